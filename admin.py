@@ -741,9 +741,14 @@ class BugAdmin(admin.ModelAdmin):
     list_display  = ('advisory', 'number', 'title')
     search_fields = ['advisory__old__package__name', 'number', 'title']
 
+class WebHookEventAdmin(admin.ModelAdmin):
+    list_display  = ('pkg_type', 'received_on', 'error')
+    list_filter = ('pkg_type',)
+
 admin.site.register(Application, ApplicationAdmin)
 admin.site.register(Package, PackageAdmin)
 admin.site.register(PackageVersion, PackageVersionAdmin)
 admin.site.register(Advisory, AdvisoryAdmin)
 admin.site.register(ApplicationHistory, ApplicationHistoryAdmin)
 admin.site.register(Bug, BugAdmin)
+admin.site.register(WebHookEvent, WebHookEventAdmin)
@@ -374,6 +374,46 @@ def file_size_callback(filename, contentdir, targetfile):  # FALSE NEGATIVE
     stat = os.lstat(filename)
     return {os.path.relpath(targetfile, contentdir) : stat.st_size}
 
+def test_cases_from_tree(tree):
+    """
+        Same as test_case_count_callback() but works on a
+        git tree listing so nothing needs to be checked out.
+
+        @tree - list - as returned by GitRepo.ls_tree()
+        @return - list - relative file names of tests
+    """
+    result = []
+    for (mode, sha, size, path) in tree:
+        # skip symlinks and hidden files, see generate_anything_from_source()
+        if (mode == '120000') or (('/' + path).find('/.') > -1):
+            continue
+
+        fname = '/' + path.lower()
+        for test_dir in utils.get_test_dirs():
+            if fname.find('/'+test_dir) > -1:
+                result.append(path)
+                break
+
+    return result
+
+def file_sizes_from_tree(tree):
+    """
+        Same as file_size_callback() but works on a
+        git tree listing so nothing needs to be checked out.
+
+        @tree - list - as returned by GitRepo.ls_tree()
+        @return - dict - {fname: size}
+    """
+    result = {}
+    for (mode, sha, size, path) in tree:
+        # skip symlinks and hidden files, see generate_anything_from_source()
+        if (mode == '120000') or (('/' + path).find('/.') > -1):
+            continue
+
+        result[path] = size
+
+    return result
+
 def normalize_list_of_dict_into_dict(alist):
     """
         Info is generated as a list of dict
@@ -20,7 +20,7 @@
 
 
 import os
-import shutil
+from gitrepo import GitRepo
 from utils import files_in_dir
 from utils import get_test_dirs
 
@@ -46,40 +46,24 @@ def generate_anything_from_source(pv, dirname, contentdir, callback):
     """
     results = []
 
-    if not os.path.exists(contentdir):
-        os.makedirs(contentdir)
-
-    os.chdir(contentdir)
-
+    content = GitRepo(contentdir)
     # empty directory => git init
-    if not os.listdir(contentdir):
-        if os.system('git init') != 0:
-            raise Exception("FAILED: git init in %s" % contentdir)
-
+    content.init()
 
     #check if the same tag already exists and skip the import
     version = pv.version.replace(" ", "_")
-    version = version.replace(".", "\.")
-    if os.system('git tag | grep "^%s$"' % version) == 0: # tag already exists
+    if content.has_tag(version): # tag already exists
         return [] # we have no idea if content was generated in the previous run
                     # so return []
 
     # remove all content files from previous tag.
     # we're doing this because tags are not imported in sequence.
-    for p in os.listdir(contentdir):
-        if p == ".git": # skip git directory
-            continue
-
-        if os.path.isfile(p):
-            os.remove(p)
-
-        if os.path.isdir(p):
-            shutil.rmtree(p, True) # ignore errors
-
+    content.clean()
 
-    os.chdir(dirname)
     # MAKE SURE we're working on the tag for this version
-    if os.system('git checkout "%s"' % pv.version.replace(" ", "_")) != 0:
+    try:
+        GitRepo(dirname).checkout(version)
+    except:
         raise Exception("FAILED: git checkout - tag doesn't exist")
 
 
@@ -108,23 +92,8 @@ def generate_anything_from_source(pv, dirname, contentdir, callback):
             results.append(res)
 
     # all done, now commit
-    os.chdir(contentdir)
-    if os.system("git add .") != 0:
-        raise Exception("FAILED: git add %s/%s" % (contentdir, pv.__unicode__()))
-
-    # this may fail if nothing has changed
-    # use -a to commit removed files
-    cmdline = "git commit -a -m 'Content gen %s' --author='Difio <no-reply@dif.io>'" % pv.__unicode__() # FALSE NEGATIVE
-    ret_code = os.system(cmdline)
-    if ret_code not in [0, 1, 256]:
-        raise Exception("FAILED: git commit %s/%s - return value %d" % (contentdir, pv.__unicode__(), ret_code))
-
-    if os.system("git tag '%s'" % pv.version.replace(" ", "_")) != 0:
-        raise Exception("FAILED: git tag %s/%s" % (contentdir, pv.__unicode__()))
-
-    # go back to the original source
-    # so that other stuff doesn't break
-    os.chdir(dirname)
+    content.commit('Content gen %s' % pv.__unicode__(), author=('Difio', 'no-reply@dif.io'))
+    content.tag(version)
 
     return results # to the caller
 
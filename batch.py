@@ -0,0 +1,76 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Execute registry callbacks, e.g. get_latest, find_date, get_download_url
+    or get_url from PACKAGE_CALLBACKS, for many packages concurrently.
+
+        results = batch.run(pypi.get_latest, [('Django', None), ('six', None)])
+
+    The callbacks block on network I/O so a pool of threads is enough.
+    utils.fetch_page() limits the number of concurrent requests to the
+    same host and reuses connections, see httppool.py.
+
+    NB: only call the network callbacks in the threads. Database access
+    belongs to the calling thread.
+"""
+
+import sys
+from traceback import format_tb
+from multiprocessing.pool import ThreadPool
+
+try:
+    from django.conf import settings
+    BATCH_WORKERS = settings.DIFIO_BATCH_WORKERS
+except:
+    BATCH_WORKERS = 16
+
+try:
+    from django.conf import settings
+    BATCH_SIZE = settings.DIFIO_BATCH_SIZE
+except:
+    BATCH_SIZE = 200
+
+def _call(func_args):
+    (func, args) = func_args
+    try:
+        return (func(*args), None)
+    except:
+        return (None, "%s\n%s" % (sys.exc_info()[1], "\n".join(format_tb(sys.exc_info()[2]))))
+
+def run(func, args_list, workers=None):
+    """
+        @func - callable - executed once for every item in @args_list
+        @args_list - list - of argument tuples
+        @workers - int - number of threads, default BATCH_WORKERS
+
+        @return - list - (result, error) for every item in the same order.
+                  error is None or the exception text with traceback.
+    """
+    if not args_list:
+        return []
+
+    if workers is None:
+        workers = BATCH_WORKERS
+
+    pool = ThreadPool(min(workers, len(args_list)))
+    try:
+        return pool.map(_call, [(func, args) for args in args_list])
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,40 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Database benchmarks. Every script creates a separate test database,
+    fills it with generated data and destroys it at the end:
+
+    $ DJANGO_SETTINGS_MODULE=mysite.settings python -m difio.benchmarks.explain
+"""
+
+from django.db import connection
+
+def create_test_db(verbosity=0):
+    """
+        Create the test database and switch the connection to it.
+        Same as the Django test runner does.
+
+        @return - string - the original database name
+    """
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+    return old_name
+
+def destroy_test_db(old_name, verbosity=0):
+    connection.creation.destroy_test_db(old_name, verbosity=verbosity)
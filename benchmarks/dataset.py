@@ -0,0 +1,194 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Generate a synthetic data set. Objects are created with
+    bulk_create() and explicit primary keys so related rows can
+    be generated without reading anything back from the database.
+"""
+
+import random
+from difio.models import *
+from django.db import connection
+from django.core.management.color import no_style
+
+# number of objects for scale = 1
+VOLUMES = {
+    'users' : 2000,
+    'packages' : 100000,
+    'versions' : 1000000,
+    'applications' : 10000,
+    'installed' : 5000000,
+    'advisories' : 200000,
+}
+
+# objects per INSERT
+BATCH_SIZE = 5000
+
+BASE_DATE = datetime(2012, 01, 01)
+
+def get_counts(scale):
+    """
+        @scale - float - 1 for the full data set
+        @return - dict - number of objects to create for each type
+    """
+    counts = {}
+    for name in VOLUMES.keys():
+        counts[name] = max(1, int(VOLUMES[name] * scale))
+
+    return counts
+
+def _bulk_create(model, objects):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) >= BATCH_SIZE:
+            model.objects.bulk_create(batch)
+            batch = []
+
+    if batch:
+        model.objects.bulk_create(batch)
+
+def _users(counts):
+    for i in range(1, counts['users'] + 1):
+        yield User(pk=i, username='user%d' % i, email='user%d@example.com' % i, password='!')
+
+def _packages(counts, rnd):
+    types = [t for (t, name) in PACKAGE_TYPES]
+    for i in range(1, counts['packages'] + 1):
+        yield Package(
+                    pk=i,
+                    name='package-%d' % i,
+                    type=rnd.choice(types),
+                    scmtype=utils.SCM_GIT,
+                    scmurl='git://example.com/package-%d.git' % i,
+                    status=rnd.choice([STATUS_NEW, STATUS_VERIFIED, STATUS_VERIFIED, STATUS_VERIFIED]),
+                    last_checked=BASE_DATE + timedelta(days=rnd.randint(0, 700)),
+                )
+
+def versions_per_package(counts):
+    return max(1, counts['versions'] // counts['packages'])
+
+def package_for_version(counts, pv_pk):
+    """
+        Versions are created in sequence for every package.
+        @return - int - Package.pk for PackageVersion @pv_pk
+    """
+    return min((pv_pk - 1) // versions_per_package(counts) + 1, counts['packages'])
+
+def _versions(counts, rnd):
+    per_pkg = versions_per_package(counts)
+    for i in range(1, counts['versions'] + 1):
+        minor = (i - 1) % per_pkg
+        yield PackageVersion(
+                    pk=i,
+                    package_id=package_for_version(counts, i),
+                    version='1.%d' % minor,
+                    scmid='v1.%d' % minor,
+                    status=rnd.choice([STATUS_NEW, STATUS_VERIFIED, STATUS_VERIFIED]),
+                    released_on=BASE_DATE + timedelta(days=minor * 30 + rnd.randint(0, 29)),
+                    download_url='http://example.com/package-%d-1.%d.tar.gz' % (package_for_version(counts, i), minor),
+                )
+
+def owner_for_application(counts, app_pk):
+    return (app_pk - 1) % counts['users'] + 1
+
+def _applications(counts, rnd):
+    for i in range(1, counts['applications'] + 1):
+        yield Application(
+                    pk=i,
+                    owner_id=owner_for_application(counts, i),
+                    name='app%d' % i,
+                    uuid='00000000-0000-0000-0000-%012d' % i,
+                    type='python-2.7',
+                    vendor=VENDOR_OPENSHIFT_EXPRESS,
+                    status=rnd.choice([APP_STATUS_APPROVED, APP_STATUS_UPTODATE, APP_STATUS_NEEDSUPDATE]),
+                    last_checkin=BASE_DATE + timedelta(days=rnd.randint(0, 700)),
+                    url='http://app%d.example.com' % i,
+                )
+
+def _installed(counts, rnd):
+    per_app = max(1, counts['installed'] // counts['applications'])
+    pk = 0
+    for app in range(1, counts['applications'] + 1):
+        owner = owner_for_application(counts, app)
+        # every app has a different package only once
+        for pv in rnd.sample(xrange(1, counts['versions'] + 1), min(per_app, counts['versions'])):
+            pk += 1
+            yield InstalledPackage(
+                        pk=pk,
+                        application=app,
+                        owner=owner,
+                        package=package_for_version(counts, pv),
+                        version=pv,
+                    )
+
+def _advisories(counts, rnd):
+    per_pkg = versions_per_package(counts)
+    for i in range(1, counts['advisories'] + 1):
+        old = rnd.randint(1, counts['versions'])
+        # newer version of the same package
+        new = old + 1
+        if (old % per_pkg == 0) or (new > counts['versions']):
+            new = old
+            old = old - 1
+        old = max(old, 1)
+
+        status = rnd.choice([STATUS_NEW, STATUS_MODIFIED, STATUS_LIVE, STATUS_LIVE, STATUS_LIVE, STATUS_LIVE])
+        yield Advisory(
+                    pk=i,
+                    old_id=old,
+                    new_id=new,
+                    type=rnd.randint(0, 100),
+                    status=status,
+                    last_updated=BASE_DATE + timedelta(days=rnd.randint(0, 700)),
+                    has_static_page=(status == STATUS_LIVE) and (rnd.random() < 0.9),
+                )
+
+def _reset_sequences():
+    """
+        Objects are created with explicit primary keys.
+        Update the sequences on databases which need it.
+    """
+    sql = connection.ops.sequence_reset_sql(no_style(), [User, Package, PackageVersion, Application, InstalledPackage, Advisory])
+    if sql:
+        cursor = connection.cursor()
+        for statement in sql:
+            cursor.execute(statement)
+
+def generate(scale=0.01, seed=0):
+    """
+        Populate an empty database.
+
+        @scale - float - 1 for the full data set, see VOLUMES
+        @seed - int - the same seed always generates the same data
+
+        @return - dict - number of objects created for each type
+    """
+    rnd = random.Random(seed)
+    counts = get_counts(scale)
+
+    _bulk_create(User, _users(counts))
+    _bulk_create(Package, _packages(counts, rnd))
+    _bulk_create(PackageVersion, _versions(counts, rnd))
+    _bulk_create(Application, _applications(counts, rnd))
+    _bulk_create(InstalledPackage, _installed(counts, rnd))
+    _bulk_create(Advisory, _advisories(counts, rnd))
+    _reset_sequences()
+
+    return counts
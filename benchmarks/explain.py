@@ -0,0 +1,197 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Print the query plans for the most common Advisory and InstalledPackage
+    lookups and fail if any of them scans the whole table or doesn't use
+    the index it was designed for.
+
+    $ DJANGO_SETTINGS_MODULE=mysite.settings python -m difio.benchmarks.explain [--scale 0.01]
+"""
+
+import re
+import sys
+from optparse import OptionParser
+from difio.models import *
+from django.db import connection
+from django.core.management.color import no_style
+from difio.benchmarks import dataset
+from difio.benchmarks import create_test_db, destroy_test_db
+
+def get_samples():
+    """
+        Pick existing values to use in the queries.
+    """
+    adv = Advisory.objects.filter(status=STATUS_LIVE).only('old', 'new')[0]
+    inst = InstalledPackage.objects.all()[0]
+
+    return {
+        'old' : adv.old_id,
+        'new' : adv.new_id,
+        'application' : inst.application,
+        'owner' : inst.owner,
+        'package' : inst.package,
+        'version' : inst.version,
+    }
+
+# (name, model which must not be scanned, fields of the index it must use,
+#  function returning the QuerySet)
+QUERIES = [
+    ('tasks.compare_versions_and_create_advisory', Advisory, ('old', 'new'),
+        lambda s: Advisory.objects.filter(old=s['old'], new=s['new']).only('id')),
+    ('tasks.update_application_status', Advisory, ('old', 'status'),
+        lambda s: Advisory.objects.filter(old=s['old'], status=STATUS_LIVE)),
+    ('views._appdetails_get_objects_fast', Advisory, ('old', 'status'),
+        lambda s: Advisory.objects.filter(old__in=[s['old'], s['new']], status=STATUS_LIVE).only('new', 'old')),
+    ('tasks.generate_static_pages', Advisory, ('status', 'has_static_page'),
+        lambda s: Advisory.objects.filter(status=STATUS_LIVE, has_static_page=False).only('id').order_by('-new__released_on')),
+    ('views.dashboard', InstalledPackage, ('application', 'version'),
+        lambda s: InstalledPackage.objects.filter(application__in=[s['application']]).only('application', 'version')),
+    ('tasks.import_application', InstalledPackage, ('application', 'version'),
+        lambda s: InstalledPackage.objects.filter(version=s['version'], application=s['application'])),
+    ('tasks.pv_import_new_from_rss', InstalledPackage, ('package', 'version'),
+        lambda s: InstalledPackage.objects.filter(package=s['package'], version__gt=0).values('version')),
+    ('views.ajax_delete_inst_pkg', InstalledPackage, ('owner',),
+        lambda s: InstalledPackage.objects.filter(owner=s['owner'])),
+]
+
+def explain(query):
+    """
+        @query - QuerySet
+        @return - list - query plan rows as strings
+    """
+    (sql, params) = query.query.get_compiler(using=query.db).as_sql()
+
+    vendor = connection.vendor
+    if vendor == 'sqlite':
+        sql = 'EXPLAIN QUERY PLAN ' + sql
+    else:
+        sql = 'EXPLAIN ' + sql
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+
+    if vendor == 'mysql':
+        columns = [col[0] for col in cursor.description]
+        return [str(dict(zip(columns, row))) for row in cursor.fetchall()]
+
+    # sqlite has the description in the last column, postgres has a single one
+    return [str(row[-1]) for row in cursor.fetchall()]
+
+def is_full_scan(plan, table):
+    """
+        @plan - list - result from explain()
+        @table - string - table name
+        @return - bool - True if the query reads every row of @table
+    """
+    vendor = connection.vendor
+
+    for line in plan:
+        if vendor == 'sqlite':
+            # SCAN TABLE x, but not SCAN TABLE x USING INDEX
+            # newer versions print SCAN x
+            if re.match('SCAN (TABLE )?%s( |$)' % table, line) and line.find('INDEX') == -1:
+                return True
+        elif vendor == 'postgresql':
+            if line.find('Seq Scan on %s' % table) > -1:
+                return True
+        elif vendor == 'mysql':
+            if (line.find("'table': '%s'" % table) > -1) and (line.find("'type': 'ALL'") > -1):
+                return True
+
+    return False
+
+def index_name(model, field_names):
+    """
+        @model - Model class
+        @field_names - tuple - as in Meta.index_together or a single db_index field
+        @return - string - the name Django gives to this index
+    """
+    fields = [model._meta.get_field_by_name(name)[0] for name in field_names]
+    sql = connection.creation.sql_indexes_for_fields(model, fields, no_style())[0]
+    return re.search(r'CREATE INDEX (\S+)', sql).group(1).strip('"`')
+
+def uses_index(plan, index):
+    """
+        @plan - list - result from explain()
+        @index - string - index name
+        @return - bool - True if the query reads @index
+    """
+    vendor = connection.vendor
+
+    for line in plan:
+        if vendor == 'sqlite':
+            # SEARCH TABLE x USING [COVERING] INDEX name (...)
+            if re.search(r'USING (COVERING )?INDEX %s( |$)' % index, line):
+                return True
+        elif vendor == 'postgresql':
+            # Index [Only] Scan using name on x, Bitmap Index Scan on name
+            if re.search(r'(Index (Only )?Scan using|Bitmap Index Scan on) %s( |$)' % index, line):
+                return True
+        elif vendor == 'mysql':
+            if line.find("'key': '%s'" % index) > -1:
+                return True
+
+    return False
+
+def check(verbose=True):
+    """
+        Explain all QUERIES.
+
+        @return - list - names of queries doing full table scans
+                  or not using their index
+    """
+    failed = []
+    samples = get_samples()
+
+    if connection.vendor == 'postgresql':
+        # small tables are cheaper to scan, make the planner show the index
+        connection.cursor().execute('SET enable_seqscan = off')
+
+    for (name, model, fields, func) in QUERIES:
+        table = model._meta.db_table
+        index = index_name(model, fields)
+        plan = explain(func(samples))
+        ok = (not is_full_scan(plan, table)) and uses_index(plan, index)
+
+        if not ok:
+            failed.append(name)
+
+        if verbose:
+            print "%s %s, expected index %s on %s" % ('OK  ' if ok else 'FAIL', name, index, ', '.join(fields))
+            for line in plan:
+                print "    %s" % line
+
+    return failed
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--scale", type="float", default=0.001, help="data set size, 1 for the full size")
+    (options, args) = parser.parse_args()
+
+    old_name = create_test_db()
+    try:
+        print "Generated", dataset.generate(options.scale)
+        failed = check()
+    finally:
+        destroy_test_db(old_name)
+
+    if failed:
+        print "Full table scans or wrong indexes in: %s" % ', '.join(failed)
+        sys.exit(1)
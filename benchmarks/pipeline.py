@@ -0,0 +1,226 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Run tasks.generate_advisory_files() against a local corpus,
+    without network access, in a test database.
+
+    $ DJANGO_SETTINGS_MODULE=mysite.settings python -m difio.benchmarks.pipeline /path/to/corpus [--json out.json]
+
+    The corpus directory contains archives, optionally local git
+    repositories, and corpus.json which describes the package pairs:
+
+    [
+        {
+            "name" : "Django",
+            "type" : 0,
+            "old" : {"version" : "1.5", "archive" : "Django-1.5.tar.gz"},
+            "new" : {"version" : "1.5.1", "archive" : "Django-1.5.1.tar.gz"},
+            "git" : "repos/django",
+            "old_tag" : "1.5",
+            "new_tag" : "1.5.1"
+        }
+    ]
+
+    "git", "old_tag" and "new_tag" are optional. If present the diff and
+    commit log come from this repository instead of the archives.
+    Tags default to the versions.
+
+    The stages are the tracing spans saved by the task in timings.json.
+    For every stage the harness reports wall time, CPU time of the process
+    and of its child processes, peak RSS (high-water marks at the end of
+    the stage), bytes read/written and the number of processes started.
+"""
+
+import os
+import sys
+import json
+import shutil
+import urllib2
+import tempfile
+from datetime import datetime
+from optparse import OptionParser
+from django.conf import settings
+
+# don't send emails and don't touch the real file storage.
+# NB: must be set before importing the tasks
+settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+settings.DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+settings.MEDIA_ROOT = tempfile.mkdtemp(prefix='difio-pipeline-media-')
+
+import difio.tasks
+from difio import utils
+from difio.models import *
+from django.core.files.storage import default_storage
+from difio.benchmarks import create_test_db, destroy_test_db
+
+def _no_network(*args, **kwargs):
+    raise Exception("Network access is disabled in the pipeline benchmark")
+
+def _disable_network():
+    """
+        Everything is read from the corpus. Make sure
+        nothing is fetched from upstream by accident.
+    """
+    # modules inside the package import each other without the difio prefix
+    for name in ['utils', 'difio.utils']:
+        if sys.modules.has_key(name):
+            sys.modules[name].fetch_page = _no_network
+
+    urllib2.urlopen = _no_network
+
+def create_advisory(corpus_dir, entry):
+    """
+        Create the Package, both PackageVersion-s and the Advisory
+        for a corpus entry in the test database.
+
+        @return - tuple - (Advisory, override) - override is True
+                  if the diff comes from the archives
+    """
+    package = Package.objects.create(name=entry['name'], type=entry['type'], status=STATUS_VERIFIED)
+
+    if entry.has_key('git'):
+        package.scmtype = utils.SCM_GIT
+        package.scmurl = os.path.abspath(os.path.join(corpus_dir, entry['git']))
+    else:
+        package.scmtype = utils.SCM_TARBALL
+    package.save()
+
+    versions = []
+    for key in ['old', 'new']:
+        path = os.path.abspath(os.path.join(corpus_dir, entry[key]['archive']))
+        versions.append(PackageVersion.objects.create(
+                            package=package,
+                            version=entry[key]['version'],
+                            scmid=entry.get('%s_tag' % key, entry[key]['version']),
+                            download_url='file://' + path,
+                            size=os.path.getsize(path),
+                            status=STATUS_VERIFIED,
+                        ))
+
+    adv = Advisory.objects.create(old=versions[0], new=versions[1], last_updated=datetime.now())
+    return (adv, not entry.has_key('git'))
+
+def _flatten(span, results, prefix=''):
+    """
+        @span - dict - tracing.Span.summary() as saved in timings.json
+        @results - dict - span path -> stats, updated in place
+    """
+    path = prefix + span['name']
+    results[path] = {
+        'wall' : span['duration'],
+        'cpu' : span['cpu'] + span['cpu_children'],
+        'maxrss' : span['maxrss'],
+        'maxrss_children' : span['maxrss_children'],
+        'subprocesses' : span['subprocesses'],
+        'read' : span['read'],
+        'written' : span['written'],
+        'http' : sum(span['http'].values()),
+    }
+
+    for child in span['spans']:
+        _flatten(child, results, path + '.')
+
+def run_entry(corpus_dir, entry):
+    """
+        Generate the advisory for a single package pair.
+
+        @return - dict - span path -> stats
+    """
+    (adv, override) = create_advisory(corpus_dir, entry)
+
+    difio.tasks.generate_advisory_files(adv.pk, ignore_status=True, override=override)
+
+    timings = json.loads(default_storage.open(adv.get_path().lstrip('/') + 'timings.json').read())
+    stages = {}
+    _flatten(timings, stages)
+
+    return stages
+
+def _add(totals, stages):
+    for (name, stats) in stages.items():
+        total = totals.setdefault(name, {'wall' : 0.0, 'cpu' : 0.0, 'subprocesses' : 0, 'read' : 0, 'written' : 0, 'http' : 0})
+        for key in total.keys():
+            total[key] += stats[key]
+
+        total['maxrss'] = max(total.get('maxrss', 0), stats['maxrss'])
+        total['maxrss_children'] = max(total.get('maxrss_children', 0), stats['maxrss_children'])
+
+def print_report(title, stages):
+    print title
+    print "    %-45s %9s %9s %10s %10s %6s %12s %12s %6s" % ('stage', 'wall s', 'cpu s', 'rss KB', 'child KB',
+                                                            'procs', 'read', 'written', 'http')
+    for name in sorted(stages.keys()):
+        s = stages[name]
+        print "    %-45s %9.3f %9.3f %10d %10d %6d %12d %12d %6d" % (name, s['wall'], s['cpu'], s['maxrss'], s['maxrss_children'],
+                                                                s['subprocesses'], s['read'], s['written'], s['http'])
+
+def run(corpus_dir, keep=False):
+    """
+        @corpus_dir - string - directory with corpus.json
+        @keep - bool - don't remove the working directory
+
+        @return - dict - {'packages' : {name : stages}, 'total' : stages}
+    """
+    corpus = json.load(open(os.path.join(corpus_dir, 'corpus.json')))
+
+    # checkouts are made under utils.which_tmp_dir()
+    workdir = tempfile.mkdtemp(prefix='difio-pipeline-')
+    tempfile.tempdir = workdir
+    for name in ['grabber', 'difio.grabber']:
+        if sys.modules.has_key(name):
+            sys.modules[name].DOWNLOAD_CACHE_DIR = os.path.join(workdir, 'cache')
+    _disable_network()
+
+    report = {'packages' : {}, 'total' : {}}
+    old_name = create_test_db()
+    try:
+        for entry in corpus:
+            name = '%s-%s-%s' % (entry['name'], entry['old']['version'], entry['new']['version'])
+            stages = run_entry(corpus_dir, entry)
+            report['packages'][name] = stages
+            _add(report['total'], stages)
+            print_report(name, stages)
+    finally:
+        destroy_test_db(old_name)
+
+        if keep:
+            print "Working directory is", workdir
+            print "Advisory files are in", settings.MEDIA_ROOT
+        else:
+            shutil.rmtree(workdir, True)
+            shutil.rmtree(settings.MEDIA_ROOT, True)
+
+    print_report('TOTAL', report['total'])
+    return report
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] CORPUS_DIR")
+    parser.add_option("--json", default=None, help="save the results as JSON")
+    parser.add_option("--keep", action="store_true", default=False, help="don't remove the working directory")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("CORPUS_DIR is required")
+
+    report = run(args[0], options.keep)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
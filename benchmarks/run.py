@@ -0,0 +1,261 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Time the most used views and tasks against a generated data set
+    and count their SQL queries.
+
+    $ DJANGO_SETTINGS_MODULE=mysite.settings python -m difio.benchmarks.run --scale 0.01 --save baseline.json
+    $ DJANGO_SETTINGS_MODULE=mysite.settings python -m difio.benchmarks.run --scale 0.01 --compare baseline.json
+
+    Results are only comparable for the same scale, seed and database vendor.
+    When comparing the exit status is non-zero if any benchmark executes
+    more queries or is slower than the allowed ratio.
+"""
+
+import sys
+import json
+import time
+import uuid
+import tempfile
+from optparse import OptionParser
+from django.conf import settings
+
+# don't send emails and don't touch the real file storage.
+# NB: must be set before importing the tasks
+settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+settings.DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+settings.MEDIA_ROOT = tempfile.mkdtemp()
+
+import difio.views
+import difio.tasks
+from difio.models import *
+from django.db import connection
+from django.core import cache as cache_module
+from django.test.client import RequestFactory
+from django.db.backends.util import CursorDebugWrapper
+from difio.benchmarks import dataset
+from difio.benchmarks import create_test_db, destroy_test_db
+
+# how much slower than the baseline is still OK
+DEFAULT_MAX_RATIO = 1.5
+
+class _QueryCounter(object):
+    count = 0
+
+class CountingCursor(CursorDebugWrapper):
+    """
+        Counts all queries. Tasks call reset_queries() when done
+        so connection.queries can't be used for that.
+    """
+    def execute(self, sql, params=()):
+        _QueryCounter.count += 1
+        return super(CountingCursor, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        _QueryCounter.count += 1
+        return super(CountingCursor, self).executemany(sql, param_list)
+
+def _install_query_counter():
+    connection.use_debug_cursor = True
+    connection.make_debug_cursor = lambda cursor: CountingCursor(cursor, connection)
+
+def get_samples(counts):
+    """
+        Pick objects which have data for every benchmark.
+    """
+    adv = Advisory.objects.filter(status=STATUS_LIVE).only('old')[0]
+    app = Application.objects.all()[0]
+
+    return {
+        'user' : User.objects.filter(pk=app.owner_id)[0],
+        'app' : app,
+        'package' : PackageVersion.objects.filter(pk=adv.old_id).only('package')[0].package_id,
+        'per_app' : max(1, counts['installed'] // counts['applications']),
+        'static_pages' : list(Advisory.objects.filter(
+                                    status=STATUS_LIVE,
+                                    has_static_page=False
+                                ).values_list('pk', flat=True)),
+    }
+
+def _request(user, path='/'):
+    request = RequestFactory().get(path)
+    request.user = user
+    return request
+
+def bench_dashboard(s):
+    difio.views.dashboard(_request(s['user']))
+
+def bench_appdetails_get_objects_fast(s):
+    difio.views._appdetails_get_objects_fast(s['user'].pk, s['app'].pk, 1, 1)
+
+def bench_previous_analytics(s):
+    difio.views.previous_analytics(_request(s['user']), 'package', s['package'])
+
+def bench_import_application(s):
+    """
+        Import a new application with the same number of
+        packages as the generated ones.
+    """
+    app = Application.objects.create(
+                    owner=s['user'],
+                    name='benchmark',
+                    uuid=str(uuid.uuid4()),
+                    type='python-2.7',
+                    vendor=VENDOR_VIRTUALENV,
+                    status=APP_STATUS_IMPORTING,
+                    url='http://benchmark.example.com',
+                )
+
+    installed = []
+    for pv in PackageVersion.objects.all().only('package', 'version').select_related('package')[:s['per_app']]:
+        installed.append({'n' : pv.package.name, 'v' : pv.version, 't' : pv.package.type})
+
+    data = {
+        'installed' : installed,
+        'pkg_type' : PYPI_PYTHON_PKG,
+        'name_url_type_changed' : False,
+    }
+    cache_module.get_cache('taskq').set(app.uuid, data)
+
+    # first time, automatic import doesn't schedule searches
+    return lambda: difio.tasks.import_application(app.pk, app.uuid, s['user'].pk, False, True)
+
+def bench_update_application_status(s):
+    difio.tasks.update_application_status(s['app'].pk)
+
+def bench_notify_app_owner_about_update(s):
+    difio.tasks.notify_app_owner_about_update(s['user'].pk, dataset.BASE_DATE, datetime.now(), 1)
+
+def bench_generate_static_pages(s):
+    # pages are generated only once
+    Advisory.objects.filter(pk__in=s['static_pages']).update(has_static_page=False)
+    return lambda: difio.tasks.generate_static_pages(True)
+
+# name, function, needs setup
+# functions which need setup return the callable to measure
+BENCHMARKS = [
+    ('views.dashboard', bench_dashboard, False),
+    ('views._appdetails_get_objects_fast', bench_appdetails_get_objects_fast, False),
+    ('views.previous_analytics', bench_previous_analytics, False),
+    ('tasks.import_application', bench_import_application, True),
+    ('tasks.update_application_status', bench_update_application_status, False),
+    ('tasks.notify_app_owner_about_update', bench_notify_app_owner_about_update, False),
+    ('tasks.generate_static_pages', bench_generate_static_pages, True),
+]
+
+def run(samples, repeat=3, only=None):
+    """
+        @samples - dict - see get_samples()
+        @repeat - int - take the fastest of that many executions
+        @only - list - names of benchmarks to execute, all if None
+
+        @return - dict - name -> {'time' : seconds, 'queries' : count}
+    """
+    results = {}
+    _install_query_counter()
+
+    for (name, func, needs_setup) in BENCHMARKS:
+        if only and (name not in only):
+            continue
+
+        best = None
+        queries = None
+        for i in range(repeat):
+            if needs_setup:
+                call = func(samples)
+            else:
+                call = lambda: func(samples)
+
+            _QueryCounter.count = 0
+            start = time.time()
+            call()
+            elapsed = time.time() - start
+
+            if (best is None) or (elapsed < best):
+                best = elapsed
+            queries = _QueryCounter.count
+
+        results[name] = {'time' : best, 'queries' : queries}
+        print "%-45s %8.3f s %8d queries" % (name, best, queries)
+
+    return results
+
+def compare(results, baseline, max_ratio=DEFAULT_MAX_RATIO):
+    """
+        @return - list - names of benchmarks which regressed
+    """
+    regressions = []
+
+    for name in sorted(results.keys()):
+        if not baseline.has_key(name):
+            continue
+
+        old = baseline[name]
+        new = results[name]
+        ratio = new['time'] / max(old['time'], 0.001)
+
+        regressed = (new['queries'] > old['queries']) or (ratio > max_ratio)
+        if regressed:
+            regressions.append(name)
+
+        print "%s %-45s time x%.2f queries %d -> %d" % ('FAIL' if regressed else 'OK  ', name, ratio, old['queries'], new['queries'])
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--scale", type="float", default=0.001, help="data set size, 1 for the full size")
+    parser.add_option("--seed", type="int", default=0, help="random seed for the data set")
+    parser.add_option("--repeat", type="int", default=3, help="executions of each benchmark")
+    parser.add_option("--only", action="append", default=None, help="benchmark name, may be repeated")
+    parser.add_option("--save", default=None, help="save results as JSON")
+    parser.add_option("--compare", default=None, help="compare with results saved previously")
+    parser.add_option("--max-ratio", type="float", default=DEFAULT_MAX_RATIO, help="allowed slowdown")
+    (options, args) = parser.parse_args()
+
+    old_name = create_test_db()
+    try:
+        start = time.time()
+        counts = dataset.generate(options.scale, options.seed)
+        print "Generated %s in %.1f s" % (counts, time.time() - start)
+
+        results = run(get_samples(counts), options.repeat, options.only)
+    finally:
+        destroy_test_db(old_name)
+
+    if options.save:
+        output = {
+            'scale' : options.scale,
+            'seed' : options.seed,
+            'vendor' : connection.vendor,
+            'results' : results,
+        }
+        with open(options.save, 'w') as f:
+            json.dump(output, f, indent=4, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare, 'r') as f:
+            baseline = json.load(f)
+
+        if (baseline['scale'] != options.scale) or (baseline['vendor'] != connection.vendor):
+            print "WARNING: baseline is for scale %s on %s" % (baseline['scale'], baseline['vendor'])
+
+        if compare(results, baseline['results'], options.max_ratio):
+            sys.exit(1)
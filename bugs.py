@@ -23,9 +23,17 @@
 ################################################################################
 
 import re
+import sys
+import csv
+import json
+import urllib
+import logging
+from StringIO import StringIO
 from BeautifulSoup import BeautifulSoup
 from datetime import datetime, timedelta
 
+logger = logging.getLogger(__name__)
+
 def extract_bug_numbers(alist):
     """
         Remove the text from "issue #123" and
@@ -516,6 +524,187 @@ def extract_title_and_dates_from_html(page, type):
 
     return (title.strip(), reported_on, closed_on)
 
+#### tracker API backends
+#
+# Most trackers expose the same data we scrape from HTML through an API.
+# It is smaller to download, doesn't break when the page layout changes
+# and for some trackers can be queried for many bugs at once.
+# The HTML scrapers above are used as a fallback.
+
+# max number of bugs to query with a single API request
+BUG_API_BATCH_SIZE = 50
+
+def _api_date(value):
+    """
+        Parse the ISO 8601 dates returned by most tracker APIs.
+        Time zone information is ignored.
+    """
+    if not value:
+        return None
+
+    return datetime.strptime(value[:19].replace(' ', 'T'), '%Y-%m-%dT%H:%M:%S')
+
+def _split_format_string(bug_format_str, separator):
+    """
+        Split a bug format string at separator.
+
+        @return - (prefix, suffix) - the part before the separator and
+        the part between the separator and the number placeholder.
+    """
+    (base, rest) = bug_format_str.split(separator, 1)
+    return (base, rest.replace('%d', ''))
+
+def _batches(numbers):
+    """
+        Split a list of bug numbers into API sized chunks
+    """
+    for i in range(0, len(numbers), BUG_API_BATCH_SIZE):
+        yield numbers[i:i+BUG_API_BATCH_SIZE]
+
+def get_github_api(bug_format_str, numbers):
+    """
+        Query the GitHub issues API. Works for pull requests too.
+        One request per bug, there's no batch lookup by number.
+    """
+    from utils import fetch_page
+    import github
+
+    (user_repo, ignore) = _split_format_string(bug_format_str.split('://github.com/', 1)[1], '/issues/')
+
+    api_url = 'https://api.github.com/repos/%s/issues/%d'
+    if github.settings_imported:
+        api_url += '?client_id=%s&client_secret=%s' % (github.GITHUB_APP_ID, github.GITHUB_API_SECRET)
+
+    result = {}
+    for num in numbers:
+        data = json.loads(fetch_page(api_url % (user_repo, num)))
+        result[num] = (data['title'], _api_date(data['created_at']), _api_date(data['closed_at']))
+
+    return result
+
+def get_bugzilla_api(bug_format_str, numbers):
+    """
+        Query the Bugzilla REST API, many bugs at a time.
+        NB: needs Bugzilla 5.0 or later.
+    """
+    from utils import fetch_page
+
+    (base, ignore) = _split_format_string(bug_format_str, 'show_bug.cgi')
+    api_url = base + 'rest/bug?include_fields=id,summary,creation_time,last_change_time,is_open&id=%s'
+
+    result = {}
+    for batch in _batches(numbers):
+        data = json.loads(fetch_page(api_url % ','.join([str(n) for n in batch])))
+        for bug in data['bugs']:
+            closed_on = None
+            if not bug['is_open']:
+                closed_on = _api_date(bug['last_change_time'])
+
+            result[bug['id']] = (bug['summary'], _api_date(bug['creation_time']), closed_on)
+
+    return result
+
+def get_launchpad_api(bug_format_str, numbers):
+    """
+        Query the Launchpad web service API. Bugs are global in
+        Launchpad so the project name from the format string is not needed.
+        Closed date is the latest date a bug task was completed on.
+    """
+    from utils import fetch_page
+
+    result = {}
+    for num in numbers:
+        data = json.loads(fetch_page('https://api.launchpad.net/1.0/bugs/%d' % num))
+        tasks = json.loads(fetch_page(data['bug_tasks_collection_link']))
+
+        closed_on = None
+        for t in tasks['entries']:
+            if t['is_complete'] and t['date_closed']:
+                closed_on = max(closed_on, t['date_closed'])
+
+        result[num] = (data['title'], _api_date(data['date_created']), _api_date(closed_on))
+
+    return result
+
+def get_jira_api(bug_format_str, numbers):
+    """
+        Query the JIRA REST API search endpoint, many issues at a time.
+        Bug format string looks like https://issues.jboss.org/browse/HV-%d
+    """
+    from utils import fetch_page
+
+    (base, project) = _split_format_string(bug_format_str, '/browse/')
+    api_url = base + '/rest/api/2/search?fields=summary,created,resolutiondate&maxResults=%d&jql=%s'
+
+    result = {}
+    for batch in _batches(numbers):
+        jql = 'key in (%s)' % ','.join(['%s%d' % (project, n) for n in batch])
+        data = json.loads(fetch_page(api_url % (len(batch), urllib.quote(jql))))
+        for issue in data['issues']:
+            num = int(issue['key'].split('-')[-1])
+            fields = issue['fields']
+            result[num] = (fields['summary'], _api_date(fields['created']), _api_date(fields['resolutiondate']))
+
+    return result
+
+def get_trac_api(bug_format_str, numbers):
+    """
+        Query Trac's CSV export of the custom query page, many tickets at a time.
+        Closed date is the last change time for closed tickets.
+    """
+    from utils import fetch_page
+
+    (base, ignore) = _split_format_string(bug_format_str, '/ticket/')
+    api_url = base + '/query?format=csv&col=id&col=summary&col=status&col=time&col=changetime&max=%d&id=%s'
+
+    result = {}
+    for batch in _batches(numbers):
+        page = fetch_page(api_url % (len(batch), ','.join([str(n) for n in batch])), False)
+        # NB: page may start with UTF-8 BOM
+        for row in csv.DictReader(StringIO(page.lstrip('\xef\xbb\xbf'))):
+            closed_on = None
+            if row['status'] == 'closed':
+                closed_on = _api_date(row['changetime'])
+
+            result[int(row['id'])] = (row['summary'].decode('UTF-8', 'replace'), _api_date(row['time']), closed_on)
+
+    return result
+
+BUG_API_BACKENDS = {
+    BUG_TYPE_GITHUB : get_github_api,
+    BUG_TYPE_BUGZILLA : get_bugzilla_api,
+    BUG_TYPE_LAUNCHPAD : get_launchpad_api,
+    BUG_TYPE_JIRA : get_jira_api,
+    BUG_TYPE_TRAC : get_trac_api,
+}
+
+def get_title_and_dates_from_api(bug_format_str, numbers, type):
+    """
+        Get bug info from the tracker API if there is a backend for it.
+
+        @bug_format_str - string - the bug URL format string
+        @numbers - list - bug numbers
+        @type - int - bug tracker type
+
+        @return - dict - { num : (title, reported_on, closed_on) }. Bugs which
+        are missing should be scraped with extract_title_and_dates_from_html().
+    """
+
+    if not BUG_API_BACKENDS.has_key(type):
+        return {}
+
+    try:
+        result = BUG_API_BACKENDS[type](bug_format_str, numbers)
+    except:
+        logger.error("Tracker API failed for %s: %s" % (bug_format_str, sys.exc_info()[1]))
+        return {}
+
+    for num in result.keys():
+        (title, reported_on, closed_on) = result[num]
+        result[num] = ((title or '').strip(), reported_on, closed_on)
+
+    return result
+
 
 def get_bug_format_string(homepage):
     """
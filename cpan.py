@@ -20,6 +20,7 @@
 
 
 import json
+import urllib
 import httplib
 import logging
 from utils import fetch_page
@@ -97,38 +98,121 @@ def get_author_from_json(package):
     return data['author']
 
 
-def get_release_date(package, version, data = None):
+# MetaCPAN returns at most that many results per request
+SEARCH_PAGE_SIZE = 500
+
+RELEASE_FIELDS = ['author', 'distribution', 'version', 'date', 'download_url', 'maturity']
+
+def search_releases(query):
     """
-        Return the released_on date for this version.
+        Search metacpan.org for releases, oldest first.
+
+        @query - string - Lucene query, e.g. date:[2014-01-01T00:00:00 TO *]
+        @return - generator - of dicts with RELEASE_FIELDS
+    """
+    offset = 0
+    while True:
+        json_data = fetch_page('http://api.metacpan.org/v0/release/_search?q=%s&fields=%s&sort=date:asc&size=%d&from=%d' %
+                            (urllib.quote(query), ','.join(RELEASE_FIELDS), SEARCH_PAGE_SIZE, offset)
+                    )
+        data = json.loads(json_data)
+        hits = data['hits']['hits']
+
+        for hit in hits:
+            release = {}
+            for field in RELEASE_FIELDS:
+                value = hit['fields'].get(field)
+                # some versions of the API return a list for every field
+                if type(value) == type([]):
+                    value = value and value[0] or None
+                release[field] = value
+            yield release
+
+        offset += len(hits)
+        if (not hits) or (offset >= data['hits']['total']):
+            break
+
+def get_indexed_release(package, version = None):
+    """
+        Look up a release in the local index, see models.CpanRelease.
+
+        @package - string - package or distribution name
+        @version - string - if None return the latest stable release
+
+        @return - dict - with RELEASE_FIELDS, same as metacpan.org returns,
+                  or None if not indexed or not running inside Django
     """
+    try:
+        from models import CpanRelease
+    except:
+        return None
+
     package = _other_name(package)
     package = package.replace('::', '-')
 
-    if not data:
-        # todo: this will fail if later version changed author. e.g. Dancer-1.000
-        author = get_author_from_json(package)
+    query = CpanRelease.objects.filter(distribution=package)
+    if version is None:
+        query = query.filter(maturity='released').order_by('-released_on')
+    else:
+        query = query.filter(version=version)
+
+    try:
+        release = query[0]
+    except IndexError:
+        return None
+
+    return {
+        'author' : release.author,
+        'distribution' : release.distribution,
+        'version' : release.version,
+        'date' : release.released_on.strftime('%Y-%m-%dT%H:%M:%S'),
+        'download_url' : release.download_url,
+        'maturity' : release.maturity,
+    }
+
+def _get_release(package, version):
+    """
+        Return the version specific details from the local index
+        or metacpan.org.
+    """
+    data = get_indexed_release(package, version)
+    if data:
+        return data
+
+    # todo: this will fail if later version changed author. e.g. Dancer-1.000
+    author = get_author_from_json(package)
+
+    # need a second call to metacpan.org to fetch version specific details
+    conn = httplib.HTTPConnection('api.metacpan.org')
+    conn.request('GET', '/v0/release/%s/%s-%s' % (author, package, version))
+    response = conn.getresponse()
+
+    if (response.status != 200):
+        # maybe authors changed. Try parse HTML
+        author = get_author_from_html(package, version)
+        if not author:
+            raise Exception("MetaCPAN - _get_release (%s, %s) - returned %d and no author" % (package, version, response.status))
 
-        # need a second call to metacpan.org to fetch version specific details
+        # 3rd try with the value in HTML
         conn = httplib.HTTPConnection('api.metacpan.org')
         conn.request('GET', '/v0/release/%s/%s-%s' % (author, package, version))
         response = conn.getresponse()
 
         if (response.status != 200):
-            # maybe authors changed. Try parse HTML
-            author = get_author_from_html(package, version)
-            if not author:
-                raise Exception("MetaCPAN - get_release_date2 (%s, %s) - returned %d and no author" % (package, version, response.status))
+            raise Exception("MetaCPAN - _get_release2 (%s, %s) - returned %d" % (package, version, response.status))
 
-            # 3rd try with the value in HTML
-            conn = httplib.HTTPConnection('api.metacpan.org')
-            conn.request('GET', '/v0/release/%s/%s-%s' % (author, package, version))
-            response = conn.getresponse()
+    json_data = response.read().decode('UTF-8')
+    return json.loads(json_data)
 
-            if (response.status != 200):
-                raise Exception("MetaCPAN - get_release_date3 (%s, %s) - returned %d" % (package, version, response.status))
+def get_release_date(package, version, data = None):
+    """
+        Return the released_on date for this version.
+    """
+    package = _other_name(package)
+    package = package.replace('::', '-')
 
-        json_data = response.read().decode('UTF-8')
-        data = json.loads(json_data)
+    if not data:
+        data = _get_release(package, version)
 
     if data.has_key('date'):
         return datetime.strptime(data['date'], '%Y-%m-%dT%H:%M:%S')
@@ -143,30 +227,7 @@ def get_download_url(package, version, data = None):
     package = package.replace('::', '-')
 
     if not data:
-        # todo: this will fail if later version changed author. e.g. Dancer-1.000
-        author = get_author_from_json(package)
-
-        # need a second call to metacpan.org to fetch version specific details
-        conn = httplib.HTTPConnection('api.metacpan.org')
-        conn.request('GET', '/v0/release/%s/%s-%s' % (author, package, version))
-        response = conn.getresponse()
-
-        if (response.status != 200):
-            # maybe authors changed. Try parse HTML
-            author = get_author_from_html(package, version)
-            if not author:
-                raise Exception("MetaCPAN - get_download_url (%s, %s) - returned %d and no author" % (package, version, response.status))
-
-            # 3rd try with the value in HTML
-            conn = httplib.HTTPConnection('api.metacpan.org')
-            conn.request('GET', '/v0/release/%s/%s-%s' % (author, package, version))
-            response = conn.getresponse()
-
-            if (response.status != 200):
-                raise Exception("MetaCPAN - get_download_url2 (%s, %s) - returned %d" % (package, version, response.status))
-
-        json_data = response.read().decode('UTF-8')
-        data = json.loads(json_data)
+        data = _get_release(package, version)
 
     if data.has_key('download_url'):
         return data['download_url']
@@ -204,7 +265,7 @@ def get_latest(package, last_checked=None):
 
     return version, released_on
 
-def get_url(package, version=None):
+def get_url(package, version=None, data = None):
     """
         Return homepage, repo, bugtracker URLs for a package
     """
@@ -217,15 +278,16 @@ def get_url(package, version=None):
             'bugtracker' : 'https://rt.cpan.org/Public/Dist/Display.html?Name=%s' % package,
         }
 
-    conn = httplib.HTTPConnection('api.metacpan.org')
-    conn.request('GET', '/v0/release/%s' % package)
-    response = conn.getresponse()
+    if not data:
+        conn = httplib.HTTPConnection('api.metacpan.org')
+        conn.request('GET', '/v0/release/%s' % package)
+        response = conn.getresponse()
 
-    if (response.status != 200):
-        raise Exception("MetaCPAN - get_url - returned %d" % response.status)
+        if (response.status != 200):
+            raise Exception("MetaCPAN - get_url - returned %d" % response.status)
 
-    json_data = response.read().decode('UTF-8')
-    data = json.loads(json_data)
+        json_data = response.read().decode('UTF-8')
+        data = json.loads(json_data)
 
     if data.has_key('resources'):
         resources = data['resources']
@@ -241,6 +303,49 @@ def get_url(package, version=None):
 
     return urls
 
+def resolve_version(package, version):
+    """
+        Return released_on, download_url, size, checksum and
+        homepage, repo, bugtracker URLs for this version.
+        Looks up the release only once instead of for every field.
+
+        The local index knows only the date and download URL so
+        size, checksum and URLs are None for indexed releases and
+        the caller will fetch them separately.
+    """
+    package = _other_name(package)
+    package = package.replace('::', '-')
+
+    data = get_indexed_release(package, version)
+    if data:
+        return {
+            'released_on' : get_release_date(package, version, data),
+            'download_url' : get_download_url(package, version, data),
+            'size' : None,
+            'checksum' : None,
+            'urls' : None,
+        }
+
+    data = _get_release(package, version)
+
+    result = {
+        'released_on' : get_release_date(package, version, data),
+        'download_url' : get_download_url(package, version, data),
+        'size' : None,
+        'checksum' : None,
+        'urls' : get_url(package, version, data),
+    }
+
+    if data.has_key('stat') and data['stat'].has_key('size'):
+        result['size'] = data['stat']['size']
+
+    if data.get('checksum_sha256'):
+        result['checksum'] = 'sha256:%s' % data['checksum_sha256']
+    elif data.get('checksum_md5'):
+        result['checksum'] = 'md5:%s' % data['checksum_md5']
+
+    return result
+
 def compare_versions(ver1, ver2):
     """
         TODO:
@@ -17,9 +17,21 @@
 ################################################################################
 
 
+import uuid
+import hashlib
+import inspect
+import tracing
+import logging
+import threading
+import querybudget
 from functools import wraps
 from django.core.cache import cache
 
+logger = logging.getLogger(__name__)
+
+# memcache keys are limited to 250 characters
+MAX_KEY_LENGTH = 200
+
 def execute_once_in(seconds):
     """
     This decorator wraps a normal function
@@ -56,6 +68,204 @@ decoration when sending to particular users/subjects as well.
             return func(*args, **kwargs)
 
 
-        return wraps(func)(inner_decorator)
+        return _wrap(func, inner_decorator)
+
+    return decorator
+
+
+def _wrap(func, inner_decorator):
+    """
+        Same as wraps(func)(inner_decorator) but also keeps a reference
+        to @func. Python 2 doesn't set __wrapped__.
+    """
+    inner_decorator = wraps(func)(inner_decorator)
+    inner_decorator.__wrapped__ = func
+    return inner_decorator
+
+def _arg_values(func, args, kwargs):
+    """
+        @return - dict - argument name -> value for a call to @func.
+        Looks through the decorators above, their signature is (*args, **kwargs).
+    """
+    while hasattr(func, '__wrapped__'):
+        func = func.__wrapped__
+
+    values = dict(zip(inspect.getargspec(func).args, args))
+    values.update(kwargs)
+    return values
+
+def _make_key(prefix, func, key_args, args, kwargs):
+    """
+        Build a cache key from the function name and the values
+        of the arguments listed in @key_args.
+    """
+    values = _arg_values(func, args, kwargs)
+
+    parts = []
+    for name in key_args:
+        parts.append(str(values.get(name)))
+
+    key = "%s.%s.%s(%s)" % (prefix, func.__module__, func.__name__, ','.join(parts))
+    key = key.replace(' ','_') # memcache doesn't like spaces
+
+    if len(key) > MAX_KEY_LENGTH:
+        key = "%s.%s" % (prefix, hashlib.sha1(key).hexdigest())
+
+    return key
+
+
+class _Lease(object):
+    """
+        Keeps a cache lock alive while the task is running.
+    """
+
+    def __init__(self, key, token, timeout):
+        self.key = key
+        self.token = token
+        self.timeout = timeout
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.renew)
+        self.thread.daemon = True
+
+    def acquire(self):
+        if not cache.add(self.key, self.token, self.timeout):
+            return False
+
+        self.thread.start()
+        return True
+
+    def renew(self):
+        # renew at half of the lease time. If another worker has
+        # taken over after the lease expired don't touch its lock
+        while not self.stopped.wait(self.timeout / 2.0):
+            if cache.get(self.key) != self.token:
+                return
+            cache.set(self.key, self.token, self.timeout)
+
+    def release(self):
+        self.stopped.set()
+        self.thread.join()
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+
+def single_instance(key_args, timeout=300, dedup=0):
+    """
+    This decorator allows only one running instance of a task for the
+    same arguments. Duplicate messages are dropped instead of waiting.
+
+    Useful against two workers diffing the same advisory or querying
+    upstream for the same package at the same time, e.g. when SQS
+    delivers a message twice.
+
+    @key_args - list - names of the arguments which identify the work.
+                Don't use callbacks or objects here, only values
+                with stable string representation (ids, names).
+    @timeout - int - lease time in seconds. It is renewed while
+                the task is running so this only matters if the
+                worker dies without releasing the lock.
+    @dedup - int - if set, drop the same work for that many seconds
+                after it has finished.
+
+    NB: The cache backend must provide atomic add(), e.g. memcached.
+
+    Usage:
+
+    @task
+    @single_instance(['id'], dedup=600)
+    def myfunction(id, callback):
+        pass
+    """
+
+    def decorator(func):
+        def inner_decorator(*args, **kwargs):
+            lock_key = _make_key('lock', func, key_args, args, kwargs)
+            done_key = _make_key('done', func, key_args, args, kwargs)
+
+            if dedup and cache.get(done_key):
+                logger.info("Skipping %s, executed in the last %d seconds" % (done_key, dedup))
+                return
+
+            lease = _Lease(lock_key, uuid.uuid4().hex, timeout)
+            if not lease.acquire():
+                logger.info("Skipping %s, already running" % lock_key)
+                return
+
+            try:
+                result = func(*args, **kwargs)
+                if dedup:
+                    cache.set(done_key, True, dedup)
+                return result
+            finally:
+                lease.release()
+
+
+        return _wrap(func, inner_decorator)
+
+    return decorator
+
+
+def traced(tag_args=[]):
+    """
+    This decorator wraps the function in a tracing span named after it.
+    Spans opened inside the function become its children.
+
+    @tag_args - list - names of the arguments to add to the log line
+
+    Usage:
+
+    @task
+    @traced(['id'])
+    def myfunction(id):
+        with tracing.span('download'):
+            pass
+    """
+
+    def decorator(func):
+        def inner_decorator(*args, **kwargs):
+            values = _arg_values(func, args, kwargs)
+
+            tags = {}
+            for name in tag_args:
+                tags[name] = values.get(name)
+
+            with tracing.span(func.__name__, **tags):
+                return func(*args, **kwargs)
+
+        return _wrap(func, inner_decorator)
 
     return decorator
+
+
+def query_budget(func):
+    """
+    This decorator counts the SQL queries and DB time of a task or view
+    and checks them against the budget for <module>.<function name>,
+    e.g. tasks.import_application. See querybudget.py.
+
+    Usage:
+
+    @task
+    @query_budget
+    def myfunction(id):
+        pass
+    """
+
+    def inner_decorator(*args, **kwargs):
+        rec = querybudget.Recording(querybudget.budget_name(func)).start()
+        try:
+            result = func(*args, **kwargs)
+        except:
+            # don't hide the original exception
+            try:
+                rec.stop()
+            except querybudget.QueryBudgetExceeded:
+                pass
+            raise
+
+        rec.stop()
+        return result
+
+    # QueryBudgetMiddleware skips views which are already measured
+    inner_decorator.query_budget = True
+    return _wrap(func, inner_decorator)
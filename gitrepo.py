@@ -0,0 +1,301 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+import os
+import time
+import shutil
+import subprocess
+
+DIFIO_AUTHOR = ('Difio', 'info@nospam.dif.io')
+
+def _quote_path(path):
+    """
+        Quote a path for git fast-import
+    """
+    return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class GitRepo(object):
+    """
+        A local git repository used to store tarball contents and
+        generated content.
+
+        All commands are executed with an explicit working directory
+        instead of os.chdir() so this is safe to use from threads.
+    """
+
+    def __init__(self, path):
+        """
+            @path - string - the top-level directory of the repository
+        """
+        self.path = path
+
+    def git(self, args, input=None, env=None, check=True):
+        """
+            Execute a git command inside the repository.
+
+            @args - list - git arguments
+            @input - string - optional data for stdin
+            @env - dict - optional additional environment variables
+            @check - bool - if True raise on non zero exit status
+
+            @return - string - stdout
+        """
+        cmdline = ['git'] + list(args)
+
+        proc_env = None
+        if env:
+            proc_env = os.environ.copy()
+            proc_env.update(env)
+
+        stdin = None
+        if input is not None:
+            stdin = subprocess.PIPE
+
+        proc = subprocess.Popen(cmdline, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.path, env=proc_env)
+        (out, err) = proc.communicate(input)
+
+        if check and (proc.returncode != 0):
+            raise Exception("FAILED: %s in %s - %s" % (' '.join(cmdline), self.path, err.strip()))
+
+        return out
+
+    def init(self):
+        """
+            Create the repository if it doesn't exist.
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        if not os.path.exists(os.path.join(self.path, '.git')):
+            self.git(['init', '-q'])
+
+    def rev_parse(self, rev):
+        """
+            @return - string - the commit sha for @rev or None if it doesn't exist
+        """
+        sha = self.git(['rev-parse', '-q', '--verify', '%s^{commit}' % rev], check=False).strip()
+        return sha or None
+
+    def has_tag(self, name):
+        """
+            @return - bool - True if tag @name exists
+        """
+        return self.rev_parse('refs/tags/%s' % name) is not None
+
+    def tags(self):
+        """
+            @return - set - all tag names
+        """
+        return set(self.git(['tag']).split())
+
+    def tag(self, name, rev='HEAD'):
+        self.git(['tag', name, rev])
+
+    def checkout(self, rev):
+        self.git(['checkout', '-q', rev])
+
+    def clean(self):
+        """
+            Remove everything from the working tree except the .git directory.
+            Tags are not imported in sequence so the previous contents must go.
+        """
+        for p in os.listdir(self.path):
+            path = os.path.join(self.path, p)
+
+            # skip git directory
+            if (p == ".git") and os.path.isdir(path):
+                continue
+
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, True) # ignore errors
+            else:
+                os.remove(path)
+
+    def worktree_files(self):
+        """
+            @return - list - paths of all files and symlinks in the working tree,
+            relative to the repository, without the .git directory.
+        """
+        result = []
+        l = len(self.path.rstrip('/')) + 1
+
+        for (dirpath, dirs, files) in os.walk(self.path):
+            if dirpath == self.path and '.git' in dirs:
+                dirs.remove('.git')
+
+            # symlinks to directories are listed in dirs but not followed
+            for d in dirs:
+                if os.path.islink(os.path.join(dirpath, d)):
+                    files.append(d)
+
+            for f in files:
+                result.append(os.path.join(dirpath, f)[l:])
+
+        return result
+
+    def commit(self, message, files=None, author=DIFIO_AUTHOR):
+        """
+            Commit and return the new commit sha.
+            An empty commit is created if nothing has changed.
+
+            @message - string - commit message
+            @files - list - optional, paths relative to the repository.
+                     If specified the committed tree is built from these files
+                     only, everything else is removed from it. Otherwise
+                     the whole working tree is committed.
+            @author - tuple - (name, email)
+        """
+        if files is None:
+            self.git(['add', '-A', '.'])
+        else:
+            # build the index from the file list
+            self.git(['read-tree', '--empty'])
+            if files:
+                self.git(['update-index', '--add', '-z', '--stdin'], input='\0'.join(files) + '\0')
+
+        tree = self.git(['write-tree']).strip()
+
+        args = ['commit-tree', tree, '-m', message]
+        parent = self.rev_parse('HEAD')
+        if parent:
+            args += ['-p', parent]
+
+        env = {
+            'GIT_AUTHOR_NAME' : author[0],
+            'GIT_AUTHOR_EMAIL' : author[1],
+            'GIT_COMMITTER_NAME' : author[0],
+            'GIT_COMMITTER_EMAIL' : author[1],
+        }
+        sha = self.git(args, env=env).strip()
+        self.git(['update-ref', 'HEAD', sha])
+
+        return sha
+
+    def ls_tree(self, rev):
+        """
+            List all files in @rev without checking it out.
+
+            @return - list - (mode, sha, size, path) tuples, size is an int
+        """
+        result = []
+
+        for line in self.git(['ls-tree', '-r', '-l', '-z', rev]).split('\0'):
+            if not line:
+                continue
+
+            (info, path) = line.split('\t', 1)
+            (mode, type, sha, size) = info.split()
+            if type != 'blob':
+                continue
+
+            if size == '-':
+                size = 0
+
+            result.append((mode, sha, int(size), path))
+
+        return result
+
+    def fast_import(self, members, ref, message, author=DIFIO_AUTHOR):
+        """
+            Stream archive members straight into git fast-import and
+            commit them under @ref. Nothing is written to the working tree.
+
+            If all members are under a single top-level directory
+            it is stripped from their paths, same as tar.untar() does.
+
+            @members - iterable - (path, kind, mode, data) tuples, see tar.iter_tar()
+            @ref - string - e.g. refs/tags/1.0
+            @message - string - commit message
+            @author - tuple - (name, email)
+
+            @return - int - number of committed files
+        """
+        if isinstance(message, unicode):
+            message = message.encode('UTF-8')
+
+        proc = subprocess.Popen(['git', 'fast-import', '--quiet', '--done'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                cwd=self.path)
+
+        entries = {} # path -> (git mode, mark)
+        hardlinks = []
+        mark = 0
+
+        try:
+            for (path, kind, mode, data) in members:
+                if kind == 'hardlink':
+                    hardlinks.append((path, data))
+                    continue
+
+                mark += 1
+                proc.stdin.write('blob\nmark :%d\ndata %d\n' % (mark, len(data)))
+                proc.stdin.write(data)
+                proc.stdin.write('\n')
+
+                if kind == 'symlink':
+                    git_mode = '120000'
+                elif mode & 0111:
+                    git_mode = '100755'
+                else:
+                    git_mode = '100644'
+
+                entries[path] = (git_mode, mark)
+
+            for (path, target) in hardlinks:
+                if entries.has_key(target):
+                    entries[path] = entries[target]
+
+            # strip the top-level directory
+            top_lvl = set()
+            has_children = False
+            for path in entries.keys():
+                parts = path.split('/', 1)
+                top_lvl.add(parts[0])
+                has_children = has_children or (len(parts) > 1)
+
+            l = 0
+            if (len(top_lvl) == 1) and has_children:
+                l = len(top_lvl.pop()) + 1
+
+            now = int(time.time())
+            who = '%s <%s> %d +0000' % (author[0], author[1], now)
+            proc.stdin.write('commit %s\nauthor %s\ncommitter %s\ndata %d\n%s\ndeleteall\n' % (ref, who, who, len(message), message))
+
+            for path in entries.keys():
+                (git_mode, m) = entries[path]
+                proc.stdin.write('M %s :%d %s\n' % (git_mode, m, _quote_path(path[l:])))
+
+            proc.stdin.write('\ndone\n')
+        finally:
+            (out, err) = proc.communicate()
+
+        if proc.returncode != 0:
+            raise Exception("FAILED: git fast-import %s in %s - %s" % (ref, self.path, err.strip()))
+
+        return len(entries.keys())
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    repo = GitRepo(tempfile.mkdtemp())
+    repo.init()
+    open(os.path.join(repo.path, 'README'), 'w').write('test\n')
+    print repo.commit('Import test', repo.worktree_files())
+    repo.tag('1.0')
+    print repo.has_tag('1.0'), repo.has_tag('2.0'), repo.tags()
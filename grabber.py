@@ -20,8 +20,27 @@
 
 
 import os
+import fcntl
+import hashlib
+import tracing
+import tempfile
 from urlgrabber.grabber import URLGrabber
 
+try:
+    from django.conf import settings
+    DOWNLOAD_CACHE_DIR = settings.DOWNLOAD_CACHE_DIR
+except:
+    DOWNLOAD_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'difio-download-cache')
+
+try:
+    from django.conf import settings
+    DOWNLOAD_CACHE_SIZE = settings.DOWNLOAD_CACHE_SIZE
+except:
+    DOWNLOAD_CACHE_SIZE = 5 * 1024 * 1024 * 1024 # 5 GB
+
+# checksums supported in URL fragments and as parameters
+CHECKSUM_ALGORITHMS = ['md5', 'sha1', 'sha256']
+
 def download_file(url, dirname):
     """
         Download @url and save to @dirname.
@@ -39,6 +58,7 @@ def download_file(url, dirname):
     if os.path.exists(filename):
         raise Exception("File %s already exists! Not downloading!" % filename)
 
+    tracing.count_http(url.split('/')[2])
     g = URLGrabber(reget=None)
     local_filename = g.urlgrab(url, filename)
     return local_filename
@@ -49,6 +69,257 @@ def remove_file(filename):
     """
     os.remove(filename)
 
+def split_checksum(url, checksum = None):
+    """
+        Separate the checksum from the URL. PyPI style URLs carry it
+        in the fragment, e.g. Django-1.5.tar.gz#md5=xxxx
+
+        @url - string - the URL
+        @checksum - string - optional, algo:hexdigest, takes precedence over the URL
+
+        @return - tuple - (url, checksum), checksum is algo:hexdigest or None
+    """
+    (url, sep, fragment) = url.partition('#')
+
+    if checksum:
+        return (url, checksum)
+
+    for part in fragment.split('&'):
+        (algo, sep, digest) = part.partition('=')
+        if (algo in CHECKSUM_ALGORITHMS) and digest:
+            return (url, '%s:%s' % (algo, digest))
+
+    return (url, None)
+
+def verify_checksum(filename, checksum):
+    """
+        @filename - string - local file
+        @checksum - string - algo:hexdigest
+
+        @return - bool - True if the file matches
+    """
+    (algo, digest) = checksum.split(':', 1)
+    h = hashlib.new(algo)
+
+    f = open(filename, 'rb')
+    try:
+        data = f.read(1024*1024)
+        while data:
+            h.update(data)
+            data = f.read(1024*1024)
+    finally:
+        f.close()
+
+    return h.hexdigest() == digest.lower()
+
+def _lock_entry(filename):
+    """
+        Open and lock @filename.lock. If the entry was evicted
+        while waiting for the lock try again.
+
+        @return - file - the locked file, close it to unlock
+    """
+    dirname = os.path.dirname(filename)
+
+    while True:
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError: # created by another worker
+                pass
+
+        try:
+            lock = open(filename + '.lock', 'a')
+        except IOError: # directory removed by _evict()
+            continue
+
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # still the same lock file, not removed by _evict()
+            if os.fstat(lock.fileno()).st_ino == os.stat(lock.name).st_ino:
+                return lock
+        except OSError:
+            pass
+
+        lock.close()
+
+def _remove_entry(filename):
+    """
+        Remove a cache entry together with its lock file and directories.
+        Entries locked by another worker are not removed.
+
+        @return - bool - True if removed
+    """
+    try:
+        lock = open(filename + '.lock', 'a')
+    except IOError: # already removed
+        return True
+
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError: # in use
+        lock.close()
+        return False
+
+    try:
+        for name in [filename, filename + '.part', filename + '.lock']:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+        # key and key[:2] directories, if empty
+        dirname = os.path.dirname(filename)
+        for d in [dirname, os.path.dirname(dirname)]:
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+    finally:
+        lock.close()
+
+    return True
+
+def _evict(keep):
+    """
+        Remove least recently used files from the download cache
+        until it fits into DOWNLOAD_CACHE_SIZE.
+
+        @keep - string - file which must not be removed
+        @return - int - size of the cache after eviction
+    """
+    entries = []
+    total_size = 0
+
+    for (path, dirs, files) in os.walk(DOWNLOAD_CACHE_DIR):
+        # the size file is at the top
+        if path == DOWNLOAD_CACHE_DIR:
+            continue
+
+        for f in files:
+            # skip locks and downloads in progress
+            if f.endswith('.lock') or f.endswith('.part'):
+                continue
+
+            fname = os.path.join(path, f)
+            try:
+                st = os.stat(fname)
+            except OSError: # removed by another worker
+                continue
+
+            total_size += st.st_size
+            entries.append((st.st_mtime, st.st_size, fname))
+
+    entries.sort()
+    for (mtime, size, fname) in entries:
+        if total_size <= DOWNLOAD_CACHE_SIZE:
+            break
+
+        if fname == keep:
+            continue
+
+        if _remove_entry(fname):
+            total_size -= size
+
+    return total_size
+
+def _account(filename):
+    """
+        Add the size of a new download to the cache size and evict
+        entries if it grows above DOWNLOAD_CACHE_SIZE. The size is kept
+        in a file so the cache is walked only when eviction is needed.
+        Only one worker evicts at a time.
+
+        @filename - string - the new download
+    """
+    fd = os.open(os.path.join(DOWNLOAD_CACHE_DIR, 'size'), os.O_RDWR | os.O_CREAT)
+    f = os.fdopen(fd, 'r+')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        data = f.read().strip()
+        if data.isdigit():
+            total_size = int(data) + os.path.getsize(filename)
+        else: # first download or lost
+            total_size = None
+
+        if (total_size is None) or (total_size > DOWNLOAD_CACHE_SIZE):
+            total_size = _evict(filename)
+
+        f.seek(0)
+        f.truncate()
+        f.write(str(total_size))
+    finally:
+        f.close()
+
+def _cache_entry(url, checksum = None):
+    """
+        @return - tuple - (url, checksum, filename in the cache)
+    """
+    # pycurl is picky about Unicode URLs, see rhbz #515797
+    url = url.encode('ascii', 'ignore')
+    (url, checksum) = split_checksum(url, checksum)
+
+    key = hashlib.sha1('%s#%s' % (url, checksum)).hexdigest()
+    basename = os.path.basename(url.split('?')[0]) or 'download'
+
+    return (url, checksum, os.path.join(DOWNLOAD_CACHE_DIR, key[:2], key, basename))
+
+def cached_size(url, checksum = None):
+    """
+        @url - string - as passed to download_cached()
+        @checksum - string - as passed to download_cached()
+
+        @return - int - size in bytes of the cached download or None if not cached
+    """
+    (url, checksum, filename) = _cache_entry(url, checksum)
+
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return None
+
+def download_cached(url, checksum = None):
+    """
+        Download @url into the shared download cache unless it's already there.
+
+        Entries are keyed by URL and checksum. Partial downloads are resumed,
+        the result is verified against the checksum if one is known and the
+        least recently used entries are removed when the cache grows
+        above DOWNLOAD_CACHE_SIZE. Workers on the same host wait for each
+        other instead of downloading the same file twice.
+
+        @url - string - what to download
+        @checksum - string - optional, algo:hexdigest as published by the registry
+
+        @return - filename in the cache. Don't modify or remove it!
+    """
+    (url, checksum, filename) = _cache_entry(url, checksum)
+
+    lock = _lock_entry(filename)
+    try:
+        if os.path.exists(filename):
+            # mark as recently used
+            os.utime(filename, None)
+            return filename
+
+        # reget='simple' resumes a previous partial download
+        tracing.count_http(url.split('/')[2])
+        g = URLGrabber(reget='simple')
+        part_name = g.urlgrab(url, filename + '.part')
+
+        if checksum and not verify_checksum(part_name, checksum):
+            os.remove(part_name)
+            raise Exception("Checksum mismatch for %s" % url)
+
+        os.rename(part_name, filename)
+    finally:
+        lock.close()
+
+    _account(filename)
+
+    return filename
+
 
 if __name__ == "__main__":
     import tar
@@ -59,7 +330,9 @@ if __name__ == "__main__":
     f = download_file('https://rubygems.org/gems/columnize-0.3.5.gem', dirname)
     print "Downloaded ", f
 
+    f = download_cached('https://rubygems.org/gems/columnize-0.3.5.gem')
+    print "Cached ", f
+
 #    tar.extract_gem(f, "%s/columnize" % dirname)
 #    remove_file(f)
 #    print "Removed ", f
-
@@ -0,0 +1,124 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Keep-alive connections and per-host concurrency limits for
+    utils.fetch_page().
+
+    Connections are shared between the threads of a process. A connection
+    is returned to the pool only after its response has been read
+    completely. At most HOST_CONCURRENCY requests are sent to the same
+    host at the same time, see batch.py for running callbacks concurrently.
+"""
+
+import socket
+import httplib
+import metrics
+import threading
+
+try:
+    from django.conf import settings
+    HOST_CONCURRENCY = settings.DIFIO_HOST_CONCURRENCY
+except:
+    HOST_CONCURRENCY = {}
+
+# used for hosts not listed above
+DEFAULT_HOST_CONCURRENCY = 4
+
+# idle connections kept for every host
+MAX_IDLE = 4
+
+_lock = threading.Lock()
+_idle = {}        # (https, host_port) -> list of connections
+_semaphores = {}  # host_port -> BoundedSemaphore
+
+def host_slot(host_port):
+    """
+        @host_port - string - host[:port]
+        @return - semaphore - use as a context manager around the request
+    """
+    with _lock:
+        if not _semaphores.has_key(host_port):
+            limit = HOST_CONCURRENCY.get(host_port, DEFAULT_HOST_CONCURRENCY)
+            _semaphores[host_port] = threading.BoundedSemaphore(limit)
+        return _semaphores[host_port]
+
+def _new(https, host_port):
+    if https:
+        conn = httplib.HTTPSConnection(host_port)
+    else:
+        conn = httplib.HTTPConnection(host_port)
+
+    conn.pool_key = (https, host_port)
+    return conn
+
+def _get(https, host_port):
+    """
+        @return - tuple - (connection, True if reused)
+    """
+    with _lock:
+        idle = _idle.get((https, host_port))
+        if idle:
+            return (idle.pop(), True)
+
+    return (_new(https, host_port), False)
+
+def release(conn, response):
+    """
+        Return @conn to the pool. Call after @response has been read.
+    """
+    if response.will_close:
+        conn.close()
+        return
+
+    with _lock:
+        idle = _idle.setdefault(conn.pool_key, [])
+        if len(idle) < MAX_IDLE:
+            idle.append(conn)
+            return
+
+    conn.close()
+
+def request(https, host_port, method, path, body=None, headers={}):
+    """
+        Send a request over a pooled connection. If a reused connection
+        has been closed by the server in the meantime the request is
+        sent again over a new one.
+
+        @return - tuple - (connection, response). Read the response and
+                  call release() or close the connection when done.
+    """
+    (conn, reused) = _get(https, host_port)
+
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        return (conn, conn.getresponse())
+    except (httplib.HTTPException, socket.error):
+        conn.close()
+        if not reused:
+            raise
+
+    metrics.incr('http.%s.retries' % metrics.clean_name(host_port))
+    conn = _new(https, host_port)
+
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        return (conn, conn.getresponse())
+    except:
+        conn.close()
+        raise
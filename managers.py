@@ -10,6 +10,24 @@ from django.db.models.query import QuerySet
 from django.db.models.manager import Manager
 from django.db.models.deletion import Collector
 
+# how many rows to load with a single query
+BULK_CHUNK_SIZE = 1000
+
+def chunks(iterable, size=BULK_CHUNK_SIZE):
+    """
+        Split @iterable into lists of at most @size items.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
 class QuerySetDoubleIteration(Exception):
     "A QuerySet was iterated over twice, you probably want to list() it."
     pass
@@ -21,6 +39,12 @@ class SkinnyManager(Manager):
     def get_query_set(self):
         return SkinnyQuerySet(self.model, using=self._db)
 
+    def values_in_bulk(self, pks, *fields):
+        return self.get_query_set().values_in_bulk(pks, *fields)
+
+    def chunked(self, size=BULK_CHUNK_SIZE, only=None, values_list=None):
+        return self.get_query_set().chunked(size, only, values_list)
+
 
 class SkinnyQuerySet(QuerySet):
     def __len__(self):
@@ -40,6 +64,66 @@ class SkinnyQuerySet(QuerySet):
 
         return self.iterator()
 
+    def values_in_bulk(self, pks, *fields):
+        """
+            Load related rows with one query per BULK_CHUNK_SIZE ids
+            instead of one query per row.
+
+            @pks - iterable - primary keys, None values are ignored
+            @fields - field names to load. For foreign keys the id is returned.
+
+            @return - dict - pk -> {field : value}
+        """
+        result = {}
+        pks = sorted(set(pk for pk in pks if pk is not None))
+
+        # sorted chunks select continuous id ranges
+        for chunk in chunks(pks):
+            for row in self.filter(pk__in=chunk).values('pk', *fields):
+                result[row.pop('pk')] = row
+
+        return result
+
+    def chunked(self, size=BULK_CHUNK_SIZE, only=None, values_list=None):
+        """
+            Iterate over the rows in primary key order, @size rows per query.
+            Every query continues after the last pk seen (keyset pagination)
+            so no cursor is kept open between the chunks and memory usage
+            doesn't depend on the table size.
+
+            @size - int - number of rows per query
+            @only - list - optional, fields to load, see QuerySet.only()
+            @values_list - list - optional, yield tuples of
+                           (pk, field1, field2, ...) instead of objects
+
+            @return - generator - yields lists of at most @size items
+        """
+        query = self.order_by('pk')
+        if values_list is not None:
+            query = query.values_list('pk', *values_list)
+        elif only:
+            query = query.only(*only)
+
+        last_pk = None
+        while True:
+            if last_pk is None:
+                chunk = list(query[:size])
+            else:
+                chunk = list(query.filter(pk__gt=last_pk)[:size])
+
+            if not chunk:
+                return
+
+            yield chunk
+
+            if len(chunk) < size:
+                return
+
+            if values_list is not None:
+                last_pk = chunk[-1][0]
+            else:
+                last_pk = chunk[-1].pk
+
     # override here b/c we can't patch Django in our PaaS environments
     # NB: doesn't execute the inherited method, copy full method definition
     # NB: Needs to be updated with every Django upgrade
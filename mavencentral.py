@@ -19,10 +19,17 @@
 ################################################################################
 
 import json
+import urllib
 from utils import fetch_page
 from datetime import datetime
 from xml.dom.minidom import parseString
 
+# repository layout, see get_metadata() and get_download_url()
+REPOSITORY_URL = 'http://repo1.maven.org/maven2'
+
+# GAVs per search.maven.org query, see search_release_dates()
+SOLR_BATCH_SIZE = 20
+
 def _groupid_artifactid(name):
     """
         @name - string - package name of the form groupid:artifactid, e.g. junit:junit
@@ -30,6 +37,101 @@ def _groupid_artifactid(name):
     """
     return name.split(':')
 
+def _text(dom, tag):
+    """
+        @return - string - text of the first @tag element or None
+    """
+    for node in dom.getElementsByTagName(tag):
+        if node.firstChild:
+            return node.firstChild.wholeText.strip()
+    return None
+
+def get_metadata(package, last_modified=None):
+    """
+        Read maven-metadata.xml for the list of versions.
+
+        @package - string - groupid:artifactid
+        @last_modified - datetime - if specified will try a conditional GET
+
+        @return - dict - versions, oldest first, release, latest and
+                  last_updated (datetime) or None if not modified
+    """
+    [groupid, artifactid] = _groupid_artifactid(package)
+
+    xml = fetch_page('%s/%s/%s/maven-metadata.xml' % (REPOSITORY_URL, groupid.replace('.', '/'), artifactid), last_modified=last_modified)
+
+    if xml is None: # NB: empty string is not None but will fail the check
+        return None
+
+    dom = parseString(xml)
+
+    last_updated = _text(dom, 'lastUpdated')
+    if last_updated:
+        last_updated = datetime.strptime(last_updated[:14], '%Y%m%d%H%M%S')
+
+    versions = []
+    for node in dom.getElementsByTagName('version'):
+        # <version> is also a direct child of <metadata>
+        if node.parentNode.tagName == 'versions' and node.firstChild:
+            versions.append(node.firstChild.wholeText.strip())
+
+    return {
+        'versions' : versions,
+        'release' : _text(dom, 'release'),
+        'latest' : _text(dom, 'latest'),
+        'last_updated' : last_updated,
+    }
+
+def search_release_dates(gavs):
+    """
+        Query search.maven.org for the release dates of many versions,
+        SOLR_BATCH_SIZE versions per request.
+
+        @gavs - list - of (groupid:artifactid, version)
+
+        @return - dict - (groupid:artifactid, version) -> datetime.
+                  Versions not found are missing.
+    """
+    result = {}
+
+    for i in range(0, len(gavs), SOLR_BATCH_SIZE):
+        chunk = gavs[i:i+SOLR_BATCH_SIZE]
+
+        terms = []
+        for (package, version) in chunk:
+            [groupid, artifactid] = _groupid_artifactid(package)
+            terms.append('(g:"%s" AND a:"%s" AND v:"%s")' % (groupid, artifactid, version))
+
+        data = fetch_page('http://search.maven.org/solrsearch/select?q=%s&core=gav&rows=%d&wt=json' %
+                        (urllib.quote(' OR '.join(terms)), len(chunk))
+                )
+        data = json.loads(data)
+
+        for doc in data['response']['docs']:
+            result[("%s:%s" % (doc['g'], doc['a']), doc['v'])] = datetime.fromtimestamp(doc['timestamp']/1000)
+
+    return result
+
+def get_indexed_release_date(package, version):
+    """
+        Look up the release date in the local index, see models.MavenVersion.
+
+        @return - datetime - or None if not indexed or not running inside Django
+    """
+    try:
+        from models import MavenVersion
+    except:
+        return None
+
+    try:
+        return MavenVersion.objects.filter(
+                        package=package,
+                        version=version,
+                        released_on__isnull=False
+                    ).values_list('released_on', flat=True)[0]
+    except IndexError:
+        return None
+
 
 def get_release_date(package, version, data = None):
     """
@@ -38,6 +140,10 @@ def get_release_date(package, version, data = None):
     [groupid, artifactid] = _groupid_artifactid(package)
 
     if not data:
+        released_on = get_indexed_release_date(package, version)
+        if released_on:
+            return released_on
+
         data = fetch_page('http://search.maven.org/solrsearch/select?q=g:"%s"+AND+a:"%s"+AND+v:"%s"&wt=json' %
                         (groupid, artifactid, version)
                 )
@@ -55,7 +161,8 @@ def get_download_url(package, version, data = None):
     """
     [groupid, artifactid] = _groupid_artifactid(package)
 
-    return "http://search.maven.org/remotecontent?filepath=%s/%s/%s/%s-%s-sources.jar" % (groupid.replace('.', '/'), artifactid, version, artifactid, version)
+    # NB: the repository answers HEAD requests, search.maven.org doesn't
+    return "%s/%s/%s/%s/%s-%s-sources.jar" % (REPOSITORY_URL, groupid.replace('.', '/'), artifactid, version, artifactid, version)
 
 
 def get_latest(package, last_checked=None):
@@ -64,24 +171,23 @@ def get_latest(package, last_checked=None):
 
         @return - version, released_on
     """
-    [groupid, artifactid] = _groupid_artifactid(package)
-
-    data = fetch_page('http://search.maven.org/solrsearch/select?q=g:"%s"+AND+a:"%s"&wt=json&core=gav' % (groupid, artifactid), last_modified=last_checked)
+    metadata = get_metadata(package, last_checked)
 
-    if data is None: # NB: empty string is not None but will fail the check
+    if metadata is None:
         return 304, 304
 
-    data = json.loads(data)
+    latest_ver = metadata['release'] or metadata['latest']
+    if (not latest_ver) and metadata['versions']:
+        latest_ver = metadata['versions'][-1]
 
-    latest_ver = None
-    latest_timestamp = 0
+    if not latest_ver:
+        return None, None
 
-    for release in data['response']['docs']:
-        if release['timestamp'] > latest_timestamp:
-            latest_timestamp = release['timestamp']
-            latest_ver = release['v']
+    # NB: don't use lastUpdated, it changes when the metadata is regenerated
+    released_on = get_indexed_release_date(package, latest_ver)
+    if released_on is None:
+        released_on = search_release_dates([(package, latest_ver)]).get((package, latest_ver))
 
-    released_on = datetime.fromtimestamp(latest_timestamp/1000)
     return latest_ver, released_on
 
 def get_url(package, version=None):
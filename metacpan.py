@@ -18,28 +18,35 @@
 #
 ################################################################################
 
+import os
 import cpan
 import json
+import time
+import shutil
 import httplib
+import hashlib
 import logging
+import tempfile
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+try:
+    from django.conf import settings
+    DIFF_CACHE_DIR = settings.DIFIO_METACPAN_DIFF_CACHE_DIR
+except:
+    DIFF_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'difio-metacpan-diff-cache')
 
-def diff_tags(tag1, tag2, file = None):
-    """
-        Produce a diff taken from metacpan.org
-        Used for packages which have not defined their
-        upstream sources.
+# remove cached diffs which were not used for that many seconds
+DIFF_CACHE_TTL = 7 * 24 * 3600
 
-        @tag1, @tag2 - string - OWNER/distribution-version, e.g.
-            SMUELLER/Parse-CPAN-Meta-1.40
-            DAGOLDEN/Parse-CPAN-Meta-1.4402
+# bytes read from the network at once
+DIFF_CHUNK_SIZE = 64 * 1024
 
-        @file - string - if specified return diff only for this file
+def _fetch_diff(tag1, tag2, filename):
+    """
+        Save the diff JSON from metacpan.org into @filename.
     """
-
     conn = httplib.HTTPConnection('api.metacpan.org')
     conn.request('GET', '/v0/diff/release/%s/%s' % (tag1, tag2))
     response = conn.getresponse()
@@ -47,23 +54,137 @@ def diff_tags(tag1, tag2, file = None):
     if (response.status != 200):
         raise Exception("MetaCPAN - diff_versions(%s, %s) - returned %d" % (tag1, tag2, response.status))
 
-    json_data = response.read().decode('UTF8', 'replace')
-    data = json.loads(json_data)
+    f = open(filename, 'wb')
+    try:
+        data = response.read(DIFF_CHUNK_SIZE)
+        while data:
+            f.write(data)
+            data = response.read(DIFF_CHUNK_SIZE)
+    finally:
+        f.close()
+
+def _evict():
+    """
+        Remove cached diffs not used for DIFF_CACHE_TTL seconds.
+    """
+    oldest = time.time() - DIFF_CACHE_TTL
+    for name in os.listdir(DIFF_CACHE_DIR):
+        dirname = os.path.join(DIFF_CACHE_DIR, name)
+        try:
+            if os.path.getmtime(dirname) < oldest:
+                shutil.rmtree(dirname)
+        except OSError: # removed by another process
+            pass
+
+def _cached_diff(tag1, tag2):
+    """
+        Fetch the diff between @tag1 and @tag2 unless it's already cached
+        and split it into one file per changed file. The diff_metacpan
+        script is executed several times for the same advisory
+        so only the first execution talks to metacpan.org.
+
+        @return - string - directory with index.json - a list of
+                  (source, target, file name) - and the diff files
+    """
+    key = hashlib.sha1('%s..%s' % (tag1, tag2)).hexdigest()
+    dirname = os.path.join(DIFF_CACHE_DIR, key)
+
+    if os.path.exists(os.path.join(dirname, 'index.json')):
+        # mark as recently used
+        os.utime(dirname, None)
+        return dirname
+
+    if not os.path.exists(DIFF_CACHE_DIR):
+        try:
+            os.makedirs(DIFF_CACHE_DIR)
+        except OSError: # created by another process
+            pass
+    _evict()
+
+    tmpdir = tempfile.mkdtemp(dir=DIFF_CACHE_DIR)
+    try:
+        json_name = os.path.join(tmpdir, 'diff.json')
+        _fetch_diff(tag1, tag2, json_name)
+
+        f = open(json_name, 'rb')
+        try:
+            data = json.loads(f.read().decode('UTF8', 'replace'))
+        finally:
+            f.close()
+        os.remove(json_name)
+
+        index = []
+        for d in data['statistics']:
+            name = '%d.diff' % len(index)
+            f = open(os.path.join(tmpdir, name), 'wb')
+            try:
+                f.write(d['diff'].encode('UTF8'))
+            finally:
+                f.close()
+            index.append((d['source'], d['target'], name))
+
+        f = open(os.path.join(tmpdir, 'index.json'), 'w')
+        try:
+            json.dump(index, f)
+        finally:
+            f.close()
+
+        try:
+            os.rename(tmpdir, dirname)
+        except OSError: # cached by another process in the meantime
+            pass
+    finally:
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+
+    return dirname
+
+def iter_diffs(tag1, tag2, file = None):
+    """
+        Same as diff_tags() but yields the diff one file at a time,
+        UTF-8 encoded, instead of building the whole string in memory.
+    """
+    dirname = _cached_diff(tag1, tag2)
+
+    f = open(os.path.join(dirname, 'index.json'), 'r')
+    try:
+        index = json.load(f)
+    finally:
+        f.close()
+
+    for (source, target, name) in index:
+        if file and not (source.endswith(file) or target.endswith(file)):
+            continue
+
+        f = open(os.path.join(dirname, name), 'rb')
+        try:
+            yield f.read()
+        finally:
+            f.close()
 
-    result = u""
-    for d in data['statistics']:
         if file:
-            if d['source'].endswith(file) or d['target'].endswith(file):
-                result += d['diff']
-                break
-        else:
-            result += d['diff']
+            break
 
-    result = result.encode('UTF8')
-    return result
+def diff_tags(tag1, tag2, file = None):
+    """
+        Produce a diff taken from metacpan.org
+        Used for packages which have not defined their
+        upstream sources.
+
+        @tag1, @tag2 - string - OWNER/distribution-version, e.g.
+            SMUELLER/Parse-CPAN-Meta-1.40
+            DAGOLDEN/Parse-CPAN-Meta-1.4402
+
+        @file - string - if specified return diff only for this file
+    """
+    return ''.join(iter_diffs(tag1, tag2, file))
 
 
 def get_tags(package, version):
+    release = cpan.get_indexed_release(package, version)
+    if release:
+        return "%s/%s-%s" % (release['author'], release['distribution'], version)
+
     author = cpan.get_author_from_html(package, version)
 
     # HTML doesn't contain info for the latest package.
@@ -84,8 +205,12 @@ def get_files(url):
 
     # get the required parts first:
     package = url.split('/')[4]
-    version, released_on = cpan.get_latest(package)
-    tag = get_tags(package, version) # AUTHOR/Dist-VERSION
+    release = cpan.get_indexed_release(package)
+    if release:
+        tag = "%s/%s-%s" % (release['author'], release['distribution'], release['version'])
+    else:
+        version, released_on = cpan.get_latest(package)
+        tag = get_tags(package, version) # AUTHOR/Dist-VERSION
 
 
     conn = httplib.HTTPConnection('api.metacpan.org')
@@ -0,0 +1,414 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Counters and timings sent to pluggable sinks.
+
+        metrics.incr('http.pypi_python_org.requests')
+        metrics.timing('http.pypi_python_org.time', 250)
+
+    Sinks are configured with DIFIO_METRICS_SINKS, a list of names
+    from SINKS or dotted paths to classes with the same methods as NullSink.
+    Errors in sinks are logged and ignored.
+
+    CacheSink aggregates the HTTP metrics recorded by utils.fetch_page()
+    per period in the cache. slowest() reads them back for the report
+    of the slowest hosts and endpoints. It costs a few cache round trips
+    per request so it is not enabled by default.
+"""
+
+import re
+import sys
+import time
+import socket
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    from django.conf import settings
+    STATSD_HOST = settings.DIFIO_STATSD_HOST
+except:
+    STATSD_HOST = None
+
+try:
+    from django.conf import settings
+    STATSD_PORT = settings.DIFIO_STATSD_PORT
+except:
+    STATSD_PORT = 8125
+
+try:
+    from django.conf import settings
+    STATSD_PREFIX = settings.DIFIO_STATSD_PREFIX
+except:
+    STATSD_PREFIX = 'difio'
+
+try:
+    from django.conf import settings
+    METRICS_SINKS = settings.DIFIO_METRICS_SINKS
+except:
+    METRICS_SINKS = ['null']
+
+try:
+    from django.conf import settings
+    METRICS_PERIOD = settings.DIFIO_METRICS_PERIOD
+except:
+    METRICS_PERIOD = 3600 * 24
+
+# host -> list of (regexp, endpoint name) matched against the URL path.
+# The names are fixed so package names don't end up in metric names.
+# Requests to other hosts or paths are recorded as 'other'.
+try:
+    from django.conf import settings
+    ENDPOINTS = settings.DIFIO_METRICS_ENDPOINTS
+except:
+    ENDPOINTS = {
+        'pypi.python.org' : [
+            (r'^/pypi/[^/]+/[^/]+/json', 'version_json'),
+            (r'^/pypi/[^/]+/json', 'json'),
+            (r'^/pypi', 'pypi'),
+            (r'^/simple/', 'simple'),
+        ],
+        'registry.npmjs.org' : [
+            (r'^/-/', 'search'),
+            (r'^/[^/]+/[^/]+', 'version'),
+            (r'^/[^/]+', 'package'),
+        ],
+        'rubygems.org' : [
+            (r'^/api/v1/versions/', 'versions'),
+            (r'^/api/v1/gems/', 'gems'),
+            (r'^/api/', 'api'),
+        ],
+        'packagist.org' : [
+            (r'^/packages/', 'packages'),
+            (r'^/feeds/', 'feeds'),
+        ],
+        'api.metacpan.org' : [
+            (r'^/v0/release/_search', 'search'),
+            (r'^/v0/release/', 'release'),
+            (r'^/v0/', 'api'),
+        ],
+        'metacpan.org' : [
+            (r'^/release/', 'release'),
+            (r'^/feed/', 'feed'),
+        ],
+        'search.maven.org' : [
+            (r'^/solrsearch/', 'solrsearch'),
+            (r'^/remotecontent', 'remotecontent'),
+        ],
+        'repo1.maven.org' : [
+            (r'/maven-metadata\.xml$', 'metadata'),
+            (r'^/maven2/', 'maven2'),
+        ],
+        'pear.php.net' : [
+            (r'^/rest/', 'rest'),
+            (r'^/feeds/', 'feeds'),
+        ],
+        'pear2.php.net' : [
+            (r'^/rest/', 'rest'),
+        ],
+        'api.github.com' : [
+            (r'^/repos/[^/]+/[^/]+/tags', 'tags'),
+            (r'^/repos/', 'repos'),
+        ],
+    }
+
+# upper bounds in ms of the latency histograms kept by CacheSink
+HISTOGRAM_BUCKETS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+def clean_name(name):
+    """
+        Dots separate the parts of a metric name. Replace them in
+        host names and paths together with characters StatsD doesn't like.
+    """
+    for c in ['.', ':', '|', '@', ' ', '/']:
+        name = name.replace(c, '_')
+    return name
+
+
+def endpoint_name(host, path):
+    """
+        @host - string - host[:port]
+        @path - string - URL path
+        @return - string - endpoint name from ENDPOINTS or 'other'
+    """
+    path = path.split('?')[0]
+    for (regexp, name) in ENDPOINTS.get(host.split(':')[0], []):
+        if re.search(regexp, path):
+            return name
+
+    return 'other'
+
+
+class NullSink(object):
+    """
+        Discards everything. Base class for the other sinks.
+    """
+    def incr(self, name, value=1):
+        pass
+
+    def timing(self, name, ms):
+        pass
+
+
+class LogSink(NullSink):
+    def incr(self, name, value=1):
+        logger.info("metric %s:%d|c" % (name, value))
+
+    def timing(self, name, ms):
+        logger.info("metric %s:%d|ms" % (name, ms))
+
+
+class StatsdSink(NullSink):
+    """
+        Sends every metric as a separate UDP packet.
+        Does nothing if DIFIO_STATSD_HOST is not configured.
+    """
+    def __init__(self):
+        self.sock = None
+        if STATSD_HOST:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, line):
+        if self.sock:
+            self.sock.sendto('%s.%s' % (STATSD_PREFIX, line), (STATSD_HOST, STATSD_PORT))
+
+    def incr(self, name, value=1):
+        self.send('%s:%d|c' % (name, value))
+
+    def timing(self, name, ms):
+        self.send('%s:%d|ms' % (name, ms))
+
+
+def _period(now=None):
+    if now is None:
+        now = time.time()
+    return int(now // METRICS_PERIOD)
+
+def _cache_key(period, name):
+    return 'metrics.%d.%s' % (period, name)
+
+class CacheSink(NullSink):
+    """
+        Keeps the sum of the HTTP metrics for the current period in
+        the cache. Timings are stored as count, sum and histogram.
+        Other metrics are ignored.
+    """
+    prefixes = ['http.', 'http_endpoint.']
+
+    def __init__(self):
+        from django.core.cache import cache
+        self.cache = cache
+
+        # names registered in the current period by this process
+        self.registered = set()
+        self.period = None
+
+    def _accept(self, name):
+        for p in self.prefixes:
+            if name.startswith(p):
+                return True
+        return False
+
+    def _add(self, period, name, value):
+        key = _cache_key(period, name)
+        timeout = METRICS_PERIOD * 3
+        try:
+            self.cache.incr(key, value)
+        except ValueError: # missing or expired
+            if not self.cache.add(key, value, timeout):
+                self.cache.incr(key, value)
+
+    def _register(self, period, name):
+        """
+            Remember timing @name so that slowest() can find it.
+        """
+        if period != self.period:
+            self.period = period
+            self.registered = set()
+
+        if name in self.registered:
+            return
+
+        # NB: not atomic. A name lost here will be added on the next call
+        key = _cache_key(period, 'names')
+        names = self.cache.get(key) or set()
+        if name not in names:
+            names.add(name)
+            self.cache.set(key, names, METRICS_PERIOD * 3)
+        self.registered.add(name)
+
+    def incr(self, name, value=1):
+        if not self._accept(name):
+            return
+
+        self._add(_period(), name, value)
+
+    def timing(self, name, ms):
+        if not self._accept(name):
+            return
+
+        period = _period()
+        self._register(period, name)
+        self._add(period, name + '.count', 1)
+        self._add(period, name + '.sum', int(ms))
+
+        for b in HISTOGRAM_BUCKETS:
+            if ms <= b:
+                self._add(period, '%s.le_%d' % (name, b), 1)
+                break
+        else:
+            self._add(period, name + '.le_inf', 1)
+
+
+SINKS = {
+    'null' : NullSink,
+    'log' : LogSink,
+    'statsd' : StatsdSink,
+    'cache' : CacheSink,
+}
+
+_sinks = None
+
+def get_sinks():
+    """
+        @return - list - sink objects configured in DIFIO_METRICS_SINKS
+    """
+    global _sinks
+
+    if _sinks is None:
+        sinks = []
+        for name in METRICS_SINKS:
+            try:
+                if SINKS.has_key(name):
+                    sinks.append(SINKS[name]())
+                else:
+                    (module, cls) = name.rsplit('.', 1)
+                    sinks.append(getattr(__import__(module, fromlist=[cls]), cls)())
+            except:
+                logger.error("Metrics sink %s failed: %s" % (name, sys.exc_info()[1]))
+        _sinks = sinks
+
+    return _sinks
+
+def incr(name, value=1):
+    for sink in get_sinks():
+        try:
+            sink.incr(name, value)
+        except:
+            logger.error("Metric %s failed: %s" % (name, sys.exc_info()[1]))
+
+def timing(name, ms):
+    for sink in get_sinks():
+        try:
+            sink.timing(name, ms)
+        except:
+            logger.error("Metric %s failed: %s" % (name, sys.exc_info()[1]))
+
+def http_request(host, path, status, seconds, size=0, conditional=False):
+    """
+        Record a single HTTP request. See utils.fetch_page().
+
+        @host - string - host[:port]
+        @path - string - URL path, see endpoint_name()
+        @status - int - HTTP status or None if the request failed
+        @seconds - float - time until the response was read
+        @size - int - response body size
+        @conditional - bool - if If-Modified-Since was sent
+    """
+    h = 'http.%s' % clean_name(host)
+    ms = int(seconds * 1000)
+
+    incr(h + '.requests')
+    timing(h + '.time', ms)
+
+    if status is None:
+        incr(h + '.errors')
+    else:
+        incr('%s.status.%d' % (h, status))
+
+    if status in [301, 302]:
+        incr(h + '.redirects')
+
+    if conditional:
+        incr(h + '.conditional')
+        if status == 304:
+            incr(h + '.not_modified')
+
+    if size:
+        incr(h + '.bytes', size)
+
+    timing('http_endpoint.%s.%s.time' % (clean_name(host), endpoint_name(host, path)), ms)
+
+def _percentile(cache, name, period, count, percent):
+    """
+        @return - int - upper bound in ms or None for the last bucket
+    """
+    needed = count * percent / 100.0
+    seen = 0
+    for b in HISTOGRAM_BUCKETS:
+        seen += cache.get(_cache_key(period, '%s.le_%d' % (name, b))) or 0
+        if seen >= needed:
+            return b
+    return None
+
+def slowest(prefix='http.', limit=10, period=None):
+    """
+        Summary of the timings aggregated by CacheSink.
+
+        @prefix - string - 'http.' for hosts, 'http_endpoint.' for endpoints
+        @limit - int - how many to return
+        @period - int - defaults to the previous, complete, period
+
+        @return - list - of dicts sorted by total time, slowest first
+    """
+    from django.core.cache import cache
+
+    if period is None:
+        period = _period() - 1
+
+    names = cache.get(_cache_key(period, 'names')) or set()
+
+    result = []
+    for name in names:
+        if not (name.startswith(prefix) and name.endswith('.time')):
+            continue
+
+        count = cache.get(_cache_key(period, name + '.count')) or 0
+        if not count:
+            continue
+
+        total = cache.get(_cache_key(period, name + '.sum')) or 0
+        subject = name[len(prefix):-len('.time')]
+
+        item = {
+            'name' : subject,
+            'requests' : count,
+            'total' : total / 1000.0,
+            'average' : total / count,
+            'p90' : _percentile(cache, name, period, count, 90),
+        }
+
+        base = prefix + subject
+        for counter in ['errors', 'redirects', 'conditional', 'not_modified', 'bytes']:
+            item[counter] = cache.get(_cache_key(period, '%s.%s' % (base, counter))) or 0
+
+        result.append(item)
+
+    result.sort(key=lambda x: x['total'], reverse=True)
+    return result[:limit]
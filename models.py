@@ -29,6 +29,7 @@ import mavencentral
 import os
 import sys
 import bugs
+import json
 import utils
 from django.db import models
 from datetime import datetime
@@ -197,6 +198,8 @@ PACKAGE_TYPES = (
 
 
 # Used to get the proper callbacks
+# resolve_version returns the fields of find_date, get_download_url and get_url
+# using a single request, None if not supported by the registry
 PACKAGE_CALLBACKS = {
     PYPI_PYTHON_PKG: {
             'compare_versions' : pypi.compare_versions,
@@ -204,6 +207,7 @@ PACKAGE_CALLBACKS = {
             'get_latest' : pypi.get_latest,
             'find_date' : pypi.get_release_date,
             'get_download_url' : pypi.get_download_url,
+            'resolve_version' : pypi.resolve_version,
             'get_latest_packages_from_rss' : pypi.get_latest_from_rss,
         },
     RUBYGEM_RUBY_PKG: {
@@ -212,6 +216,7 @@ PACKAGE_CALLBACKS = {
             'get_latest' : rubygems.get_latest,
             'find_date' : rubygems.get_release_date,
             'get_download_url' : rubygems.get_download_url,
+            'resolve_version' : rubygems.resolve_version,
 # if RUBYGEMS_API_KEY is defined disable RSS imports
 # Need to manually register the .../hook/rubygems/ path with RubyGems.org
 # See urls.py/views.py and http://guides.rubygems.org/rubygems-org-api/#webhook_methods
@@ -223,6 +228,7 @@ PACKAGE_CALLBACKS = {
             'get_latest' : nodejs.get_latest,
             'find_date' : nodejs.get_release_date,
             'get_download_url' : nodejs.get_download_url,
+            'resolve_version' : nodejs.resolve_version,
             'get_latest_packages_from_rss' : nodejs.get_latest_from_rss,
         },
     JAVA_MAVEN_PKG: {
@@ -231,6 +237,7 @@ PACKAGE_CALLBACKS = {
             'get_latest' : mavencentral.get_latest,
             'find_date' : mavencentral.get_release_date,
             'get_download_url' : mavencentral.get_download_url,
+            'resolve_version' : None,
             'get_latest_packages_from_rss' : mavencentral.get_latest_from_rss,
         },
     PERL_CPAN_PKG: {
@@ -239,6 +246,7 @@ PACKAGE_CALLBACKS = {
             'get_latest' : cpan.get_latest,
             'find_date' : cpan.get_release_date,
             'get_download_url' : cpan.get_download_url,
+            'resolve_version' : cpan.resolve_version,
             'get_latest_packages_from_rss' : cpan.get_latest_from_rss,
         },
     PHP_PEAR_PKG: {
@@ -247,6 +255,7 @@ PACKAGE_CALLBACKS = {
             'get_latest' : pear.get_latest,
             'find_date' : pear.get_release_date,
             'get_download_url' : pear.get_download_url,
+            'resolve_version' : None,
             'get_latest_packages_from_rss' : pear.get_latest_from_rss,
         },
     PHP_PEAR2_PKG: {
@@ -255,6 +264,7 @@ PACKAGE_CALLBACKS = {
             'get_latest' : pear2.get_latest,
             'find_date' : pear2.get_release_date,
             'get_download_url' : pear2.get_download_url,
+            'resolve_version' : None,
             'get_latest_packages_from_rss' : pear2.get_latest_from_rss,
         },
     PHP_PACKAGIST_PKG: {
@@ -263,6 +273,7 @@ PACKAGE_CALLBACKS = {
             'get_latest' : packagist.get_latest,
             'find_date' : packagist.get_release_date,
             'get_download_url' : packagist.get_download_url,
+            'resolve_version' : packagist.resolve_version,
             'get_latest_packages_from_rss' : packagist.get_latest_from_rss,
         },
     GITHUB_TAGGED_PKG: {
@@ -271,6 +282,7 @@ PACKAGE_CALLBACKS = {
             'get_latest' : github.get_latest_from_tag,
             'find_date' : github.get_release_date_from_tag,
             'get_download_url' : github.get_download_url_from_tag,
+            'resolve_version' : None,
             'get_latest_packages_from_rss' : None,
         },
 }
@@ -593,6 +605,8 @@ class PackageVersion(models.Model):
     download_url = models.CharField(blank=True, null=True, max_length=200)
     download_url.help_text = 'URL to package SOURCE, e.g. http://project.org/downloads/project-1.0.tar.gz'
     size = models.IntegerField('Size in bytes', default=None, null=True, blank=True)
+    checksum = models.CharField(blank=True, null=True, max_length=128)
+    checksum.help_text = 'Checksum of the download as published by the registry, e.g. sha256:hexdigest'
 
     # when added to DB. used internally wrt manual PackageVersion additions
     added_on = models.DateTimeField(db_index=True, default=datetime.now)
@@ -612,6 +626,11 @@ class InstalledPackage(models.Model):
     class Meta:
         if INSTALLED_PACKAGE_DB_TABLE:
             db_table = INSTALLED_PACKAGE_DB_TABLE
+        # match the most common lookups, see benchmarks/explain.py
+        index_together = (
+            ('application', 'version'),
+            ('package', 'version'),
+        )
 
     # NB: no joins here
     application = models.IntegerField(null=False, db_index=True, default=0)
@@ -658,6 +677,12 @@ class Advisory(models.Model):
         )
         if ADVISORY_DB_TABLE:
             db_table = ADVISORY_DB_TABLE
+        # match the most common lookups, see benchmarks/explain.py
+        index_together = (
+            ('old', 'status'),
+            ('old', 'new'),
+            ('status', 'has_static_page'),
+        )
 
     old = models.ForeignKey(PackageVersion, unique=False, related_name='Old version')
     new = models.ForeignKey(PackageVersion, unique=False, related_name='New version')
@@ -707,9 +732,24 @@ class Advisory(models.Model):
 
 
 
+# store a full package list every N history records
+APPLICATION_HISTORY_SNAPSHOT_EVERY = 20
+
 class ApplicationHistory(models.Model):
     """
-        Records package history as text.
+        Records package history.
+
+        Records are either a full snapshot of the installed packages
+        or a delta against the previous record, both stored as JSON:
+
+        {'snapshot' : [ "name-version", ... ]}
+        {'added' : [ "name-version", ... ], 'removed' : [ "name-version", ... ]}
+
+        Entries are "name-version" like in the plain text records
+        so several versions of the same name are all kept.
+
+        NB: records created before deltas were introduced hold
+        the package list as plain text.
     """
 
     # override default QuerySet manager
@@ -723,6 +763,68 @@ class ApplicationHistory(models.Model):
     def __unicode__(self):
         return unicode("%s - %s" % (self.application.name, self.when_added))
 
+    def get_data(self):
+        """
+            @return - dict - the decoded record or None for text records
+        """
+        try:
+            data = json.loads(self.packages)
+        except:
+            return None
+
+        if not isinstance(data, dict):
+            return None
+
+        return data
+
+    def is_snapshot(self):
+        data = self.get_data()
+        return (data is not None) and data.has_key('snapshot')
+
+    def apply_to(self, state):
+        """
+            Apply this record on top of the previous package state.
+
+            @state - set - of "name-version", modified in place
+            @return - set - the new state
+        """
+        data = self.get_data()
+
+        if data.has_key('snapshot'):
+            state.clear()
+            state.update(data['snapshot'])
+            return state
+
+        state.difference_update(data['removed'])
+        state.update(data['added'])
+
+        return state
+
+    def packages_as_text(self):
+        """
+            Render the record for display.
+        """
+        data = self.get_data()
+
+        if data is None:
+            return self.packages
+
+        text = ""
+
+        if data.has_key('snapshot'):
+            for n_v in sorted(data['snapshot']):
+                text += "%s\n" % n_v
+            return text
+
+        removed = set(data['removed'])
+        for n_v in sorted(removed | set(data['added'])):
+            if n_v in removed:
+                text += "- %s\n" % n_v
+            else:
+                text += "+ %s\n" % n_v
+
+        return text
+
 class Bug(models.Model):
     """
         Holds bugs description.
@@ -743,6 +845,70 @@ class Bug(models.Model):
         return unicode("%s - %d: %s" % (self.url, self.number, self.title))
 
 
+class CpanRelease(models.Model):
+    """
+        Local index of CPAN releases. Answers author, date and download URL
+        lookups for Perl packages without asking metacpan.org.
+        Updated by tasks.cron_refresh_cpan_index, see cpan.get_indexed_release.
+    """
+
+    # override default QuerySet manager
+    objects = SkinnyManager()
+
+    class Meta:
+        unique_together = (('distribution', 'version'),)
+
+    author = models.CharField(max_length=64)
+    distribution = models.CharField(max_length=128, db_index=True)
+    version = models.CharField(max_length=64)
+    released_on = models.DateTimeField(db_index=True)
+    download_url = models.CharField(max_length=256)
+    maturity = models.CharField(max_length=16) # released or developer
+
+    def __unicode__(self):
+        return unicode("%s/%s-%s" % (self.author, self.distribution, self.version))
+
+class MavenVersion(models.Model):
+    """
+        Local index of versions published to Maven Central. Answers release
+        date lookups for Java packages without querying search.maven.org.
+        Updated by tasks.cron_refresh_maven_index, see mavencentral.py.
+    """
+
+    # override default QuerySet manager
+    objects = SkinnyManager()
+
+    class Meta:
+        unique_together = (('package', 'version'),)
+
+    package = models.CharField(max_length=128, db_index=True) # groupid:artifactid
+    version = models.CharField(max_length=64)
+    released_on = models.DateTimeField(null=True, blank=True) # None if search.maven.org doesn't know
+    added_on = models.DateTimeField(default=datetime.now)
+
+    def __unicode__(self):
+        return unicode("%s:%s" % (self.package, self.version))
+
+class WebHookEvent(models.Model):
+    """
+        Notification received from an upstream web hook, e.g. RubyGems.org.
+        Saved by the views as is and imported in batches by
+        tasks.cron_process_webhook_events, which deletes it afterwards.
+        Events which can't be parsed are kept with the error message
+        and processed again once the error is cleared.
+    """
+
+    # override default QuerySet manager
+    objects = SkinnyManager()
+
+    pkg_type = models.IntegerField(choices=PACKAGE_TYPES)
+    payload = models.TextField() # as received
+    received_on = models.DateTimeField(default=datetime.now)
+    error = models.TextField(blank=True, default='')
+
+    def __unicode__(self):
+        return unicode("%s - %s" % (self.get_pkg_type_display(), self.received_on))
+
 
 class AbstractMockProfile(models.Model):
     """
@@ -86,7 +86,7 @@ def get_latest(package, last_checked=None):
     return latest_ver, released_on
 
 
-def get_url(package, version=None):
+def get_url(package, version=None, data = None):
     """
         Return homepage, repo, bugtracker URLs for a package
     """
@@ -97,7 +97,8 @@ def get_url(package, version=None):
         }
 
     try:
-        data = get_pkg_descr(package, version)
+        if not data:
+            data = get_pkg_descr(package, version)
 
         version = version or data['dist-tags']['latest']
         descr = data['versions'][version]
@@ -129,6 +130,31 @@ def get_url(package, version=None):
 
     return urls
 
+def resolve_version(package, version):
+    """
+        Return released_on, download_url, size, checksum and
+        homepage, repo, bugtracker URLs for this version
+        using a single request.
+
+        NB: the registry doesn't publish the tarball size.
+    """
+    data = get_pkg_descr(package)
+
+    result = {
+        'released_on' : get_release_date(package, version, data),
+        'download_url' : get_download_url(package, version, data),
+        'size' : None,
+        'checksum' : None,
+        'urls' : get_url(package, version, data),
+    }
+
+    try:
+        result['checksum'] = 'sha1:%s' % data['versions'][version]['dist']['shasum']
+    except KeyError:
+        pass
+
+    return result
+
 class Semver:
     """
         Represent a npm version. For version descriptions see :
@@ -113,7 +113,7 @@ def get_latest(package, last_checked=None, data=None):
 
     return latest_ver, release_date
 
-def get_url(package, version=None):
+def get_url(package, version=None, data = None):
     """
         Return homepage, repo, bugtracker URLs for a package
     """
@@ -123,8 +123,9 @@ def get_url(package, version=None):
             'bugtracker' : '',
         }
 
-    data = fetch_page("https://packagist.org/packages/%s.json" % package)
-    data = json.loads(data)
+    if not data:
+        data = fetch_page("https://packagist.org/packages/%s.json" % package)
+        data = json.loads(data)
 
     if (not data):
         logger.error("Can't find URL for %s-%s" % (package, version))
@@ -157,6 +158,32 @@ def get_url(package, version=None):
 
     return urls
 
+def resolve_version(package, version):
+    """
+        Return released_on, download_url, size, checksum and
+        homepage, repo, bugtracker URLs for this version
+        using a single request.
+    """
+    data = fetch_page("https://packagist.org/packages/%s.json" % package)
+    data = json.loads(data)
+
+    result = {
+        'released_on' : get_release_date(package, version, data),
+        'download_url' : get_download_url(package, version, data),
+        'size' : None,
+        'checksum' : None,
+        'urls' : get_url(package, version, data),
+    }
+
+    # NB: often empty for archives generated from GitHub
+    try:
+        if data['package']['versions'][version]['dist']['shasum']:
+            result['checksum'] = 'sha1:%s' % data['package']['versions'][version]['dist']['shasum']
+    except (KeyError, TypeError):
+        pass
+
+    return result
+
 
 def get_latest_from_rss():
     """
@@ -149,7 +149,7 @@ def get_latest(package, last_checked=None):
 
     return latest_ver, release_date
 
-def get_url(package, version=None):
+def get_url(package, version=None, data = None):
     """
         Return homepage, repo, bugtracker URLs for a package
     """
@@ -169,11 +169,13 @@ def get_url(package, version=None):
 
     pkg_name = _other_name(package)
 
-    if not version:
-        version, released_on = get_latest(pkg_name)
+    release_data = data
+    if not release_data:
+        if not version:
+            version, released_on = get_latest(pkg_name)
 
-    release_data = fetch_page("https://pypi.python.org/pypi/%s/%s/json" % (pkg_name, version))
-    release_data = json.loads(release_data)
+        release_data = fetch_page("https://pypi.python.org/pypi/%s/%s/json" % (pkg_name, version))
+        release_data = json.loads(release_data)
 
     if (not release_data):
         logger.error("Can't find URL for %s-%s" % (package, version))
@@ -191,6 +193,39 @@ def get_url(package, version=None):
 
     return urls
 
+def resolve_version(package, version):
+    """
+        Return released_on, download_url, size, checksum and
+        homepage, repo, bugtracker URLs for this version
+        using a single request.
+    """
+    pkg_name = _other_name(package)
+
+    data = fetch_page("https://pypi.python.org/pypi/%s/%s/json" % (pkg_name, version))
+    data = json.loads(data)
+
+    result = {
+        'released_on' : get_release_date(package, version, data),
+        'download_url' : get_download_url(package, version, data),
+        'size' : None,
+        'checksum' : None,
+        'urls' : get_url(package, version, data),
+    }
+
+    if data.has_key('urls'):
+        for file in data['urls']:
+            if file['url'] != result['download_url']:
+                continue
+
+            result['size'] = file.get('size')
+
+            if file.has_key('digests') and file['digests'].get('sha256'):
+                result['checksum'] = 'sha256:%s' % file['digests']['sha256']
+            elif file.get('md5_digest'):
+                result['checksum'] = 'md5:%s' % file['md5_digest']
+
+    return result
+
 def compare_versions(ver1, ver2):
     return pypi_compare_versions(ver1, ver2)
 
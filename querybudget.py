@@ -0,0 +1,241 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Count SQL queries and DB time per view and per task.
+
+    Views are measured by QueryBudgetMiddleware, tasks with the
+    @query_budget decorator from decorators.py. The number of queries
+    and the total time are logged and sent to the metrics sinks. If the
+    budget from DIFIO_QUERY_BUDGETS is exceeded the slowest statements
+    are logged as well, or QueryBudgetExceeded is raised if
+    DIFIO_QUERY_BUDGET_STRICT is set, e.g. in tests.
+
+    Queries are recorded by a cursor wrapper, not from connection.queries,
+    because tasks call reset_queries() while still running.
+"""
+
+import time
+import metrics
+import logging
+import threading
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends.util import CursorWrapper
+
+logger = logging.getLogger(__name__)
+
+# name -> (max queries, max seconds), None means no limit
+DEFAULT_QUERY_BUDGETS = {
+    'views.dashboard' : (20, 0.5),
+    'views.appdetails' : (30, 1.0),
+    # about 3 queries for every installed package
+    'tasks.import_application' : (2000, 10.0),
+}
+
+try:
+    QUERY_BUDGETS = settings.DIFIO_QUERY_BUDGETS
+except:
+    QUERY_BUDGETS = {}
+
+try:
+    QUERY_BUDGET_STRICT = settings.DIFIO_QUERY_BUDGET_STRICT
+except:
+    QUERY_BUDGET_STRICT = False
+
+# how many of the slowest statements to log
+try:
+    QUERY_BUDGET_TOP = settings.DIFIO_QUERY_BUDGET_TOP
+except:
+    QUERY_BUDGET_TOP = 5
+
+_local = threading.local()
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def get_budget(name):
+    """
+        @name - string - e.g. views.dashboard or tasks.import_application
+        @return - tuple - (max queries, max seconds) or (None, None)
+    """
+    if QUERY_BUDGETS.has_key(name):
+        return QUERY_BUDGETS[name]
+
+    return DEFAULT_QUERY_BUDGETS.get(name, (None, None))
+
+def _active():
+    if not hasattr(_local, 'active'):
+        _local.active = []
+    return _local.active
+
+
+class RecordingCursor(CursorWrapper):
+    """
+        Passes the executed statements to all active recordings.
+    """
+    def _record(self, sql, started):
+        duration = time.time() - started
+        for rec in _active():
+            rec.add(sql, duration)
+
+    def execute(self, sql, params=()):
+        started = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self._record(sql, started)
+
+    def executemany(self, sql, param_list):
+        started = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self._record(sql, started)
+
+def _install():
+    """
+        Wrap the debug cursor of the default database, keeping
+        whatever wrapper was installed before.
+    """
+    db = connections[DEFAULT_DB_ALIAS]
+    _local.saved = (db, db.use_debug_cursor, db.__dict__.get('make_debug_cursor'))
+
+    previous = db.make_debug_cursor
+    db.use_debug_cursor = True
+    db.make_debug_cursor = lambda cursor: RecordingCursor(previous(cursor), db)
+
+def _uninstall():
+    (db, use_debug_cursor, make_debug_cursor) = _local.saved
+    db.use_debug_cursor = use_debug_cursor
+    if make_debug_cursor is None:
+        del db.make_debug_cursor
+    else:
+        db.make_debug_cursor = make_debug_cursor
+
+
+class Recording(object):
+    """
+        Queries executed on this thread between start() and stop().
+        Recordings may be nested, e.g. a task called directly from another.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.time = 0
+        self.statements = [] # (duration, sql), only the slowest are kept
+
+    def add(self, sql, duration):
+        self.count += 1
+        self.time += duration
+
+        self.statements.append((duration, sql))
+        if len(self.statements) > QUERY_BUDGET_TOP * 10:
+            self.statements.sort(reverse=True)
+            del self.statements[QUERY_BUDGET_TOP:]
+
+    def slowest(self):
+        """
+            @return - list - (duration, sql) of the slowest statements
+        """
+        self.statements.sort(reverse=True)
+        return self.statements[:QUERY_BUDGET_TOP]
+
+    def start(self):
+        active = _active()
+        if not active:
+            _install()
+        active.append(self)
+        return self
+
+    def stop(self):
+        """
+            Log the results and check the budget.
+
+            @return - bool - True if within budget
+        """
+        active = _active()
+        if self in active:
+            active.remove(self)
+            if not active:
+                _uninstall()
+
+        metrics.incr('queries.%s.count' % self.name, self.count)
+        metrics.timing('queries.%s.time' % self.name, int(self.time * 1000))
+
+        (max_queries, max_time) = get_budget(self.name)
+        exceeded = ((max_queries is not None) and (self.count > max_queries)) or \
+                    ((max_time is not None) and (self.time > max_time))
+
+        message = "Queries for %s: %d in %.3f s, budget %s queries in %s s" % (self.name, self.count, self.time, max_queries, max_time)
+        if not exceeded:
+            logger.info(message)
+            return True
+
+        logger.warning("Over budget! " + message)
+        for (duration, sql) in self.slowest():
+            logger.warning("%.3f s %s" % (duration, sql))
+
+        if QUERY_BUDGET_STRICT:
+            raise QueryBudgetExceeded(message)
+
+        return False
+
+
+def budget_name(func):
+    """
+        @return - string - e.g. views.dashboard for difio.views.dashboard
+    """
+    return "%s.%s" % (func.__module__.split('.')[-1], func.__name__)
+
+
+class QueryBudgetMiddleware(object):
+    """
+        Add to MIDDLEWARE_CLASSES to measure every view. Views decorated
+        with @query_budget are measured without it.
+    """
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # measured by the @query_budget decorator
+        if getattr(view_func, 'query_budget', False):
+            return None
+
+        # drop recordings left by a request which didn't finish cleanly
+        if _active():
+            del _active()[:]
+            _uninstall()
+
+        request._query_budget = Recording(budget_name(view_func)).start()
+        return None
+
+    def process_exception(self, request, exception):
+        if hasattr(request, '_query_budget'):
+            rec = request._query_budget
+            del request._query_budget
+            # don't hide the original exception
+            try:
+                rec.stop()
+            except QueryBudgetExceeded:
+                pass
+        return None
+
+    def process_response(self, request, response):
+        if hasattr(request, '_query_budget'):
+            rec = request._query_budget
+            del request._query_budget
+            rec.stop()
+        return response
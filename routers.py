@@ -0,0 +1,119 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Celery task routing. Enable with
+
+        CELERY_ROUTES = ('difio.routers.TaskRouter',)
+
+    and start a separate worker for every queue so that long running
+    analytics don't starve user triggered work. See README.md.
+"""
+
+# cron helpers, email notifications and everything else
+QUEUE_DEFAULT = 'difio'
+
+# user triggered work: app imports and the 'search updates' button
+QUEUE_INTERACTIVE = 'difio.interactive'
+
+# short tasks which only talk to the database
+QUEUE_DB = 'difio.db'
+
+# tasks which query upstream sources over the network
+QUEUE_NETWORK = 'difio.network'
+
+# downloading tarballs, generating diffs and static pages
+QUEUE_HEAVY = 'difio.heavy'
+
+ALL_QUEUES = [QUEUE_DEFAULT, QUEUE_INTERACTIVE, QUEUE_DB, QUEUE_NETWORK, QUEUE_HEAVY]
+
+TASK_QUEUES = {
+    'helper_search_new_data' : QUEUE_INTERACTIVE,
+    'import_application' : QUEUE_INTERACTIVE,
+
+    'do_stuff_when_packages_change' : QUEUE_DB,
+    'generate_application_history_records' : QUEUE_DB,
+    'update_application_status' : QUEUE_DB,
+    'set_package_latest_version' : QUEUE_DB,
+    'move_package_to_verified' : QUEUE_DB,
+    'move_package_version_to_verified' : QUEUE_DB,
+    'cron_delete_pending_apps' : QUEUE_DB,
+
+    'find_homepage_for_package' : QUEUE_NETWORK,
+    'find_new_version_for_package' : QUEUE_NETWORK,
+    'find_new_versions_in_batch' : QUEUE_NETWORK,
+    'compare_versions_and_create_advisory' : QUEUE_NETWORK,
+    'pv_import_same_pkg_type_from_rss' : QUEUE_NETWORK,
+    'pv_import_new_from_rss' : QUEUE_NETWORK,
+    'pv_find_date' : QUEUE_NETWORK,
+    'pv_find_download_url' : QUEUE_NETWORK,
+    'pv_resolve' : QUEUE_NETWORK,
+    'pv_find_tags' : QUEUE_NETWORK,
+
+    'generate_advisory_files' : QUEUE_HEAVY,
+    'find_bugs' : QUEUE_HEAVY,
+    'generate_static_pages' : QUEUE_HEAVY,
+}
+
+def get_queue(task_name, args=None, kwargs=None):
+    """
+        @task_name - string - full task name, e.g. difio.tasks.find_bugs
+        @args - list - positional task arguments
+        @kwargs - dict - keyword task arguments
+
+        @return - string - queue name
+    """
+    name = task_name.split('.')[-1]
+
+    # searching new versions for a single application is
+    # triggered by the user, everything else is executed by CRON
+    if name == 'cron_find_new_versions':
+        app_id = None
+        if args and len(args) > 1:
+            app_id = args[1]
+        elif kwargs:
+            app_id = kwargs.get('app_id', None)
+
+        if app_id is not None:
+            return QUEUE_INTERACTIVE
+        return QUEUE_DEFAULT
+
+    return TASK_QUEUES.get(name, QUEUE_DEFAULT)
+
+
+class TaskRouter(object):
+    """
+        Route tasks to queues according to TASK_QUEUES.
+
+        Explicit queue= passed to apply_async() takes precedence.
+    """
+
+    def route_for_task(self, task, args=None, kwargs=None):
+        queue = get_queue(task, args, kwargs)
+        return {
+            'queue' : queue,
+            'routing_key' : queue,
+        }
+
+
+if __name__ == "__main__":
+    for name in ['difio.tasks.helper_search_new_data', 'difio.tasks.generate_advisory_files',
+                    'difio.tasks.cron_find_new_versions', 'difio.tasks.cron_notify_app_owners_1']:
+        print name, get_queue(name)
+
+    print 'difio.tasks.cron_find_new_versions', get_queue('difio.tasks.cron_find_new_versions', [None, 1, True])
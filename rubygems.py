@@ -19,6 +19,7 @@
 ################################################################################
 
 
+import re
 import json
 import logging
 from utils import fetch_page
@@ -102,6 +103,32 @@ def get_url(package, version=None):
 
     return urls
 
+def resolve_version(package, version):
+    """
+        Return released_on, download_url, size and checksum
+        for this version using a single request.
+
+        NB: homepage, repo, bugtracker URLs are not part of
+        the versions list. Use get_url().
+    """
+    json_data = fetch_page('https://rubygems.org/api/v1/versions/%s.json' % package)
+    data = json.loads(json_data)
+
+    result = {
+        'released_on' : get_release_date(package, version, data),
+        'download_url' : get_download_url(package, version, data),
+        'size' : None,
+        'checksum' : None,
+        'urls' : None,
+    }
+
+    for ver in data:
+        if (ver['number'] == version) and ver.get('sha'):
+            result['checksum'] = 'sha256:%s' % ver['sha']
+            break
+
+    return result
+
 def compare_versions(ver1, ver2):
     """
         Based on:
@@ -171,6 +198,30 @@ def compare_versions(ver1, ver2):
 
     return 0
 
+def is_prerelease(version):
+    """
+        Versions which contain letters are prerelease, e.g. 1.0.0.rc1.
+        Same as Gem::Version#prerelease?
+    """
+    return re.search('[a-zA-Z]', version) is not None
+
+def parse_web_hook(data):
+    """
+        @data - dict - JSON posted by the RubyGems.org web hook. Same as
+                /api/v1/gems/NAME.json for the pushed version.
+
+        @return - tuple - (name, version, released_on) or None for
+                  prerelease versions. released_on is None if not known.
+    """
+    if is_prerelease(data['version']):
+        return None
+
+    released_on = None
+    if data.get('version_created_at'):
+        released_on = datetime.strptime(data['version_created_at'][:19], '%Y-%m-%dT%H:%M:%S')
+
+    return (data['name'], data['version'], released_on)
+
 def get_latest_from_rss():
     """
         @return - list of (name. version, released_on)
@@ -21,90 +21,170 @@
 import os
 import glob
 import gzip
+import zlib
 import shutil
 import tarfile
 import zipfile
 from bz2 import BZ2Compressor
 
-def _ensure_read_access(tarfileobj):
+def _ensure_read_access(tarinfo):
     """
 From: https://gist.github.com/124597
 
-Ensure that the given tarfile will be readable by the user after
+Ensure that the given tarfile member will be readable by the user after
 extraction.
 
 Some tarballs have u-x set on directories. They may as well have u-r set
 on files. We reset such perms here.. so that the extracted files remain
 accessible.
 
+NB: members are extracted one by one so directories need to be writable
+as well, otherwise their contents can't be extracted.
+
 See also: http://bugs.python.org/issue6196
     """
     EXECUTE = 0100
     READ = 0400
-    dir_perm = EXECUTE
+    WRITE = 0200
+    dir_perm = EXECUTE | READ | WRITE
     file_perm = EXECUTE | READ
 
-    # WARNING: if the tarfile had a huge list of files, this could be a
-    # potential performance bottleneck.
-    for tarinfo in tarfileobj.getmembers():
-        tarinfo.mode |= (dir_perm if tarinfo.isdir() else file_perm)
+    tarinfo.mode |= (dir_perm if tarinfo.isdir() else file_perm)
 
-def _get_top_dir_tar(tarfileobj): # FALSE NEGATIVE
+def _split_top_dir(path):
     """
-        Many tarball-s contain a top-level directory with everything underneat.
-        This is breaking diff so we want to extract all members without the top-level
-        parent directory.
+        Split a member path into top-level object and the rest.
 
-        @return - name of toplevel directory
+        @return - tuple - (top, rest), rest is None for top-level objects
     """
-    top_lvl = []
+    path = os.path.normpath(path).strip('/')
 
-    # grab all toplevel opjects
-    for tarinfo in tarfileobj.getmembers():
-        path = tarinfo.path.strip('/')
-        if path.count('/') == 0:
-            top_lvl.append(tarinfo)
+    if path == '.':
+        return (None, None)
 
-    if (len(top_lvl) == 1) and top_lvl[0].isdir():
-        return top_lvl[0].path
+    parts = path.split('/', 1)
+    if len(parts) == 1:
+        return (parts[0], None)
 
-    return None
+    return (parts[0], parts[1])
+
+def _sanitize_zip_member(name):
+    """
+        Normalize a zip member name the way zipfile._extract_member does:
+        drop drive letters, absolute components, '.' and '..'.
+
+        @return - string - relative path, or None if nothing is left
+    """
+    name = name.replace('\\', '/')
+    parts = []
+    for part in name.split('/'):
+        part = os.path.splitdrive(part)[1]
+        if part in ('', os.curdir, os.pardir):
+            continue
+        parts.append(part)
+
+    if not parts:
+        return None
+
+    path = '/'.join(parts)
+    if name.endswith('/'):
+        path += '/'
+    return path
+
+def _move_down(dirname, top_dir, extracted):
+    """
+        Many tarball-s contain a top-level directory with everything underneat
+        and we extract members without it. If it turns out there's more than one
+        top-level object then move what has been extracted so far
+        back under the top-level directory. Uses rename, not a copy.
+
+        @dirname - string - the extraction directory
+        @top_dir - string - name of the stripped top-level directory
+        @extracted - set - top-level names created in @dirname so far
+    """
+    tmp_dir = os.path.join(dirname, '.%s.tmp' % top_dir)
+    os.mkdir(tmp_dir)
+
+    for name in extracted:
+        if os.path.lexists(os.path.join(dirname, name)):
+            os.rename(os.path.join(dirname, name), os.path.join(tmp_dir, name))
+
+    os.rename(tmp_dir, os.path.join(dirname, top_dir))
+
+def _extract_stream(tarfileobj, dirname, strip_top_dir=True):
+    """
+        Extract members as they are read from a tar stream.
+        Each file is written only once.
+
+        @tarfileobj - TarFile - opened in stream mode
+        @dirname - string - where to extract
+        @strip_top_dir - bool - if True and all members are under a single
+                         top-level directory extract them without it
+    """
+
+    top_dir = None
+    extracted = set() # top-level names, used only while stripping
+
+    for tarinfo in tarfileobj:
+        (top, rest) = _split_top_dir(tarinfo.name)
+        if top is None:
+            continue
+
+        if strip_top_dir:
+            if (top_dir is None) and ((rest is not None) or tarinfo.isdir()):
+                top_dir = top
+
+            if (top_dir is None) or (top != top_dir):
+                # more than one top-level object, stop stripping
+                strip_top_dir = False
+                if top_dir is not None:
+                    _move_down(dirname, top_dir, extracted)
+            elif rest is None:
+                # this is the top-level directory itself
+                continue
+            else:
+                tarinfo.name = rest
+                if tarinfo.islnk():
+                    (link_top, link_rest) = _split_top_dir(tarinfo.linkname)
+                    if (link_top == top_dir) and link_rest:
+                        tarinfo.linkname = link_rest
+
+                extracted.add(rest.split('/', 1)[0])
+
+        _ensure_read_access(tarinfo)
+        try:
+            tarfileobj.extract(tarinfo, dirname)
+        except: # this can fail if we have unicode file names in the archive
+            continue
 
 def _get_top_dir_zip(zipfileobj): # FALSE NEGATIVE
     """
         @return - name of toplevel directory
     """
     top_lvl = {}
+    has_children = False
 
     # grab all toplevel opjects
     for file in zipfileobj.namelist():
-        try:
-            path = file.strip('/').split('/')[0]
-            top_lvl[path] = 1
-        except IndexError: # top-level file with no dir
-            top_lvl[path] = 1
+        file = _sanitize_zip_member(file)
+        if file is None:
+            continue
+
+        (top, rest) = _split_top_dir(file)
+        if top is None:
+            continue
+
+        top_lvl[top] = 1
+        if rest or file.endswith('/'):
+            has_children = True
 
     top_lvl = top_lvl.keys()
 
-    if len(top_lvl) == 1:
+    if (len(top_lvl) == 1) and has_children:
         return top_lvl[0]
 
     return None
 
-def _move_up(tarfileobj, dirname, get_top_dir_callback):
-    """
-        Move extracted files one level up
-        and delete the top-level directory
-    """
-    # move files around and delete top_dir
-    top_dir = get_top_dir_callback(tarfileobj)
-
-    if top_dir and top_dir not in ['.']:
-        if os.system('cp -r "%s/%s"/* "%s"' % (dirname, top_dir, dirname)) != 0:
-            raise Exception("FAILED: _move_up %s, %s" % (dirname, top_dir))
-
-        shutil.rmtree('%s/%s' % (dirname, top_dir), True)
-
 
 def untar(filename, dirname): # FALSE NEGATIVE
     """
@@ -115,15 +195,10 @@ def untar(filename, dirname): # FALSE NEGATIVE
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    # open for read, transparent compression enabled
-    f = tarfile.open(name=filename, mode='r:*')
+    # open for streaming read, transparent compression enabled
+    f = tarfile.open(name=filename, mode='r|*')
     try:
-        _ensure_read_access(f)
-        try:
-            f.extractall(dirname)
-        except: # this can fail if we have unicode file names in the archive
-            pass
-        _move_up(f, dirname, _get_top_dir_tar)
+        _extract_stream(f, dirname)
     finally:
         f.close()
 
@@ -137,12 +212,52 @@ def unzip(filename, dirname):
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    # open for read, transparent compression enabled
     f = zipfile.ZipFile(filename, 'r')
     try:
-        # todo: do we need to _ensure_read_access() here ???
-        f.extractall(dirname)
-        _move_up(f, dirname, _get_top_dir_zip)
+        # NB: the member list comes from the central directory
+        # which is already in memory
+        top_dir = _get_top_dir_zip(f)
+        root = os.path.realpath(dirname)
+
+        for info in f.infolist():
+            name = _sanitize_zip_member(info.filename)
+            if name is None:
+                continue
+
+            (top, rest) = _split_top_dir(name)
+            if top is None:
+                continue
+
+            if top_dir:
+                if rest is None:
+                    continue
+                path = os.path.join(dirname, rest)
+            elif rest is None:
+                path = os.path.join(dirname, top)
+            else:
+                path = os.path.join(dirname, top, rest)
+
+            # never write outside of @dirname, e.g. through a symlink
+            if not os.path.realpath(path).startswith(root + os.sep):
+                continue
+
+            if name.endswith('/'):
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                continue
+
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            src = f.open(info)
+            try:
+                dst = open(path, 'wb')
+                try:
+                    shutil.copyfileobj(src, dst, 1024*1024)
+                finally:
+                    dst.close()
+            finally:
+                src.close()
     finally:
         f.close()
 
@@ -172,41 +287,121 @@ def extract_gem(filename, dirname):
         Extract @filename into @dirname
         where @filename is a Ruby .gem file
         X.gem (tar archive) contains data.tar.gz and metadata.gz
+
+        Both are extracted directly from the .gem stream.
     """
 
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    # open for read, transparent compression enabled
-    f = tarfile.open(name=filename, mode='r:*')
+    f = tarfile.open(name=filename, mode='r|*')
     try:
-        # todo: _ensure_read_access()
-#        f.extract("data.tar.gz", dirname)
-        f.extractall(dirname)
+        for tarinfo in f:
+            if tarinfo.name == "data.tar.gz":
+                data = tarfile.open(fileobj=f.extractfile(tarinfo), mode='r|gz', ignore_zeros=True)
+                try:
+                    _extract_stream(data, dirname, False)
+                finally:
+                    data.close()
+            elif tarinfo.name == "metadata.gz":
+                # NB: metadata is small, gzip.GzipFile can't read from a stream
+                out_file = open(os.path.join(dirname, "metadata"), 'wb')
+                try:
+                    out_file.write(zlib.decompress(f.extractfile(tarinfo).read(), 16 + zlib.MAX_WBITS))
+                finally:
+                    out_file.close()
+            else:
+                _ensure_read_access(tarinfo)
+                f.extract(tarinfo, dirname)
     finally:
         f.close()
 
-    data_tar_gz = dirname + "/data.tar.gz"
-    metadata_gz = dirname + "/metadata.gz"
 
+
+#### member iterators
+#
+# Used to import archives directly into git without writing
+# anything to disk. Each member is yielded as
+# (path, kind, mode, data) where kind is 'file', 'symlink' or 'hardlink';
+# data is the file contents or the link target respectively.
+# Directories are not yielded.
+
+def _member_path(name):
+    (top, rest) = _split_top_dir(name)
+    if rest is None:
+        return top
+
+    return '%s/%s' % (top, rest)
+
+def _iter_tar_stream(tarfileobj):
+    for tarinfo in tarfileobj:
+        path = _member_path(tarinfo.name)
+        if path is None:
+            continue
+
+        if tarinfo.isfile():
+            yield (path, 'file', tarinfo.mode, tarfileobj.extractfile(tarinfo).read())
+        elif tarinfo.issym():
+            yield (path, 'symlink', tarinfo.mode, tarinfo.linkname)
+        elif tarinfo.islnk():
+            yield (path, 'hardlink', tarinfo.mode, _member_path(tarinfo.linkname))
+
+def iter_tar(filename):
+    """
+        Iterate over the members of a [compressed] tar archive
+    """
+    f = tarfile.open(name=filename, mode='r|*')
     try:
-        gunzip(metadata_gz, dirname)
+        for member in _iter_tar_stream(f):
+            yield member
     finally:
-        os.remove(metadata_gz)
+        f.close()
 
+def iter_zip(filename):
+    """
+        Iterate over the members of a zip archive
+    """
+    f = zipfile.ZipFile(filename, 'r')
     try:
-        # open for read, transparent compression enabled
-        f = tarfile.open(data_tar_gz, mode='r:gz', ignore_zeros=True)
-
-        try:
-            # todo: _ensure_read_access()
-            f.extractall(dirname)
-        finally:
-            f.close()
+        for info in f.infolist():
+            path = _member_path(info.filename)
+            if (path is None) or info.filename.endswith('/'):
+                continue
+
+            # unix permissions are in the high bits, if present
+            mode = (info.external_attr >> 16) or 0644
+            yield (path, 'file', mode, f.read(info))
+    finally:
+        f.close()
 
+def iter_gem(filename):
+    """
+        Iterate over the contents of a Ruby .gem file,
+        the same way extract_gem() extracts them
+    """
+    f = tarfile.open(name=filename, mode='r|*')
+    try:
+        for tarinfo in f:
+            if tarinfo.name == "data.tar.gz":
+                data = tarfile.open(fileobj=f.extractfile(tarinfo), mode='r|gz', ignore_zeros=True)
+                try:
+                    for member in _iter_tar_stream(data):
+                        yield member
+                finally:
+                    data.close()
+            elif tarinfo.name == "metadata.gz":
+                yield ("metadata", 'file', 0644, zlib.decompress(f.extractfile(tarinfo).read(), 16 + zlib.MAX_WBITS))
+            elif tarinfo.isfile():
+                yield (_member_path(tarinfo.name), 'file', tarinfo.mode, f.extractfile(tarinfo).read())
     finally:
-        os.remove(data_tar_gz)
+        f.close()
 
+# extract function -> member iterator
+MEMBER_ITERATORS = {
+    untar : iter_tar,
+    unzip : iter_zip,
+    extract_gem : iter_gem,
+}
 
 
 def bz2compress(data):
@@ -23,27 +23,33 @@ import api
 import bugs
 import json
 import pypi
-import time
+import cpan
 import urls
+import batch
 import shlex
 import utils
 import views
 import shutil
 import github
 import socket
+import routers
+import tracing
+import metrics
 import metacpan
+import rubygems
+import throttle
 import analytics
 import bitbucket
 import xmlrpclib
 import subprocess
 import mavencentral
 from models import *
-from time import sleep
 from decorators import *
 import distutils.dir_util
 import distutils.file_util
 from tar import bz2compress
-from tempfile import mkdtemp
+from managers import chunks
+from gitrepo import GitRepo
 from celery.task import task
 from traceback import format_tb
 from django.conf import settings
@@ -52,8 +58,8 @@ from django.core import cache as cache_module
 from django.db import reset_queries
 from django.shortcuts import render
 from django.utils.html import escape
-from django.db.models import Count, Q
-from django.core.mail import send_mail
+from django.db.models import Count, Max, Q
+from django.core.mail import send_mail, get_connection
 from htmlmin.minify import html_minify
 from BeautifulSoup import BeautifulSoup
 from datetime import datetime, timedelta
@@ -66,6 +72,9 @@ from django.contrib.auth.models import AnonymousUser
 from django.core.files.storage import default_storage
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 
+# count subprocesses inside tracing spans
+tracing.install()
+
 @task
 def cron_find_homepages(id = None):
     """
@@ -88,29 +97,42 @@ def cron_find_homepages(id = None):
         last_time = datetime.now()-timedelta(days=7)
         query = query.filter(status=STATUS_NEW, last_checked__lte=last_time)
         # select only installed packages
-        query = query.filter(pk__in=set(inst.package for inst in InstalledPackage.objects.only('package').distinct()))
-
-    query = query.only('name', 'type')
-
-    for pkg in query:
-        try:
-            # get a version object b/c some URLs require name and version
-            # this is a quick hack to take the most recent version as sorted by the DB
-            # it will not always be the most recent one, but should work well enough to populate
-            # URLs into the DB.
-            ver = PackageVersion.objects.filter(package=pkg.pk).only('version').order_by('-version')[0]
-            find_homepage_for_package.delay(pkg.pk, pkg.name, ver.version, PACKAGE_CALLBACKS[pkg.type]['get_url'])
-        except:
-            logger.error("Can't find homepage for package: %s - %d" % (pkg.name, pkg.pk))
-            logger.error("Exception: %s" % sys.exc_info()[1])
-            logger.error(format_tb(sys.exc_info()[2]))
+        query = query.filter(pk__in=InstalledPackage.objects.values('package'))
+
+    for chunk in query.chunked(values_list=['name', 'type']):
+        # get a version b/c some URLs require name and version
+        # this is a quick hack to take the most recent version as sorted by the DB
+        # it will not always be the most recent one, but should work well enough to populate
+        # URLs into the DB.
+        versions = {}
+        for row in PackageVersion.objects.filter(
+                        package__in=[pk for (pk, name, type) in chunk]
+                    ).values('package').annotate(latest=Max('version')).order_by():
+            versions[row['package']] = row['latest']
+
+        for (pk, name, type) in chunk:
+            try:
+                get_url_func = PACKAGE_CALLBACKS[type]['get_url']
+                countdown = throttle.reserve(throttle.bucket_for_callback(get_url_func))
+                if countdown is None: # still NEW, searched on the next execution
+                    continue
+
+                find_homepage_for_package.apply_async(
+                                args=[pk, name, versions[pk], get_url_func],
+                                countdown=countdown
+                            )
+            except:
+                logger.error("Can't find homepage for package: %s - %d" % (name, pk))
+                logger.error("Exception: %s" % sys.exc_info()[1])
+                logger.error(format_tb(sys.exc_info()[2]))
             continue
 
     reset_queries()
 
 
 @task
-def find_homepage_for_package(id, name, version, get_url_func):
+@single_instance(['id'], dedup=3600)
+def find_homepage_for_package(id, name, version, get_url_func, urls=None):
     """
         Updates URL of particular Package.
         Not to be executed by CRON directly.
@@ -119,13 +141,15 @@ def find_homepage_for_package(id, name, version, get_url_func):
         @name - string - package name - used for performance reasons
         @version - string - package version - used for performance reasons
         @get_url_func - callback which returns the homepage URL
+        @urls - dict - already known URLs, e.g. from resolve_version. @get_url_func is not called
     """
     logger = find_homepage_for_package.get_logger()
 
     logger.info("Going to search for package URLs for %s" % name)
 
     try:
-        urls = get_url_func(name, version)
+        if not urls:
+            urls = get_url_func(name, version)
 
         # additional helpers to speed up data entry
         website = urls['homepage']
@@ -204,7 +228,7 @@ def cron_find_new_versions(id = None, app_id = None, rate_limit = True):
     last_time = datetime.now()-timedelta(hours=20)
 
     # select PackageVersion's followed/installed by users
-    pv_ids = InstalledPackage.objects.only('version').distinct()
+    pv_ids = InstalledPackage.objects.values('version')
 
     # if app_id is not None then user pressed the
     # 'search updates' button in the apps view
@@ -212,9 +236,7 @@ def cron_find_new_versions(id = None, app_id = None, rate_limit = True):
         pv_ids = pv_ids.filter(application=app_id)
 
     # now select the objects themselves
-    query = PackageVersion.objects.filter(
-                pk__in=set(inst.version for inst in pv_ids)
-            ).only('package')
+    query = PackageVersion.objects.filter(pk__in=pv_ids)
 
     # if ID param was specified then
     # search new versions only for installed packages of
@@ -222,30 +244,68 @@ def cron_find_new_versions(id = None, app_id = None, rate_limit = True):
     if id is not None:
         query = query.filter(package=id)
 
+    # keep user triggered searches in the priority lane
+    # CRON searches are spread over time, see throttle.py
+    options = {}
+    if app_id is not None:
+        options['queue'] = routers.QUEUE_INTERACTIVE
 
-    for pv in query:
-        try:
-            pkg = Package.objects.filter(pk=pv.package_id).only('name', 'type', 'last_checked')[0]
+    # CRON queries upstream for many packages in the same task, see batch.py
+    in_batch = (app_id is None) and (id is None)
+    pending = {} # get_upstream_func -> [(pk, name)]
 
-            # impose date(rate) limit to avoid users
-            # scheduling too often (via the website) to find updates.
-            if rate_limit and pkg.last_checked and (pkg.last_checked > last_time):
-                continue
+    for chunk in query.chunked(values_list=['package']):
+        packages = Package.objects.values_in_bulk([pkg_id for (pk, pkg_id) in chunk], 'name', 'type', 'last_checked')
+
+        for (pk, pkg_id) in chunk:
+            try:
+                pkg = packages[pkg_id]
+
+                # impose date(rate) limit to avoid users
+                # scheduling too often (via the website) to find updates.
+                if rate_limit and pkg['last_checked'] and (pkg['last_checked'] > last_time):
+                    continue
+
+                get_upstream_func = PACKAGE_CALLBACKS[pkg['type']]['get_latest']
 
-            find_new_version_for_package.delay(
-                                pv.pk,
-                                pkg.name,
-                                PACKAGE_CALLBACKS[pkg.type]['get_latest']
+                if in_batch:
+                    pending.setdefault(get_upstream_func, []).append((pk, pkg['name']))
+                    if len(pending[get_upstream_func]) >= batch.BATCH_SIZE:
+                        _find_new_versions_in_batch_later(get_upstream_func, pending.pop(get_upstream_func))
+                    continue
+
+                if app_id is None:
+                    options['countdown'] = throttle.reserve(throttle.bucket_for_callback(get_upstream_func))
+                    if options['countdown'] is None: # checked on the next execution
+                        continue
+
+                find_new_version_for_package.apply_async(
+                                args=[pk, pkg['name'], get_upstream_func],
+                                **options
                             )
-        except:
-            logger.error("Exception: %s" % sys.exc_info()[1])
-            logger.error(format_tb(sys.exc_info()[2]))
-            continue
+            except:
+                logger.error("Exception: %s" % sys.exc_info()[1])
+                logger.error(format_tb(sys.exc_info()[2]))
+                continue
+
+    for get_upstream_func in pending.keys():
+        _find_new_versions_in_batch_later(get_upstream_func, pending[get_upstream_func])
 
     reset_queries()
 
+def _find_new_versions_in_batch_later(get_upstream_func, packages):
+    countdown = throttle.reserve(throttle.bucket_for_callback(get_upstream_func))
+    if countdown is None: # checked on the next execution
+        return
+
+    find_new_versions_in_batch.apply_async(
+                    args=[get_upstream_func, packages],
+                    countdown=countdown
+                )
+
 
 @task
+@single_instance(['id'], dedup=600)
 def find_new_version_for_package(id, name, get_upstream_func):
     """
         Search for new versions of a particular package and create new objects.
@@ -275,35 +335,82 @@ def find_new_version_for_package(id, name, get_upstream_func):
             upstream_ver = 304
             upstream_released_on = 304
 
-        # if we can't find version/date (e.g. wrong import)
-        if not (upstream_ver or upstream_released_on):
-            return
+        _save_upstream_version(logger, installed, name, upstream_ver, upstream_released_on)
+    except:
+        logger.error("Exception: %s" % sys.exc_info()[1])
+        logger.error(format_tb(sys.exc_info()[2]))
 
-        # GET returned 304 Not Modified => get the latest PV available in DB
-        if (upstream_ver == 304) and (upstream_released_on == 304):
-            pv_upst = PackageVersion.objects.filter(package=installed.package).order_by('-released_on')[0]
-        else:
-            try:
-                # this version is already present
-                pv_upst = PackageVersion.objects.filter(package=installed.package, version=upstream_ver)[0]
-            except IndexError:
-                # create new PV object
-                pv_upst = PackageVersion.objects.create(package=installed.package, version=upstream_ver, released_on=upstream_released_on)
-                logger.info("Found new version %s-%s" % (name, upstream_ver))
+    reset_queries()
 
+@task
+def find_new_versions_in_batch(get_upstream_func, packages):
+    """
+        Same as find_new_version_for_package() for many packages
+        of the same type. Upstream is queried concurrently, see batch.py.
+        Not to be executed by CRON directly.
 
-        # NB: don't delay here
-        # NB: this will call set_package_latest_version()
-        # NB: always execute, not only for new PVs to catch the situation
-        # where older package is installed *AFTER* the new one has been imported
-        compare_versions_and_create_advisory(installed, pv_upst)
+        @get_upstream_func - callback to get the latest upstream version
+        @packages - list - of (PackageVersion.id, package name)
+    """
+    logger = find_new_versions_in_batch.get_logger()
 
-    except:
-        logger.error("Exception: %s" % sys.exc_info()[1])
-        logger.error(format_tb(sys.exc_info()[2]))
+    logger.info("Going to search new versions for %d packages" % len(packages))
+
+    installed = {}
+    for pv in PackageVersion.objects.filter(pk__in=[id for (id, name) in packages]).select_related('package'):
+        installed[pv.pk] = pv
+
+    packages = [(id, name) for (id, name) in packages if installed.has_key(id)]
+    args_list = [(name, installed[id].package.last_checked) for (id, name) in packages]
+
+    # network only, the DB is updated below in this thread
+    results = batch.run(get_upstream_func, args_list)
+
+    for ((id, name), (result, error)) in zip(packages, results):
+        try:
+            if error:
+                # see find_new_version_for_package()
+                result = (304, 304)
+
+            _save_upstream_version(logger, installed[id], name, result[0], result[1])
+        except:
+            logger.error("Exception: %s" % sys.exc_info()[1])
+            logger.error(format_tb(sys.exc_info()[2]))
 
     reset_queries()
 
+def _save_upstream_version(logger, installed, name, upstream_ver, upstream_released_on):
+    """
+        Create the upstream PackageVersion if needed and compare
+        it with the installed one.
+
+        @installed - PackageVersion - currently installed version
+        @name - string - package name
+        @upstream_ver, @upstream_released_on - result from the get_latest callback
+    """
+    # if we can't find version/date (e.g. wrong import)
+    if not (upstream_ver or upstream_released_on):
+        return
+
+    # GET returned 304 Not Modified => get the latest PV available in DB
+    if (upstream_ver == 304) and (upstream_released_on == 304):
+        pv_upst = PackageVersion.objects.filter(package=installed.package).order_by('-released_on')[0]
+    else:
+        try:
+            # this version is already present
+            pv_upst = PackageVersion.objects.filter(package=installed.package, version=upstream_ver)[0]
+        except IndexError:
+            # create new PV object
+            pv_upst = PackageVersion.objects.create(package=installed.package, version=upstream_ver, released_on=upstream_released_on)
+            logger.info("Found new version %s-%s" % (name, upstream_ver))
+
+
+    # NB: don't delay here
+    # NB: this will call set_package_latest_version()
+    # NB: always execute, not only for new PVs to catch the situation
+    # where older package is installed *AFTER* the new one has been imported
+    compare_versions_and_create_advisory(installed, pv_upst)
+
 @task
 def set_package_latest_version(installed, upstream):
     """
@@ -323,6 +430,19 @@ def set_package_latest_version(installed, upstream):
                 ) > 0):
         Package.objects.filter(id=installed.package.id).update(latest_version=upstream.version)
 
+# how long does it take to find the homepage of a package
+HOMEPAGE_SEARCH_COUNTDOWN = 10
+
+def _pv_find_tags_after(id, countdown):
+    """
+        Search tags for a single PackageVersion, no recursion.
+        If @countdown is set schedule the search instead of blocking the worker.
+    """
+    if countdown:
+        pv_find_tags.apply_async(args=[id, False], countdown=countdown)
+    else:
+        pv_find_tags(id, False) # NB: no delay
+
 @task
 def compare_versions_and_create_advisory(installed, upstream):
     """
@@ -344,7 +464,7 @@ def compare_versions_and_create_advisory(installed, upstream):
 
     # skip unapproved apps, analytics for them will be created once the app
     # is approved by the user
-    apps_pks = set(inst.application for inst in InstalledPackage.objects.filter(version=installed.pk).only('application'))
+    apps_pks = InstalledPackage.objects.filter(version=installed.pk).values('application')
     count = Application.objects.filter(pk__in=apps_pks, status__gte=APP_STATUS_APPROVED).count()
     if count == 0:
         return
@@ -354,7 +474,7 @@ def compare_versions_and_create_advisory(installed, upstream):
     # then try to find date because version compare will fail otherwise
     # NB: No delay here.
     if not installed.released_on:
-        pv_find_date(installed.id, PACKAGE_CALLBACKS[upstream.package.type]['find_date'])
+        _pv_resolve(installed.id, upstream.package.type)
         installed = PackageVersion.objects.filter(pk=installed.pk)[0] # reload the object after date has been updated
 
     # bump the latest version marker
@@ -397,27 +517,28 @@ def compare_versions_and_create_advisory(installed, upstream):
             # otherwise it's not needed so no need to send additional messages and get charged
 #NB: no .delay()
 
-            if not installed.package.scmurl:
-                cron_find_homepages(installed.package.pk)
-                sleep(10) # give it time to find some URLs
-
-            if not installed.released_on:
-                pv_find_date(installed.id, PACKAGE_CALLBACKS[installed.package.type]['find_date'])
+            # one request per version for date, download URL and package URLs
+            urls = None
+            if not (installed.released_on and installed.download_url):
+                urls = _pv_resolve(installed.id, installed.package.type)
 
-            if (not installed.scmid) or (installed.scmid == utils.TAG_NOT_FOUND):
-                pv_find_tags(installed.id, False) # no recursion, only this version
+            if not (upstream.released_on and upstream.download_url):
+                urls = _pv_resolve(upstream.id, upstream.package.type) or urls
 
-            if not installed.download_url:
-                pv_find_download_url(installed.id, PACKAGE_CALLBACKS[installed.package.type]['get_download_url'])
+            # tags are searched in the repository so give it time to find some URLs
+            tags_countdown = 0
+            if not installed.package.scmurl:
+                if urls:
+                    find_homepage_for_package.delay(installed.package.pk, installed.package.name, upstream.version, None, urls)
+                else:
+                    cron_find_homepages(installed.package.pk)
+                tags_countdown = HOMEPAGE_SEARCH_COUNTDOWN
 
-            if not upstream.released_on:
-                pv_find_date(upstream.id, PACKAGE_CALLBACKS[upstream.package.type]['find_date'])
+            if (not installed.scmid) or (installed.scmid == utils.TAG_NOT_FOUND):
+                _pv_find_tags_after(installed.id, tags_countdown)
 
             if (not upstream.scmid) or (upstream.scmid == utils.TAG_NOT_FOUND):
-                pv_find_tags(upstream.id, False) # no recursion, only this version
-
-            if not upstream.download_url:
-                pv_find_download_url(upstream.id, PACKAGE_CALLBACKS[upstream.package.type]['get_download_url'])
+                _pv_find_tags_after(upstream.id, tags_countdown)
 
     # update this package so it's not checked again very soon
     Package.objects.filter(pk=installed.package_id).update(last_checked=datetime.now())
@@ -456,8 +577,16 @@ def pv_import_same_pkg_type_from_rss(pkg_type, get_latest_from_rss_func):
     """
 
     for (name, version, released_on) in get_latest_from_rss_func():
-        pv_import_new_from_rss(pkg_type, name, version, released_on) # NB: no .delay()
-        time.sleep(2) # introduce some delay to offload DB server
+        # spread the imports over time to offload DB server
+        countdown = throttle.reserve('db')
+        # NB: versions not imported here are found by cron_find_versions
+        if countdown is None:
+            break
+
+        pv_import_new_from_rss.apply_async(
+                                args=[pkg_type, name, version, released_on],
+                                countdown=countdown
+                            )
 
 
 @task
@@ -490,7 +619,8 @@ def pv_import_new_from_rss(pkg_type, name, version, released_on):
         if not released_on:
             # NB: NO DELAY HERE b/c there's a race condition between pv_find_date() and
             # ver_date_cmp() in compare_versions_and_create_advisory() below if delayed
-            pv_find_date(pv.id, PACKAGE_CALLBACKS[pv.package.type]['find_date'])
+            # NB: collects download URL, size and checksum with the same request
+            _pv_resolve(pv.id, pkg_type)
 
         # this is newly imported PV. It's possible that our users have an old
         # version installed. => Fetch all installed versions and generate advisories.
@@ -498,15 +628,95 @@ def pv_import_new_from_rss(pkg_type, name, version, released_on):
         pv_ids = InstalledPackage.objects.filter(
                                         package=package.pk,
                                         version__gt=0,
-                                    ).only('version').distinct()
+                                    ).values('version')
 
-        for installed in PackageVersion.objects.filter(pk__in=set(inst.version for inst in pv_ids)):
+        for installed in PackageVersion.objects.filter(pk__in=pv_ids):
             # don't delay
             compare_versions_and_create_advisory(installed, pv)
 
     reset_queries()
 
 
+# parse web hook payloads into (name, version, released_on), see WebHookEvent
+WEBHOOK_PARSERS = {
+    RUBYGEM_RUBY_PKG : rubygems.parse_web_hook,
+}
+
+# events imported per execution
+WEBHOOK_BATCH_SIZE = 1000
+
+@task
+@single_instance([], timeout=600)
+def cron_process_webhook_events():
+    """
+        Import new versions received by the web hooks, see WebHookEvent.
+        Drops duplicate events, prerelease versions and versions
+        which are already in the DB. Executed by CRON.
+    """
+    logger = cron_process_webhook_events.get_logger()
+
+    # NB: failed events are kept until the error is cleared
+    events = list(WebHookEvent.objects.filter(error='').order_by('pk').values_list('pk', 'pkg_type', 'payload')[:WEBHOOK_BATCH_SIZE])
+    if not events:
+        return
+
+    failed = set()
+    releases = {} # (pkg_type, name, version) -> released_on
+    sources = {} # (pkg_type, name, version) -> [WebHookEvent.pk]
+    for (pk, pkg_type, payload) in events:
+        try:
+            release = WEBHOOK_PARSERS[pkg_type](json.loads(payload))
+            if release:
+                (name, version, released_on) = release
+                releases[(pkg_type, name, version)] = released_on
+                sources.setdefault((pkg_type, name, version), []).append(pk)
+        except:
+            logger.error("Can't parse web hook event %d" % pk)
+            logger.error("Exception: %s" % sys.exc_info()[1])
+            logger.error(format_tb(sys.exc_info()[2]))
+            WebHookEvent.objects.filter(pk=pk).update(error="%s\n%s" % (sys.exc_info()[1], "".join(format_tb(sys.exc_info()[2]))))
+            failed.add(pk)
+
+    # skip versions which are already imported
+    existing = set()
+    for pkg_type in set([t for (t, name, version) in releases.keys()]):
+        names = set([name for (t, name, version) in releases.keys() if t == pkg_type])
+        versions = set([version for (t, name, version) in releases.keys() if t == pkg_type])
+        for (name, version) in PackageVersion.objects.filter(
+                                        package__type=pkg_type,
+                                        package__name__in=names,
+                                        version__in=versions
+                                    ).values_list('package__name', 'version'):
+            existing.add((pkg_type, name, version))
+
+    imported = 0
+    deferred = set() # events kept for the next execution
+    for key in releases.keys():
+        if key in existing:
+            continue
+
+        # spread the imports over time to offload DB server
+        countdown = throttle.reserve('db')
+        if countdown is None:
+            deferred.update(sources[key])
+            continue
+
+        (pkg_type, name, version) = key
+        pv_import_new_from_rss.apply_async(
+                                args=[pkg_type, name, version, releases[key]],
+                                countdown=countdown
+                            )
+        imported += 1
+
+    WebHookEvent.objects.filter(
+                    pk__in=[pk for (pk, pkg_type, payload) in events if (pk not in failed) and (pk not in deferred)]
+                ).delete()
+    logger.info("Processed %d web hook events, importing %d new versions, %d failed, %d deferred" %
+                    (len(events), imported, len(failed), len(deferred)))
+
+    reset_queries()
+
+
 @task
 def cron_generate_advisory_files():
     """
@@ -517,47 +727,56 @@ def cron_generate_advisory_files():
     logger.info("Diffing new advisories")
 
     last_time = datetime.now()-timedelta(hours=1, minutes=30)
-    query = Advisory.objects.filter(status=STATUS_NEW).only('pk')
-    for adv in query:
-        try:
-            # try to pupulate missing data. Will move to VERIFIED if all found
-            # NB: automatically collect data only if new advisory is created.
-            # otherwise it's not needed so no need to send additional messages and get charged
-#NB: no .delay()
-
-            if not adv.old.package.scmurl:
-                cron_find_homepages(adv.old.package.pk)
-                sleep(10) # give it time to find some URLs
+    query = Advisory.objects.filter(status=STATUS_NEW)
+    for chunk in query.chunked(values_list=['old', 'new', 'last_updated']):
+        versions = PackageVersion.objects.values_in_bulk(
+                        [old for (pk, old, new, last_updated) in chunk] + [new for (pk, old, new, last_updated) in chunk],
+                        'package', 'released_on', 'scmid', 'download_url', 'status'
+                    )
+        packages = Package.objects.values_in_bulk([pv['package'] for pv in versions.values()], 'type', 'scmurl')
 
-            if not adv.old.released_on:
-                pv_find_date(adv.old.pk, PACKAGE_CALLBACKS[adv.old.package.type]['find_date'])
+        for (pk, old_pk, new_pk, last_updated) in chunk:
+            try:
+                old = versions[old_pk]
+                new = versions[new_pk]
+                old_pkg = packages[old['package']]
+                new_pkg = packages[new['package']]
+
+                # try to pupulate missing data. Will move to VERIFIED if all found
+                # NB: automatically collect data only if new advisory is created.
+                # otherwise it's not needed so no need to send additional messages and get charged
+#NB: no .delay()
 
-            if (not adv.old.scmid) or (adv.old.scmid == utils.TAG_NOT_FOUND):
-                pv_find_tags(adv.old.pk, False) # no recursion, only this version
+                # don't wait for the homepage search. NEW advisories
+                # are collected again on the next execution. After the
+                # grace period continue without it and override below
+                if (not old_pkg['scmurl']) and (last_updated > last_time):
+                    cron_find_homepages(old['package'])
+                    continue
 
-            if not adv.old.download_url:
-                pv_find_download_url(adv.old.pk, PACKAGE_CALLBACKS[adv.old.package.type]['get_download_url'])
+                if not (old['released_on'] and old['download_url']):
+                    _pv_resolve(old_pk, old_pkg['type'])
 
-            if not adv.new.released_on:
-                pv_find_date(adv.new.pk, PACKAGE_CALLBACKS[adv.new.package.type]['find_date'])
+                if (not old['scmid']) or (old['scmid'] == utils.TAG_NOT_FOUND):
+                    pv_find_tags(old_pk, False) # no recursion, only this version
 
-            if (not adv.new.scmid) or (adv.new.scmid == utils.TAG_NOT_FOUND):
-                pv_find_tags(adv.new.pk, False) # no recursion, only this version
+                if not (new['released_on'] and new['download_url']):
+                    _pv_resolve(new_pk, new_pkg['type'])
 
-            if not adv.new.download_url:
-                pv_find_download_url(adv.new.pk, PACKAGE_CALLBACKS[adv.new.package.type]['get_download_url'])
+                if (not new['scmid']) or (new['scmid'] == utils.TAG_NOT_FOUND):
+                    pv_find_tags(new_pk, False) # no recursion, only this version
 
-            # found what we could, now generate analytics
+                # found what we could, now generate analytics
 
-            if (adv.old.status == STATUS_VERIFIED) and (adv.new.status == STATUS_VERIFIED):
-                generate_advisory_files.delay(adv.pk)
-            elif (adv.last_updated <= last_time) and  (STATUS_NEW not in [adv.old.status, adv.new.status]):
-                generate_advisory_files.delay(adv.pk, override=True)
+                if (old['status'] == STATUS_VERIFIED) and (new['status'] == STATUS_VERIFIED):
+                    generate_advisory_files.delay(pk)
+                elif (last_updated <= last_time) and  (STATUS_NEW not in [old['status'], new['status']]):
+                    generate_advisory_files.delay(pk, override=True)
 
-        except:
-            logger.error("Exception: %s" % sys.exc_info()[1])
-            logger.error(format_tb(sys.exc_info()[2]))
-            continue
+            except:
+                logger.error("Exception: %s" % sys.exc_info()[1])
+                logger.error(format_tb(sys.exc_info()[2]))
+                continue
 
     reset_queries()
 
@@ -578,6 +797,7 @@ def _compress_data_if_needed(data, path, field_name):
     return data
 
 @task
+@single_instance(['id'])
 def generate_advisory_files(id, ignore_status=False, override=False):
     """
         Generate advisory files.
@@ -605,7 +825,7 @@ def generate_advisory_files(id, ignore_status=False, override=False):
     Advisory.objects.filter(pk=adv.pk).update(status=STATUS_ASSIGNED, last_updated = datetime.now())
 
     cmdline = ""
-    tmpdir = utils.which_tmp_dir()
+    trace = tracing.span('generate_advisory_files', advisory=adv.pk).start()
 
     try:
         pkg_scm_type = adv.old.package.scmtype
@@ -618,9 +838,10 @@ def generate_advisory_files(id, ignore_status=False, override=False):
         magicdir= utils.which_checkout_dir(SCM_SHORT_NAMES[utils.SCM_MAGIC],   adv.old.package.type, adv.old.package.name, adv.pk)
 
         # prepare tarball and API directories
-        utils.checkout_or_pull(tardir, adv.old.package.scmurl, SCM_CLONE_CMD[utils.SCM_TARBALL], SCM_PULL_CMD[utils.SCM_TARBALL])
-        utils.checkout_or_pull(apidir, adv.old.package.scmurl, SCM_CLONE_CMD[utils.SCM_APIGEN], SCM_PULL_CMD[utils.SCM_APIGEN])
-        utils.checkout_or_pull(magicdir, adv.old.package.scmurl, SCM_CLONE_CMD[utils.SCM_APIGEN], SCM_PULL_CMD[utils.SCM_APIGEN]) # just git init
+        with tracing.span('setup'):
+            utils.checkout_or_pull(tardir, adv.old.package.scmurl, SCM_CLONE_CMD[utils.SCM_TARBALL], SCM_PULL_CMD[utils.SCM_TARBALL])
+            utils.checkout_or_pull(apidir, adv.old.package.scmurl, SCM_CLONE_CMD[utils.SCM_APIGEN], SCM_PULL_CMD[utils.SCM_APIGEN])
+            utils.checkout_or_pull(magicdir, adv.old.package.scmurl, SCM_CLONE_CMD[utils.SCM_APIGEN], SCM_PULL_CMD[utils.SCM_APIGEN]) # just git init
 
         version_old = adv.old.scmid
         version_new = adv.new.scmid
@@ -628,32 +849,42 @@ def generate_advisory_files(id, ignore_status=False, override=False):
 
         # download, untar and commit to local git repo if tarball
         # the repo is initialized above with the CLONE_CMD
-        utils.download_extract_commit(adv.old, tardir, adv.old.package.type == PHP_PEAR_PKG)
+        # NB: archives are imported straight into git, the working tree
+        # is populated by the checkout in generate_anything_from_source()
+        tarrepo = GitRepo(tardir)
+
+        with tracing.span('extract_old'):
+            utils.download_extract_commit(adv.old, tardir, adv.old.package.type == PHP_PEAR_PKG, True)
         api_was_generated = False
-        for r in api.generate_anything_from_source(adv.old, tardir, apidir, api.api_gen_callback): # API
-            api_was_generated = api_was_generated or r
-        old_filetypes = api.generate_anything_from_source(adv.old, tardir, magicdir, analytics.filetype_gen_callback) # file types
-        old_filetypes = analytics.normalize_list_of_dict_into_dict(old_filetypes)
-        # count the tests. Use temp dir, nothing will be written there except empty git repo
-        old_tests = api.generate_anything_from_source(adv.old, tardir, mkdtemp(prefix='test_count_old_', dir=tmpdir), analytics.test_case_count_callback)
-        # Get file sizes. Use temp dir, nothing will be written there except empty git repo
-        sizes_old = api.generate_anything_from_source(adv.old, tardir, mkdtemp(prefix='size_old_', dir=tmpdir), analytics.file_size_callback)
-        sizes_old = analytics.normalize_list_of_dict_into_dict(sizes_old)
-
-        utils.download_extract_commit(adv.new, tardir, adv.new.package.type == PHP_PEAR_PKG)
-        for r in api.generate_anything_from_source(adv.new, tardir, apidir, api.api_gen_callback): # API
-            api_was_generated = api_was_generated or r
-        new_filetypes = api.generate_anything_from_source(adv.new, tardir, magicdir, analytics.filetype_gen_callback) # file types
-        new_filetypes = analytics.normalize_list_of_dict_into_dict(new_filetypes)
-        # count the tests. Use temp dir, nothing will be written there except empty git repo
-        new_tests = api.generate_anything_from_source(adv.new, tardir, mkdtemp(prefix='test_count_new_', dir=tmpdir), analytics.test_case_count_callback)
-        # Get file sizes. Use temp dir, nothing will be written there except empty git repo
-        sizes_new = api.generate_anything_from_source(adv.new, tardir, mkdtemp(prefix='size_new_', dir=tmpdir), analytics.file_size_callback)
-        sizes_new = analytics.normalize_list_of_dict_into_dict(sizes_new)
+        with tracing.span('api_old'):
+            for r in api.generate_anything_from_source(adv.old, tardir, apidir, api.api_gen_callback): # API
+                api_was_generated = api_was_generated or r
+        with tracing.span('filetypes_old'):
+            old_filetypes = api.generate_anything_from_source(adv.old, tardir, magicdir, analytics.filetype_gen_callback) # file types
+            old_filetypes = analytics.normalize_list_of_dict_into_dict(old_filetypes)
+        # count the tests and get file sizes from the git tree
+        with tracing.span('tree_old'):
+            old_tree = tarrepo.ls_tree(adv.old.version.replace(" ", "_"))
+            old_tests = analytics.test_cases_from_tree(old_tree)
+            sizes_old = analytics.file_sizes_from_tree(old_tree)
+
+        with tracing.span('extract_new'):
+            utils.download_extract_commit(adv.new, tardir, adv.new.package.type == PHP_PEAR_PKG, True)
+        with tracing.span('api_new'):
+            for r in api.generate_anything_from_source(adv.new, tardir, apidir, api.api_gen_callback): # API
+                api_was_generated = api_was_generated or r
+        with tracing.span('filetypes_new'):
+            new_filetypes = api.generate_anything_from_source(adv.new, tardir, magicdir, analytics.filetype_gen_callback) # file types
+            new_filetypes = analytics.normalize_list_of_dict_into_dict(new_filetypes)
+        # count the tests and get file sizes from the git tree
+        with tracing.span('tree_new'):
+            new_tree = tarrepo.ls_tree(adv.new.version.replace(" ", "_"))
+            new_tests = analytics.test_cases_from_tree(new_tree)
+            sizes_new = analytics.file_sizes_from_tree(new_tree)
 
         # Pull code from upstream
-        # NB: After this function PWD will be changed
-        utils.checkout_or_pull(dirname, adv.old.package.scmurl, SCM_CLONE_CMD[pkg_scm_type], SCM_PULL_CMD[pkg_scm_type])
+        with tracing.span('checkout'):
+            utils.checkout_or_pull(dirname, adv.old.package.scmurl, SCM_CLONE_CMD[pkg_scm_type], SCM_PULL_CMD[pkg_scm_type])
 
 
         # tag names match pv.version
@@ -665,43 +896,46 @@ def generate_advisory_files(id, ignore_status=False, override=False):
             version_old = api_version_old
             version_new = api_version_new
 
-        # if changelog is specified and exists use it. otherwise try to find it
-        if changelog_file and (changelog_file != 'None'): # os.path.exists(dirname + '/' + changelog_file):
-            pass
-        elif changelog_file == 'None':
-            changelog_file = None
-        elif pkg_scm_type != utils.SCM_METACPAN: # metacpan doesn't checkout source so find always fails
-            search_dir = dirname
-            if adv.old.package.subpackage_path:
-                search_dir = os.path.join(search_dir, adv.old.package.subpackage_path)
-            changelog_file = utils.which_changelog(utils.files_in_dir(search_dir))
-
-        # First compile the changelog text from diff for the Changelog file
-        if changelog_file and SCM_DIFF_CHANGELOG_CMD[pkg_scm_type]:
-            cmdline = SCM_DIFF_CHANGELOG_CMD[pkg_scm_type] % (version_old, version_new, changelog_file)
-            proc = subprocess.Popen(cmdline.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=dirname)
-
-            news = proc.communicate()[0]
-            news = _compress_data_if_needed(news, adv.get_path(), 'changelog')
-            # decode after save to S3 and truncate
-            news = news.decode('UTF8', 'replace')
-        else: # No changelog
-            news = utils.INFO_NOT_AVAILABLE
-
-        # in case changelog returns empty string
-        if not news:
-            news = utils.INFO_NOT_AVAILABLE
+        with tracing.span('changelog'):
+            # if changelog is specified and exists use it. otherwise try to find it
+            if changelog_file and (changelog_file != 'None'): # os.path.exists(dirname + '/' + changelog_file):
+                pass
+            elif changelog_file == 'None':
+                changelog_file = None
+            elif pkg_scm_type != utils.SCM_METACPAN: # metacpan doesn't checkout source so find always fails
+                search_dir = dirname
+                if adv.old.package.subpackage_path:
+                    search_dir = os.path.join(search_dir, adv.old.package.subpackage_path)
+                changelog_file = utils.which_changelog(utils.files_in_dir(search_dir))
+
+            # First compile the changelog text from diff for the Changelog file
+            if changelog_file and SCM_DIFF_CHANGELOG_CMD[pkg_scm_type]:
+                cmdline = SCM_DIFF_CHANGELOG_CMD[pkg_scm_type] % (version_old, version_new, changelog_file)
+                proc = subprocess.Popen(cmdline.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=dirname)
+
+                news = proc.communicate()[0]
+                news = _compress_data_if_needed(news, adv.get_path(), 'changelog')
+                # decode after save to S3 and truncate
+                news = news.decode('UTF8', 'replace')
+            else: # No changelog
+                news = utils.INFO_NOT_AVAILABLE
+
+            # in case changelog returns empty string
+            if not news:
+                news = utils.INFO_NOT_AVAILABLE
 
         # calculate change rate based on total size changes.
-        if adv.old.size is None:
-            old_size = utils.get_size(adv.old.download_url)
-            adv.old.size = old_size # temp assign, b/c not .save()'d
-            PackageVersion.objects.filter(pk=adv.old_id).update(size=old_size)
-
-        if adv.new.size is None:
-            new_size = utils.get_size(adv.new.download_url)
-            adv.new.size = new_size # temp assign, b/c not .save()'d
-            PackageVersion.objects.filter(pk=adv.new_id).update(size=new_size)
+        # NB: the archives were downloaded above, no need for the network
+        with tracing.span('size'):
+            if adv.old.size is None:
+                old_size = utils.get_package_version_size(adv.old)
+                adv.old.size = old_size # temp assign, b/c not .save()'d
+                PackageVersion.objects.filter(pk=adv.old_id).update(size=old_size)
+
+            if adv.new.size is None:
+                new_size = utils.get_package_version_size(adv.new)
+                adv.new.size = new_size # temp assign, b/c not .save()'d
+                PackageVersion.objects.filter(pk=adv.new_id).update(size=new_size)
 
         change_rate = utils.change_rate(adv.new.size, adv.old.size)
         severity = utils.which_severity(change_rate)
@@ -721,19 +955,20 @@ def generate_advisory_files(id, ignore_status=False, override=False):
                 overriden = override
             )
 
-        cmdline = None
-        if adv.old.package.subpackage_path and SCM_LOG_PATH_CMD[pkg_scm_type]:
-            cmdline = SCM_LOG_PATH_CMD[pkg_scm_type] % (version_old, version_new, adv.old.package.subpackage_path)
-        elif SCM_LOG_CMD[pkg_scm_type]:
-            cmdline = SCM_LOG_CMD[pkg_scm_type] % (version_old, version_new)
-
-        if cmdline is not None:
-            changelog = subprocess.Popen(cmdline.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=dirname).communicate()[0]
-            changelog = _compress_data_if_needed(changelog, adv.get_path(), 'commit_log')
-            # decode after save to S3 and truncate
-            changelog = changelog.decode('UTF8', 'replace')
-        else:
-            changelog = utils.INFO_NOT_AVAILABLE
+        with tracing.span('commit_log'):
+            cmdline = None
+            if adv.old.package.subpackage_path and SCM_LOG_PATH_CMD[pkg_scm_type]:
+                cmdline = SCM_LOG_PATH_CMD[pkg_scm_type] % (version_old, version_new, adv.old.package.subpackage_path)
+            elif SCM_LOG_CMD[pkg_scm_type]:
+                cmdline = SCM_LOG_CMD[pkg_scm_type] % (version_old, version_new)
+
+            if cmdline is not None:
+                changelog = subprocess.Popen(cmdline.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=dirname).communicate()[0]
+                changelog = _compress_data_if_needed(changelog, adv.get_path(), 'commit_log')
+                # decode after save to S3 and truncate
+                changelog = changelog.decode('UTF8', 'replace')
+            else:
+                changelog = utils.INFO_NOT_AVAILABLE
 
         # store commit log into S3
         file_path = _create_json_file(adv.pk, adv.get_path(), 'commit_log', changelog)
@@ -742,164 +977,168 @@ def generate_advisory_files(id, ignore_status=False, override=False):
         try:
             more = { 'tests' : [] }
 
-            ### API diff test
-            skip_api_url = False
-            # avoid "100% compatibility" message for unsupported languages where API is missing
-            if api_was_generated:
-                (severity, api_diff) = analytics.api_diff(apidir, api_version_old, api_version_new)
-            else:
-                api_diff = utils.INFO_NOT_AVAILABLE
-                skip_api_url = True
-
-            # store api_diff into S3
-            api_diff_path = _create_json_file(adv.pk, adv.get_path(), 'api_diff', api_diff)
-
-            ### API diff stats test
-            if api_diff == utils.INFO_NO_API_DIFF_FOUND:
-                text = utils.INFO_NO_API_DIFF_FOUND
-                skip_api_url = True
-            else:
-                (severity, text) = analytics.diff_stats(utils.SCM_APIGEN, apidir, api_version_old, api_version_new, True, adv.old.package.subpackage_path)
-
-            test_name = "API diff"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
-            if not skip_api_url:
-                more[test_name]['u'] = api_diff_path
-
-            ### FULL DIFF
-            (severity, diff) = analytics.full_diff(pkg_scm_type, dirname, version_old, version_new, adv.old.package.subpackage_path)
-            diff = _compress_data_if_needed(diff, adv.get_path(), 'diff')
-            # store full_diff into S3
-            diff = diff.decode('UTF8', 'replace') # decode after bzipping b/c compress fails otherwise
-            full_diff_path = _create_json_file(adv.pk, adv.get_path(), 'full_diff', diff)
-
-            ### FULL DIFF stats test
-            (severity, text) = analytics.diff_stats(pkg_scm_type, dirname, version_old, version_new, True, adv.old.package.subpackage_path)
-            test_name = "Full diff"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,  # 3 files changed, etc.
-                'u' : full_diff_path,
-            }
+            with tracing.span('api_diff'):
+                ### API diff test
+                skip_api_url = False
+                # avoid "100% compatibility" message for unsupported languages where API is missing
+                if api_was_generated:
+                    (severity, api_diff) = analytics.api_diff(apidir, api_version_old, api_version_new)
+                else:
+                    api_diff = utils.INFO_NOT_AVAILABLE
+                    skip_api_url = True
 
+                # store api_diff into S3
+                api_diff_path = _create_json_file(adv.pk, adv.get_path(), 'api_diff', api_diff)
 
-            ### Package size change
-            (severity, text) = analytics.package_size_change(adv)
-            test_name = "Package Size Change"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
-
-            ### File size changes
-            (severity, text) = analytics.file_size_changes(sizes_old, sizes_new)
-            test_name = "File Size Change"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
+                ### API diff stats test
+                if api_diff == utils.INFO_NO_API_DIFF_FOUND:
+                    text = utils.INFO_NO_API_DIFF_FOUND
+                    skip_api_url = True
+                else:
+                    (severity, text) = analytics.diff_stats(utils.SCM_APIGEN, apidir, api_version_old, api_version_new, True, adv.old.package.subpackage_path)
+
+                test_name = "API diff"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
+                if not skip_api_url:
+                    more[test_name]['u'] = api_diff_path
+
+            with tracing.span('full_diff'):
+                ### FULL DIFF
+                (severity, diff) = analytics.full_diff(pkg_scm_type, dirname, version_old, version_new, adv.old.package.subpackage_path)
+                diff = _compress_data_if_needed(diff, adv.get_path(), 'diff')
+                # store full_diff into S3
+                diff = diff.decode('UTF8', 'replace') # decode after bzipping b/c compress fails otherwise
+                full_diff_path = _create_json_file(adv.pk, adv.get_path(), 'full_diff', diff)
+
+                ### FULL DIFF stats test
+                (severity, text) = analytics.diff_stats(pkg_scm_type, dirname, version_old, version_new, True, adv.old.package.subpackage_path)
+                test_name = "Full diff"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,  # 3 files changed, etc.
+                    'u' : full_diff_path,
+                }
+
+
+            with tracing.span('file_tests'):
+                ### Package size change
+                (severity, text) = analytics.package_size_change(adv)
+                test_name = "Package Size Change"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
+
+                ### File size changes
+                (severity, text) = analytics.file_size_changes(sizes_old, sizes_new)
+                test_name = "File Size Change"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
 
 ### TODO: remove API diff and Full diff from the public template when launching subscriptions
 
-            ### FILE LIST TESTS
-
-            ### Added non-text files
-            (severity, text) = analytics.added_non_text_files(old_filetypes, new_filetypes)
-            test_name = "Added non-text Files"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
-
-
-            ### Modified files test
-            # NB: tarball dir tags versions the same way api dir does
-            (severity, text) = analytics.list_modified_files(tardir, api_version_old, api_version_new)
-            test_name = "Modified Files"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
-
-            ### File list changes
-            (severity, file_list) = analytics.get_file_list_changes(tardir, api_version_old, api_version_new)
-
-            ### Added files
-            (severity, text) = analytics.filter_added_files(file_list)
-            test_name = "Added Files"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
-
-
-            ### Removed files
-            (severity, text) = analytics.filter_removed_files(file_list)
-            test_name = "Removed Files"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
-
-            ### Renamed files
-            (severity, text) = analytics.filter_renamed_files(file_list)
-            test_name = "Renamed Files"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
-
-            ### File permissions change
-            (severity, text) = analytics.filter_permission_change(file_list)
-            test_name = "Permissions Change"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
-
-
-            ### Symlinks 
-            (severity, text) = analytics.symlinks_test(tardir) # NB: tardir has cheched out the NEW version
-            test_name = "Symlinks"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
-
-            ### File types change test
-            (severity, text) = analytics.file_types_diff(magicdir, api_version_old, api_version_new)
-            test_name = "File Types Change"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
-
-
-            ### Virus scan
-            (severity, text) = analytics.virus_scan(tardir)
-            (severity, text) = analytics.parse_virus_scan(text) # returns all text w/ Infected files: X at the top
-
-            test_name = "Virus Scan"
-            more['tests'].append(test_name)
-            more[test_name] = {
-                's' : severity,
-                't' : text,
-            }
+                ### FILE LIST TESTS
+
+                ### Added non-text files
+                (severity, text) = analytics.added_non_text_files(old_filetypes, new_filetypes)
+                test_name = "Added non-text Files"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
+
+
+                ### Modified files test
+                # NB: tarball dir tags versions the same way api dir does
+                (severity, text) = analytics.list_modified_files(tardir, api_version_old, api_version_new)
+                test_name = "Modified Files"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
+
+                ### File list changes
+                (severity, file_list) = analytics.get_file_list_changes(tardir, api_version_old, api_version_new)
+
+                ### Added files
+                (severity, text) = analytics.filter_added_files(file_list)
+                test_name = "Added Files"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
+
+
+                ### Removed files
+                (severity, text) = analytics.filter_removed_files(file_list)
+                test_name = "Removed Files"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
+
+                ### Renamed files
+                (severity, text) = analytics.filter_renamed_files(file_list)
+                test_name = "Renamed Files"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
+
+                ### File permissions change
+                (severity, text) = analytics.filter_permission_change(file_list)
+                test_name = "Permissions Change"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
+
+
+                ### Symlinks 
+                (severity, text) = analytics.symlinks_test(tardir) # NB: tardir has cheched out the NEW version
+                test_name = "Symlinks"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
+
+                ### File types change test
+                (severity, text) = analytics.file_types_diff(magicdir, api_version_old, api_version_new)
+                test_name = "File Types Change"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
+
+
+            with tracing.span('virus_scan'):
+                ### Virus scan
+                (severity, text) = analytics.virus_scan(tardir)
+                (severity, text) = analytics.parse_virus_scan(text) # returns all text w/ Infected files: X at the top
+
+                test_name = "Virus Scan"
+                more['tests'].append(test_name)
+                more[test_name] = {
+                    's' : severity,
+                    't' : text,
+                }
 
 
             ### Test case count
@@ -930,9 +1169,19 @@ def generate_advisory_files(id, ignore_status=False, override=False):
         shutil.rmtree(apidir, True)
         shutil.rmtree(magicdir, True)
 
+        # store the timings next to more.json
+        trace.stop()
+        try:
+            _create_json_file(adv.pk, adv.get_path(), 'timings', trace.summary(), False) # don't escape
+        except:
+            logger.error("Exception: %s" % sys.exc_info()[1])
+            logger.error(format_tb(sys.exc_info()[2]))
+
     reset_queries()
 
 @task
+@single_instance(['id'])
+@traced(['id'])
 def find_bugs(id, changelog = None, commit_log = None):
     """
         Find bugs.
@@ -998,19 +1247,29 @@ def find_bugs(id, changelog = None, commit_log = None):
 
 
         bug_format_str = adv.old.package.bugurl or 'http://example.com/%d'
-
-        for b in bug_nums:
-            try:
-                url = bug_format_str % b
+        bug_type = adv.old.package.bugtype
+
+        with tracing.span('api'):
+            # query the tracker API for all bugs at once where possible,
+            # whatever is not found there is scraped from HTML below
+            api_info = bugs.get_title_and_dates_from_api(bug_format_str, bug_nums, bug_type)
+
+        with tracing.span('scrape'):
+            for b in bug_nums:
+                try:
+                    url = bug_format_str % b
+                    if api_info.has_key(b):
+                        (title, reported_on, closed_on) = api_info[b]
+                    else:
 # TODO: skip fetch_page if in DB
-                page = utils.fetch_page(url)
-                (title, reported_on, closed_on) = bugs.extract_title_and_dates_from_html(page, adv.old.package.bugtype)
-                Bug.objects.get_or_create(advisory=adv, number=b, url=url, title=title, context=bug_dict[b], reported_on=reported_on, closed_on=closed_on)
-            except:
-                logger.error("Failed to get info for bug %d: %s" % (b, sys.exc_info()[1]))
-                logger.error(format_tb(sys.exc_info()[2]))
-                Bug.objects.get_or_create(advisory=adv, number=b, url=url, title="FAILED: %s" % sys.exc_info()[1], context=bug_dict[b])
-                continue
+                        page = utils.fetch_page(url)
+                        (title, reported_on, closed_on) = bugs.extract_title_and_dates_from_html(page, bug_type)
+                    Bug.objects.get_or_create(advisory=adv, number=b, url=url, title=title, context=bug_dict[b], reported_on=reported_on, closed_on=closed_on)
+                except:
+                    logger.error("Failed to get info for bug %d: %s" % (b, sys.exc_info()[1]))
+                    logger.error(format_tb(sys.exc_info()[2]))
+                    Bug.objects.get_or_create(advisory=adv, number=b, url=url, title="FAILED: %s" % sys.exc_info()[1], context=bug_dict[b])
+                    continue
 
         Advisory.objects.filter(
                 pk=adv.pk
@@ -1034,22 +1293,218 @@ def cron_move_advisories_to_live():
     """
     logger = cron_move_advisories_to_live.get_logger()
 
-    logger.info("Moving advisories to LIVE")
+    logger.info("Moving advisories to LIVE")
+
+    query = Advisory.objects.filter(status=STATUS_PUSH_READY)
+
+    for adv in query:
+        # go through all apps which currently have this package installed
+        # and update them.
+#todo: if 1 app has 2 updates released together this will update status and cache twice
+        for inst in InstalledPackage.objects.filter(application__gt=0, version=adv.old_id).only('application'):
+            update_application_status.delay(inst.application, APP_STATUS_NEEDSUPDATE)
+
+    # move to LIVE
+    affected = query.update(status=STATUS_LIVE)
+
+    if affected > 0:
+        generate_static_pages.delay()
+
+    reset_queries()
+
+@task
+def cron_report_slow_hosts(limit = 10):
+    """
+        Log the hosts and endpoints with the most time spent in
+        utils.fetch_page() during the previous metrics period.
+        Needs the 'cache' metrics sink. Executed by CRON.
+
+        @limit - int - how many hosts and endpoints to report
+
+        @return - dict - the report, see metrics.slowest()
+    """
+    logger = cron_report_slow_hosts.get_logger()
+
+    report = {
+        'hosts' : metrics.slowest('http.', limit),
+        'endpoints' : metrics.slowest('http_endpoint.', limit),
+    }
+
+    for kind in ['hosts', 'endpoints']:
+        logger.info("Slowest %s" % kind)
+        for item in report[kind]:
+            logger.info("%(name)s requests=%(requests)d total=%(total).1fs average=%(average)dms p90=%(p90)sms errors=%(errors)d redirects=%(redirects)d not_modified=%(not_modified)d/%(conditional)d bytes=%(bytes)d" % item)
+
+    return report
+
+
+# how far back to go when the CPAN index is empty
+CPAN_INDEX_INITIAL_DAYS = 30
+
+# distributions per search request
+CPAN_INDEX_DISTRIBUTIONS = 50
+
+def _index_cpan_releases(releases):
+    """
+        Save releases returned by cpan.search_releases() which
+        are not in the index yet.
+
+        @return - int - how many were added
+    """
+    added = 0
+
+    for chunk in chunks(releases):
+        existing = set(CpanRelease.objects.filter(
+                            distribution__in=set([r['distribution'] for r in chunk])
+                        ).values_list('distribution', 'version'))
+
+        new = []
+        for r in chunk:
+            if not (r['author'] and r['distribution'] and r['version'] and r['date']):
+                continue
+
+            if (r['distribution'], r['version']) in existing:
+                continue
+
+            try:
+                released_on = datetime.strptime(r['date'][:19], '%Y-%m-%dT%H:%M:%S')
+            except ValueError:
+                continue
+
+            existing.add((r['distribution'], r['version']))
+            new.append(CpanRelease(
+                            author=r['author'],
+                            distribution=r['distribution'],
+                            version=r['version'],
+                            released_on=released_on,
+                            download_url=r['download_url'] or '',
+                            maturity=r['maturity'] or 'released',
+                        ))
+
+        CpanRelease.objects.bulk_create(new)
+        added += len(new)
+
+    return added
+
+@task
+@single_instance([], timeout=3600)
+def cron_refresh_cpan_index():
+    """
+        Update the local index of CPAN releases, see CpanRelease.
+        Adds the releases uploaded since the last execution and all
+        releases of installed Perl packages which are not indexed yet.
+        Uses bulk searches instead of one request per release.
+        Executed by CRON.
+    """
+    logger = cron_refresh_cpan_index.get_logger()
+
+    try:
+        since = CpanRelease.objects.aggregate(Max('released_on'))['released_on__max']
+        if since is None:
+            since = datetime.now() - timedelta(days=CPAN_INDEX_INITIAL_DAYS)
+
+        query = 'date:[%s TO *]' % since.strftime('%Y-%m-%dT%H:%M:%S')
+        added = _index_cpan_releases(cpan.search_releases(query))
+        logger.info("Indexed %d new CPAN releases since %s" % (added, since))
+
+        # installed Perl packages which are not indexed yet
+        names = Package.objects.filter(
+                        type=PERL_CPAN_PKG,
+                        pk__in=InstalledPackage.objects.values('package')
+                    ).values_list('name', flat=True)
+        distributions = set([cpan._other_name(name).replace('::', '-') for name in names])
+
+        missing = []
+        for chunk in chunks(sorted(distributions)):
+            indexed = CpanRelease.objects.filter(distribution__in=chunk).values_list('distribution', flat=True).distinct()
+            missing += list(set(chunk) - set(indexed))
+
+        for chunk in chunks(missing, CPAN_INDEX_DISTRIBUTIONS):
+            query = 'distribution:(%s)' % ' OR '.join(['"%s"' % d for d in chunk])
+            added = _index_cpan_releases(cpan.search_releases(query))
+            logger.info("Indexed %d CPAN releases for %d distributions" % (added, len(chunk)))
+    except:
+        logger.error("Exception: %s" % sys.exc_info()[1])
+        logger.error(format_tb(sys.exc_info()[2]))
+
+    reset_queries()
+
+
+# search.maven.org is updated some time after the upload. Ask again
+# for versions without a release date which are not older than that
+MAVEN_INDEX_RETRY_DAYS = 30
+
+def _maven_metadata(package, last_modified):
+    """
+        mavencentral.get_metadata() which returns None on errors
+        to skip the package, e.g. metadata not published.
+    """
+    try:
+        return mavencentral.get_metadata(package, last_modified)
+    except:
+        return None
+
+@task
+@single_instance([], timeout=3600)
+def cron_refresh_maven_index():
+    """
+        Update the local index of Maven versions, see MavenVersion.
+        Reads maven-metadata.xml of every installed Java package using
+        conditional GET and queries search.maven.org for the release
+        dates of new versions in batches. Versions which search.maven.org
+        didn't know yet are asked for again. Executed by CRON.
+    """
+    logger = cron_refresh_maven_index.get_logger()
+
+    retry_since = datetime.now() - timedelta(days=MAVEN_INDEX_RETRY_DAYS)
+
+    query = Package.objects.filter(type=JAVA_MAVEN_PKG, pk__in=InstalledPackage.objects.values('package'))
+    names = sorted(set(query.values_list('name', flat=True)))
 
-    query = Advisory.objects.filter(status=STATUS_PUSH_READY)
+    for chunk in chunks(names, batch.BATCH_SIZE):
+        try:
+            # when was each package indexed for the last time
+            last_indexed = {}
+            for row in MavenVersion.objects.filter(package__in=chunk).values('package').annotate(last=Max('added_on')).order_by():
+                last_indexed[row['package']] = row['last']
+
+            results = batch.run(_maven_metadata, [(name, last_indexed.get(name)) for name in chunk])
+
+            # versions which are not indexed yet
+            indexed = set(MavenVersion.objects.filter(package__in=chunk).values_list('package', 'version'))
+            gavs = []
+            for (name, (metadata, error)) in zip(chunk, results):
+                if not metadata: # not modified or failed
+                    continue
+
+                gavs += [(name, v) for v in metadata['versions'] if (name, v) not in indexed]
+
+            # indexed versions without a date, regardless of the metadata
+            undated = list(MavenVersion.objects.filter(
+                                    package__in=chunk,
+                                    released_on__isnull=True,
+                                    added_on__gte=retry_since
+                                ).values_list('package', 'version'))
+
+            if not (gavs or undated):
+                continue
 
-    for adv in query:
-        # go through all apps which currently have this package installed
-        # and update them.
-#todo: if 1 app has 2 updates released together this will update status and cache twice
-        for inst in InstalledPackage.objects.filter(application__gt=0, version=adv.old_id).only('application'):
-            update_application_status.delay(inst.application, APP_STATUS_NEEDSUPDATE)
+            dates = mavencentral.search_release_dates(gavs + undated)
+            MavenVersion.objects.bulk_create([
+                            MavenVersion(package=name, version=v, released_on=dates.get((name, v)))
+                            for (name, v) in gavs
+                        ])
 
-    # move to LIVE
-    affected = query.update(status=STATUS_LIVE)
+            dated = 0
+            for (name, v) in undated:
+                if dates.has_key((name, v)):
+                    MavenVersion.objects.filter(package=name, version=v).update(released_on=dates[(name, v)])
+                    dated += 1
 
-    if affected > 0:
-        generate_static_pages.delay()
+            logger.info("Indexed %d Maven versions, found the date of %d more" % (len(gavs), dated))
+        except:
+            logger.error("Exception: %s" % sys.exc_info()[1])
+            logger.error(format_tb(sys.exc_info()[2]))
 
     reset_queries()
 
@@ -1274,18 +1729,29 @@ def cron_search_dates(id = None):
     if not id:
         query = query.filter(released_on__isnull=True)
         # only installed PVs
-        query = query.filter(pk__in=set(inst.version for inst in InstalledPackage.objects.only('version').distinct()))
+        query = query.filter(pk__in=InstalledPackage.objects.values('version'))
     else:
         query = query.filter(pk=id)
 
-    for pv in query.only('package'):
-        pkg = Package.objects.filter(pk=pv.package_id).only('type')[0]
-        pv_find_date.delay(pv.pk, PACKAGE_CALLBACKS[pkg.type]['find_date'])
+    for chunk in query.chunked(values_list=['package']):
+        packages = Package.objects.values_in_bulk([pkg_id for (pk, pkg_id) in chunk], 'type')
+
+        for (pk, pkg_id) in chunk:
+            find_date_func = PACKAGE_CALLBACKS[packages[pkg_id]['type']]['find_date']
+            countdown = throttle.reserve(throttle.bucket_for_callback(find_date_func))
+            if countdown is None: # searched on the next execution
+                continue
+
+            pv_find_date.apply_async(
+                                args=[pk, find_date_func],
+                                countdown=countdown
+                            )
 
     reset_queries()
 
 
 @task
+@single_instance(['id'], dedup=600)
 def pv_find_date(id, find_date_func):
     """
         Fetch the date for individual PackageVersion and save to DB.
@@ -1346,17 +1812,28 @@ def cron_find_download_url(id = None):
     if not id:
         query = query.filter(download_url__isnull=True)
         # only installed PVs
-        query = query.filter(pk__in=set(inst.version for inst in InstalledPackage.objects.only('version').distinct()))
+        query = query.filter(pk__in=InstalledPackage.objects.values('version'))
     else:
         query = query.filter(pk=id)
 
-    for pv in query.only('package'):
-        pkg = Package.objects.filter(pk=pv.package_id).only('type')[0]
-        pv_find_download_url.delay(pv.pk, PACKAGE_CALLBACKS[pkg.type]['get_download_url'])
+    for chunk in query.chunked(values_list=['package']):
+        packages = Package.objects.values_in_bulk([pkg_id for (pk, pkg_id) in chunk], 'type')
+
+        for (pk, pkg_id) in chunk:
+            find_url_func = PACKAGE_CALLBACKS[packages[pkg_id]['type']]['get_download_url']
+            countdown = throttle.reserve(throttle.bucket_for_callback(find_url_func))
+            if countdown is None: # searched on the next execution
+                continue
+
+            pv_find_download_url.apply_async(
+                                args=[pk, find_url_func],
+                                countdown=countdown
+                            )
 
     reset_queries()
 
 @task
+@single_instance(['id'], dedup=600)
 def pv_find_download_url(id, find_url_func):
     """
         Fetch the download URL for individual PackageVersion and save to DB.
@@ -1407,6 +1884,101 @@ def pv_find_download_url(id, find_url_func):
     reset_queries()
 
 
+@task
+@single_instance(['id'], dedup=600)
+def pv_resolve(id, resolve_func):
+    """
+        Fetch the release date, download URL, size and checksum for individual
+        PackageVersion using a single request and save the missing ones to DB
+        with a single UPDATE.
+
+        @resolve_func - the resolve_version callback
+
+        @return - dict - released_on, download_url and package urls or None
+    """
+
+    logger = pv_resolve.get_logger()
+
+    try:
+        pv = PackageVersion.objects.filter(id=id).select_related('package')[0]
+    except IndexError:
+        reset_queries()
+        return None
+
+    released_on = pv.released_on
+    # placeholder date, see pv_find_date
+    if released_on == datetime(2001, 01, 01):
+        released_on = None
+
+    result = {
+        'released_on' : released_on,
+        'download_url' : pv.download_url,
+        'urls' : None,
+    }
+
+    logger.info('Will resolve %s' % pv)
+
+    try:
+        found = resolve_func(pv.package.name, pv.version)
+        result['urls'] = found['urls']
+
+        missing = {
+            'released_on' : released_on,
+            'download_url' : pv.download_url,
+            'size' : pv.size,
+            'checksum' : pv.checksum,
+        }
+
+        values = {}
+        for field in missing.keys():
+            if (not missing[field]) and found[field]:
+                values[field] = found[field]
+
+        if values:
+            # don't overwrite ASSIGNED or VERIFIED
+            if pv.status < STATUS_ASSIGNED:
+                values['status'] = STATUS_MODIFIED
+
+            PackageVersion.objects.filter(id=id).update(**values)
+            logger.info('Found %s for %s' % (', '.join(sorted(values.keys())), pv))
+
+            result.update(values)
+            move_package_version_to_verified(pv.pk)
+    except:
+        logger.error("Exception: %s" % sys.exc_info()[1])
+        logger.error(format_tb(sys.exc_info()[2]))
+
+    reset_queries()
+    return result
+
+def _pv_resolve(id, pkg_type):
+    """
+        Populate missing release date, download URL, size and checksum
+        for a PackageVersion. Uses resolve_version if the registry supports it
+        and the separate callbacks for what is still missing,
+        e.g. versions built from a GitHub commit. NB: no delay.
+
+        @id - PackageVersion id
+        @pkg_type - int - Package.type
+
+        @return - dict - homepage, repo, bugtracker URLs or None
+    """
+    callbacks = PACKAGE_CALLBACKS[pkg_type]
+
+    result = {}
+    if callbacks['resolve_version']:
+        # None if the same version is being resolved right now
+        result = pv_resolve(id, callbacks['resolve_version']) or {}
+
+    if not result.get('released_on'):
+        pv_find_date(id, callbacks['find_date'])
+
+    if not result.get('download_url'):
+        pv_find_download_url(id, callbacks['get_download_url'])
+
+    return result.get('urls')
+
+
 @task
 def cron_find_tags(id = None):
     """
@@ -1421,17 +1993,20 @@ def cron_find_tags(id = None):
         # search where field is None, "" or "TAG-NOT-FOUND"
         query = query.filter(Q(scmid__isnull=True) | Q(scmid="") | Q(scmid=utils.TAG_NOT_FOUND), package__scmtype__gt=utils.SCM_UNKNOWN)
         # only installed PVs
-        query = query.filter(pk__in=set(inst.version for inst in InstalledPackage.objects.only('version').distinct()))
+        query = query.filter(pk__in=InstalledPackage.objects.values('version'))
     else:
         query = query.filter(id=id)
 
-    for pv in query.only('pk'):
-        pv_find_tags.delay(pv.pk)
+    for chunk in query.chunked(values_list=[]):
+        for (pk,) in chunk:
+            pv_find_tags.delay(pk)
 
     reset_queries()
 
 
 @task
+@single_instance(['id', 'search_others'], dedup=600)
+@traced(['id'])
 def pv_find_tags(id, search_others=False):
     """
         Fetch tags for individual PackageVersion and save to DB
@@ -1459,36 +2034,37 @@ def pv_find_tags(id, search_others=False):
         vtag = "" # silence DB if no tags found
         pkg_scm_type = pv.package.scmtype
 
-        # traditional SCM types
-        if pv.package.website:
-            if pv.package.website.find('github.com') > -1:
-                tags = github.get_tags(pv.package.website)
-            elif pv.package.website.find('bitbucket.org') > -1:
-                tags = bitbucket.get_tags(pv.package.website)
+        with tracing.span('hosted'):
+            # traditional SCM types
+            if pv.package.website:
+                if pv.package.website.find('github.com') > -1:
+                    tags = github.get_tags(pv.package.website)
+                elif pv.package.website.find('bitbucket.org') > -1:
+                    tags = bitbucket.get_tags(pv.package.website)
 
-        if (not tags) and pv.package.scmurl:
-            if pv.package.scmurl.find('github.com') > -1:
-                tags = github.get_tags(pv.package.scmurl)
-            elif pv.package.scmurl.find('bitbucket.org') > -1:
-                tags = bitbucket.get_tags(pv.package.scmurl)
+            if (not tags) and pv.package.scmurl:
+                if pv.package.scmurl.find('github.com') > -1:
+                    tags = github.get_tags(pv.package.scmurl)
+                elif pv.package.scmurl.find('bitbucket.org') > -1:
+                    tags = bitbucket.get_tags(pv.package.scmurl)
 
 
-        if (not tags) and SCM_LIST_TAGS_CMD[pkg_scm_type]: # Generic Git/Mercurial/Bzr
-            dirname = utils.which_checkout_dir(SCM_SHORT_NAMES[pkg_scm_type], pv.package.type, pv.package.name)
+        with tracing.span('scm'):
+            if (not tags) and SCM_LIST_TAGS_CMD[pkg_scm_type]: # Generic Git/Mercurial/Bzr
+                dirname = utils.which_checkout_dir(SCM_SHORT_NAMES[pkg_scm_type], pv.package.type, pv.package.name)
 
-            # NB: After this function PWD will be changed
-            utils.checkout_or_pull(dirname, pv.package.scmurl, SCM_CLONE_CMD[pkg_scm_type], SCM_PULL_CMD[pkg_scm_type])
+                utils.checkout_or_pull(dirname, pv.package.scmurl, SCM_CLONE_CMD[pkg_scm_type], SCM_PULL_CMD[pkg_scm_type])
 
-            cmdline = SCM_LIST_TAGS_CMD[pkg_scm_type]
-            proc = subprocess.Popen(cmdline.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=dirname)
-            tags = proc.communicate()[0].split("\n")
+                cmdline = SCM_LIST_TAGS_CMD[pkg_scm_type]
+                proc = subprocess.Popen(cmdline.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=dirname)
+                tags = proc.communicate()[0].split("\n")
 
-            if pkg_scm_type in [utils.SCM_MERCURIAL, utils.SCM_BAZAAR]:
-                # cut the first column
-                new_tags = []
-                for t in tags:
-                    new_tags.append(t.split(' ')[0])
-                tags = new_tags
+                if pkg_scm_type in [utils.SCM_MERCURIAL, utils.SCM_BAZAAR]:
+                    # cut the first column
+                    new_tags = []
+                    for t in tags:
+                        new_tags.append(t.split(' ')[0])
+                    tags = new_tags
 
         # other SCMs
         if (not tags) and (pv.package.scmtype == utils.SCM_METACPAN):
@@ -1512,29 +2088,30 @@ def pv_find_tags(id, search_others=False):
             if pv.package.scmurl.find('github.com') > -1:
                 vtag = commit
 
-        # try to guess the commit sha by examining the changes
-        # NB: don't update vtag to prevent skipping manual inspection
-        if (vtag in ["", utils.TAG_NOT_FOUND]) and (pv.released_on):
-            if (pv.package.scmurl.find('github.com') > -1):
-                candidates = [] # possible sha values where version changed
-
-                user_repo = github._get_user_repo(pv.package.scmurl)
-                commits = github.get_commits_around_date(user_repo, pv.released_on)
-
-                for commit_sha in commits.keys():      # for every commit
-                    for patch in commits[commit_sha]:  # inspect all patches
-                        for line in patch.split('\n'): # and scan all lines
-                            if line.startswith('+') and \
-                                (line.lower().find('version') > -1) and \
-                                (line.find(pv.version) > -1):
-                                candidates.append(commit_sha)
-
-                # avoid automatic move to VERIFIED
-                if len(candidates) == 1:
-                    vtag = None
-                    PackageVersion.objects.filter(id=pv.id).update(scmid=candidates[0], status=STATUS_ASSIGNED)
-                else:
-                    print "DEBUG: find tags", candidates
+        with tracing.span('commits'):
+            # try to guess the commit sha by examining the changes
+            # NB: don't update vtag to prevent skipping manual inspection
+            if (vtag in ["", utils.TAG_NOT_FOUND]) and (pv.released_on):
+                if (pv.package.scmurl.find('github.com') > -1):
+                    candidates = [] # possible sha values where version changed
+
+                    user_repo = github._get_user_repo(pv.package.scmurl)
+                    commits = github.get_commits_around_date(user_repo, pv.released_on)
+
+                    for commit_sha in commits.keys():      # for every commit
+                        for patch in commits[commit_sha]:  # inspect all patches
+                            for line in patch.split('\n'): # and scan all lines
+                                if line.startswith('+') and \
+                                    (line.lower().find('version') > -1) and \
+                                    (line.find(pv.version) > -1):
+                                    candidates.append(commit_sha)
+
+                    # avoid automatic move to VERIFIED
+                    if len(candidates) == 1:
+                        vtag = None
+                        PackageVersion.objects.filter(id=pv.id).update(scmid=candidates[0], status=STATUS_ASSIGNED)
+                    else:
+                        print "DEBUG: find tags", candidates
 
         if vtag:
             # don't overwrite ASSIGNED
@@ -1584,10 +2161,11 @@ def cron_move_package_version_to_verified():
                 scmid=utils.TAG_NOT_FOUND
             )
     # only installed PVs
-    query = query.filter(pk__in=set(inst.version for inst in InstalledPackage.objects.only('version').distinct()))
+    query = query.filter(pk__in=InstalledPackage.objects.values('version'))
 
-    for pv in query.only('pk'):
-        move_package_version_to_verified.delay(pv.pk)
+    for chunk in query.chunked(values_list=[]):
+        for (pk,) in chunk:
+            move_package_version_to_verified.delay(pk)
 
     reset_queries()
 
@@ -1645,12 +2223,26 @@ def cron_helper_notify_app_owners(delay=1):
     end_date = datetime.now()
     start_date = datetime.now() - timedelta(days=delay)
 
-    for user in User.objects.filter(is_active=True).only('pk'):
+    # NB: build the digests once and give every batch its part
+    digests = _digests_for_updates(*_find_owner_updates(start_date, end_date))
+
+    batch = {}
+    for user in User.objects.filter(pk__in=digests.keys(), is_active=True).only('pk'):
         # to avoid importing the UserProfile class
         # which may be defined in a private app
         profile = user.get_profile()
-        if profile.get_email_delay() == delay:
-            notify_app_owner_about_update.delay(user.pk, start_date, end_date, delay)
+        if profile.get_email_delay() != delay:
+            continue
+
+        batch[user.pk] = digests[user.pk]
+        if len(batch) >= DIGEST_BATCH_SIZE:
+            send_update_digests.delay(batch, start_date, end_date, delay)
+            batch = {}
+
+    if batch:
+        send_update_digests.delay(batch, start_date, end_date, delay)
+
+    reset_queries()
 
 @task
 @execute_once_in(3600*24*6)  # once every 6 days
@@ -1669,94 +2261,103 @@ def cron_notify_app_owners_1():
     cron_helper_notify_app_owners(1)
 
 
-@task
-def notify_app_owner_about_update(user_id, start_date, end_date, frequency):
+# digest emails, by frequency
+DIGEST_EMAIL_DATA = {
+    1 : {
+        'subject' : "Latest package updates",
+        'url_prefix' : 'daily',
+    },
+
+    7 : {
+        'subject' : "Weekly package updates",
+        'url_prefix' : 'weekly',
+    },
+}
+
+# how many digests to send over a single SMTP connection
+DIGEST_BATCH_SIZE = 100
+
+def _find_owner_updates(start_date, end_date, owners = None):
     """
-        Notify application owner about pending updates,
-        published between @start_date and @end_date,
-        respecting their email preferences.
+        Find all updates published between @start_date and @end_date
+        and group them by application owner.
 
-        This new version tells people only about new package versions
-        and in which apps are they used; then asks them to login to
-        their dashboard to review the changes, to stimulate more site visits!
+        Advisories are searched once for everybody and then
+        inverted to owners via their installed packages.
 
-        @user_id - int - User.id
         @start_date - timestamp
         @end_date - timestamp
-        @frequencey - int - daily, weekly, etc
+        @owners - list - optional, search only for these User.id
+
+        @return - tuple - ({ owner : { new version : set of affected apps } },
+                           set of all affected apps, set of all new versions)
     """
 
-    logger = notify_app_owner_about_update.get_logger()
+    # build a map of old versions and the new versions which replace them
+    new_versions = {}
+    query = Advisory.objects.filter(
+                            status=STATUS_LIVE,
+                            last_updated__gte=start_date,
+                            last_updated__lte=end_date,
+                        ).only('old', 'new')
 
-    email_data = {
-        1 : {
-            'subject' : "Latest package updates",
-            'url_prefix' : 'daily',
-        },
+    for adv in query:
+        if not new_versions.has_key(adv.old_id):
+            new_versions[adv.old_id] = set()
 
-        7 : {
-            'subject' : "Weekly package updates",
-            'url_prefix' : 'weekly',
-        },
-    }
+        new_versions[adv.old_id].add(adv.new_id)
 
-    try:
-        user = User.objects.filter(id=user_id).only('username', 'first_name')[0]
-    except IndexError:
-        reset_queries()
-        logger.error('No user with id %d' % user_id)
-        return
+    owner_updates = {}
+    all_apps_pks = set() # helper for easier queries later
+    all_new_pks = set()
 
-    if not user.is_active:
-        logger.error('User %s(%d) is not active' % (user, user_id))
-        return
+    if len(new_versions.keys()) <= 0:
+        return (owner_updates, all_apps_pks, all_new_pks)
 
-    if not user.email:
-        logger.error('User %s(%d) does not have email' % (user, user_id))
-        return
+    query = InstalledPackage.objects.filter(
+                                        version__in=new_versions.keys()
+                                    )
+    if owners is not None:
+        query = query.filter(owner__in=owners)
 
-    email = user.email.strip()
-    if email.find("@") == -1:
-        logger.error('User %s(%d) has invalid email' % (user.username, user_id))
-        return
+    for inst in query.only('owner', 'version', 'application'):
+        if not owner_updates.has_key(inst.owner):
+            owner_updates[inst.owner] = {}
 
+        updates = owner_updates[inst.owner]
+        for new_pk in new_versions[inst.version]:
+            if not updates.has_key(new_pk):
+                updates[new_pk] = set()
 
-    # store PKs, to be used later
-    installed_vers = {} # installed versions and their apps
-    all_apps_pks = set() # helper for easier queries later
-    query = InstalledPackage.objects.filter(
-                                        owner=user_id
-                                    ).only(
-                                        'version',
-                                        'application'
-                                    )
-    for inst in query:
-        if not installed_vers.has_key(inst.version):
-            installed_vers[inst.version] = set()
+            updates[new_pk].add(inst.application)
+            all_new_pks.add(new_pk)
 
-        installed_vers[inst.version].add(inst.application)
         all_apps_pks.add(inst.application)
 
+    return (owner_updates, all_apps_pks, all_new_pks)
 
-    # build a map of new versions and corresponding apps
-    new_versions = {}
-    query = Advisory.objects.filter(
-                            old__in=installed_vers.keys(),
-                            status=STATUS_LIVE,
-                            last_updated__gte=start_date,
-                            last_updated__lte=end_date,
-                        ).only('old', 'new')
+def _build_update_digests(start_date, end_date, owners = None):
+    """
+        Build the released items lists for the digest emails.
 
-    for adv in query:
-        if not new_versions.has_key(adv.new_id):
-            new_versions[adv.new_id] = set() # set of affected apps
+        @start_date - timestamp
+        @end_date - timestamp
+        @owners - list - optional, build digests only for these User.id
+
+        @return - dict - { User.id : [ {'nvr' : ..., 'apps' : ...}, ... ] }
+    """
 
-        new_versions[adv.new_id].update(installed_vers[adv.old_id])
+    return _digests_for_updates(*_find_owner_updates(start_date, end_date, owners))
 
+def _digests_for_updates(owner_updates, all_apps_pks, all_new_pks):
+    """
+        Build the released items lists from the result of _find_owner_updates().
 
-    if len(new_versions.keys()) <= 0:
-        logger.info('User %s(%d) does not have any new updates' % (user, user_id))
-        return
+        @return - dict - { User.id : [ {'nvr' : ..., 'apps' : ...}, ... ] }
+    """
+
+    if len(owner_updates.keys()) <= 0:
+        return {}
 
     # fetch app names. these are by definition already approved
     app_name_map = {}
@@ -1771,7 +2372,7 @@ def notify_app_owner_about_update(user_id, start_date, end_date, frequency):
     ver_pkg_pks = set()
 
     # fetch NEW versions as string
-    for ver in PackageVersion.objects.filter(pk__in=new_versions.keys()).only('version', 'package'):
+    for ver in PackageVersion.objects.filter(pk__in=all_new_pks).only('version', 'package'):
         ver_map[ver.pk] = { 'v' : ver.version, 'p' : ver.package_id }
         ver_pkg_pks.add(ver.package_id)
 
@@ -1780,107 +2381,282 @@ def notify_app_owner_about_update(user_id, start_date, end_date, frequency):
         name_map[pkg.pk] = pkg.name
 
 
-    released_items = {}
-    # build a list of released items for the email template
-    for new_pk in new_versions.keys():
-        package_pk = ver_map[new_pk]['p']
-        package_name = name_map[package_pk]
-        new_version = ver_map[new_pk]['v']
-
-        new_release = "%s-%s" % (package_name, new_version) # e.g. Django-1.5.2
-        # figure out which apps use this package
-        apps = []
-        for app in new_versions[new_pk]:
-            apps.append(app_name_map[app])
-        apps.sort()
+    digests = {}
+    for owner in owner_updates.keys():
+        released_items = {}
+        # build a list of released items for the email template
+        for new_pk in owner_updates[owner].keys():
+            package_name = name_map[ver_map[new_pk]['p']]
+            new_version = ver_map[new_pk]['v']
 
-#        print new_release, apps
+            new_release = "%s-%s" % (package_name, new_version) # e.g. Django-1.5.2
+            # figure out which apps use this package
+            apps = []
+            for app in owner_updates[owner][new_pk]:
+                apps.append(app_name_map[app])
+            apps.sort()
 
-        released_items[new_release] = apps
+            released_items[new_release] = apps
 
-    nvrs = released_items.keys()
-    nvrs.sort()
+        nvrs = released_items.keys()
+        nvrs.sort()
 
-    sorted_released_items = []
-    for nvr in nvrs:
-        sorted_released_items.append(
+        digests[owner] = []
+        for nvr in nvrs:
+            digests[owner].append(
                                     {
                                         'nvr' : nvr,
                                         # work around comma issue in templates
-                                        'apps' : ', '.join(released_items[nvr]), 
+                                        'apps' : ', '.join(released_items[nvr]),
                                     }
                                 )
 
+    return digests
+
+def _send_update_digest(logger, user, released_items, start_date, end_date, frequency, connection = None):
+    """
+        Send the update digest email to a single user.
+
+        @logger - the calling task logger
+        @user - User
+        @released_items - list - as returned by _build_update_digests()
+        @connection - email backend connection - optional, reuse it if specified
+
+        @return - bool - True if email was sent
+    """
+
+    if not user.is_active:
+        logger.error('User %s(%d) is not active' % (user, user.pk))
+        return False
+
+    if not user.email:
+        logger.error('User %s(%d) does not have email' % (user, user.pk))
+        return False
+
+    email = user.email.strip()
+    if email.find("@") == -1:
+        logger.error('User %s(%d) has invalid email' % (user.username, user.pk))
+        return False
+
     try:
         send_templated_mail(
             template_name='update_digest',
             from_email="Difio <%s>" % settings.DEFAULT_FROM_EMAIL,
             recipient_list=[email],
             context={
-                'email_subject' : email_data[frequency]['subject'],
+                'email_subject' : DIGEST_EMAIL_DATA[frequency]['subject'],
                 'username': user.username,
                 'full_name': user.first_name,
                 'start_date' : start_date,
                 'end_date' : end_date,
-                'released_items' : sorted_released_items,
+                'released_items' : released_items,
             },
+            connection=connection,
         )
     except:
-        pass
+        logger.error("Can't send notification to %s" % user)
+        logger.error("Exception: %s" % sys.exc_info()[1])
+        logger.error(format_tb(sys.exc_info()[2]))
+        return False
 
     logger.info("Sent notification to %s" % user)
+    return True
+
+@task
+def send_update_digests(digests, start_date, end_date, frequency):
+    """
+        Send update digests to a batch of users over a single SMTP connection.
+
+        @digests - dict - User.id -> released items, see _build_update_digests()
+        @start_date - timestamp
+        @end_date - timestamp
+        @frequencey - int - daily, weekly, etc
+    """
+
+    logger = send_update_digests.get_logger()
+
+    if len(digests.keys()) <= 0:
+        reset_queries()
+        return
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except:
+        logger.error("Exception: %s" % sys.exc_info()[1])
+        logger.error(format_tb(sys.exc_info()[2]))
+        return
+
+    try:
+        query = User.objects.filter(
+                            pk__in=digests.keys()
+                        ).only('username', 'first_name', 'email', 'is_active')
+
+        for user in query:
+            _send_update_digest(logger, user, digests[user.pk], start_date, end_date, frequency, connection)
+    finally:
+        connection.close()
+
+    reset_queries()
+
+@task
+def notify_app_owner_about_update(user_id, start_date, end_date, frequency):
+    """
+        Notify application owner about pending updates,
+        published between @start_date and @end_date,
+        respecting their email preferences.
+
+        This new version tells people only about new package versions
+        and in which apps are they used; then asks them to login to
+        their dashboard to review the changes, to stimulate more site visits!
+
+        NB: digests are sent in batches by send_update_digests(),
+        this task is for a single user.
+
+        @user_id - int - User.id
+        @start_date - timestamp
+        @end_date - timestamp
+        @frequencey - int - daily, weekly, etc
+    """
+
+    logger = notify_app_owner_about_update.get_logger()
+
+    try:
+        user = User.objects.filter(id=user_id).only('username', 'first_name', 'email', 'is_active')[0]
+    except IndexError:
+        reset_queries()
+        logger.error('No user with id %d' % user_id)
+        return
+
+    digests = _build_update_digests(start_date, end_date, [user_id])
+
+    if not digests.has_key(user_id):
+        logger.info('User %s(%d) does not have any new updates' % (user, user_id))
+        reset_queries()
+        return
+
+    _send_update_digest(logger, user, digests[user_id], start_date, end_date, frequency)
     reset_queries()
 
+def _get_installed_state(app_id):
+    """
+        Load the current list of installed packages from the DB.
+
+        @app_id - Application.id
+        @return - set - of "name-version"
+    """
+
+    installed = {}
+    pkg_pks = set()
+    ver_pks = set()
+    for inst in InstalledPackage.objects.filter(application=app_id).only('package', 'version'):
+        installed[inst.version] = inst.package
+        pkg_pks.add(inst.package)
+        ver_pks.add(inst.version)
+
+    name_map = {}
+    for pkg in Package.objects.filter(pk__in=pkg_pks).only('name'):
+        name_map[pkg.pk] = pkg.name
+
+    state = set()
+    for ver in PackageVersion.objects.filter(pk__in=ver_pks).only('version'):
+        if name_map.has_key(installed[ver.pk]):
+            state.add('%s-%s' % (name_map[installed[ver.pk]], ver.version))
+
+    return state
+
+def _get_application_history_state(app_id):
+    """
+        Reconstruct the last recorded package list from the latest
+        snapshot and the deltas recorded after it.
+
+        @app_id - Application.id
+        @return - tuple - (state, count) - state is set of "name-version"
+                  or None if there is no usable snapshot, count is the number
+                  of records after the snapshot
+    """
+
+    # NB: a snapshot is stored at least every APPLICATION_HISTORY_SNAPSHOT_EVERY records
+    query = ApplicationHistory.objects.filter(
+                                        application=app_id
+                                    ).only(
+                                        'packages'
+                                    ).order_by(
+                                        '-when_added'
+                                    )[:APPLICATION_HISTORY_SNAPSHOT_EVERY]
+
+    records = []
+    for record in query:
+        if record.get_data() is None: # old text record
+            return (None, 0)
+
+        records.append(record)
+        if record.is_snapshot():
+            break
+    else:
+        return (None, 0)
+
+    state = set()
+    records.reverse()
+    for record in records:
+        record.apply_to(state)
+
+    return (state, len(records) - 1)
+
 @task
-def generate_application_history_records(app_id, when = None):
+def generate_application_history_records(app_id, when = None, installed = None):
     """
-        After application/package list has been updated store the current state in the DB.
+        After application/package list has been updated store the changes in the DB.
+        Stores the difference against the previous record and a full snapshot
+        every APPLICATION_HISTORY_SNAPSHOT_EVERY records.
 
         @app_id - Application.id
         @when - datetime - optional
-
-TODO: fix slow queries!!!
-TODO: when importing refactor to just save the text of the import (from URL, upload, etc)
+        @installed - set - optional "name-version" of currently installed
+                     packages. Will be loaded from the DB if not specified.
     """
 
-    text = ""
-    name_ver = {}
-    for installed in InstalledPackage.objects.filter(application=app_id).only('package', 'version'):
-        try:
-            package = Package.objects.filter(pk=installed.package).only('name')[0]
-            version = PackageVersion.objects.filter(pk=installed.version).only('version')[0]
-            name_ver['%s-%s' % (package.name, version.version)] = 1
-        except:
-            continue
+    if installed is None:
+        installed = _get_installed_state(app_id)
 
-    # sort by name
-    names = name_ver.keys()
-    names.sort()
-    for n in names:
-        text += "%s\n" % n
+    (previous, count) = _get_application_history_state(app_id)
+
+    if (previous is None) or (count + 1 >= APPLICATION_HISTORY_SNAPSHOT_EVERY):
+        data = { 'snapshot' : sorted(installed) }
+    else:
+        data = {
+            'added' : sorted(installed - previous),
+            'removed' : sorted(previous - installed),
+        }
+
+        if not (data['added'] or data['removed']):
+            reset_queries()
+            return
 
     if when is None:
         when = datetime.now()
 
-    ApplicationHistory.objects.create(application_id=app_id, when_added=when, packages=text)
+    ApplicationHistory.objects.create(application_id=app_id, when_added=when, packages=json.dumps(data))
+    reset_queries()
 
 
 
 @task
-def do_stuff_when_packages_change(app_id):
+def do_stuff_when_packages_change(app_id, installed = None):
     """
         This task is executed always when packages have been changed
 
         @app_id - int - Application identifier
+        @installed - set - optional "name-version" of currently installed packages
     """
 
-#todo: this method utilizes slow queries - fix it
-
     # save the current state into the DB
-    generate_application_history_records(app_id)
+    generate_application_history_records(app_id, installed=installed)
 
 
 @task
+@traced(['app_pk'])
+@query_budget
 def import_application(app_pk, app_uuid, owner_pk, is_manual_import, is_first_import):
     """
         Executed from views.application_register to import packages/versions
@@ -1908,42 +2684,44 @@ def import_application(app_pk, app_uuid, owner_pk, is_manual_import, is_first_im
     latest_installed = []
     new_package = False
 
-    # add packages and versions, already sanitized
-    for n_v_r in data['installed']:
+    with tracing.span('packages'):
+        # add packages and versions, already sanitized
+        for n_v_r in data['installed']:
 
-        if n_v_r.has_key('t'):
-            pkg_type = n_v_r['t']
-        else:
-            pkg_type = data['pkg_type']
+            if n_v_r.has_key('t'):
+                pkg_type = n_v_r['t']
+            else:
+                pkg_type = data['pkg_type']
 
-        try:
-            package = Package.objects.filter(name=n_v_r['n'], type=pkg_type)[0]
-        except IndexError:
-            package = Package.objects.create(name=n_v_r['n'], type=pkg_type)
-            new_package = True
+            try:
+                package = Package.objects.filter(name=n_v_r['n'], type=pkg_type)[0]
+            except IndexError:
+                package = Package.objects.create(name=n_v_r['n'], type=pkg_type)
+                new_package = True
 
-        try:
-            version = PackageVersion.objects.filter(package=package.pk, version=n_v_r['v'])[0]
-        except IndexError:
-            version = PackageVersion.objects.create(package=package, version=n_v_r['v'])
-            new_package = True
+            try:
+                version = PackageVersion.objects.filter(package=package.pk, version=n_v_r['v'])[0]
+            except IndexError:
+                version = PackageVersion.objects.create(package=package, version=n_v_r['v'])
+                new_package = True
 
-        try:
-            installed = InstalledPackage.objects.filter(version=version.pk, application=app_pk)[0]
-        except IndexError:
-            installed = InstalledPackage.objects.create(application=app_pk, owner=owner_pk, version=version.pk, package=package.pk)
-            new_package = True
+            try:
+                installed = InstalledPackage.objects.filter(version=version.pk, application=app_pk)[0]
+            except IndexError:
+                installed = InstalledPackage.objects.create(application=app_pk, owner=owner_pk, version=version.pk, package=package.pk)
+                new_package = True
 
-        latest_installed.append(installed.id) 
+            latest_installed.append(installed.id) 
 
 
-    # delete packages that are no longer present
-    # NB: this needs to be executed last to preserve prior state on errors
-    # in case of errors, just re-push
-    query = InstalledPackage.objects.filter(application=app_pk).exclude(pk__in=latest_installed)
-    if query.count() > 0: # packages have changed
-        query.delete()
-        new_package = True
+    with tracing.span('cleanup'):
+        # delete packages that are no longer present
+        # NB: this needs to be executed last to preserve prior state on errors
+        # in case of errors, just re-push
+        query = InstalledPackage.objects.filter(application=app_pk).exclude(pk__in=latest_installed)
+        if query.count() > 0: # packages have changed
+            query.delete()
+            new_package = True
 
     search_data = True
     if is_first_import:
@@ -1981,8 +2759,13 @@ def import_application(app_pk, app_uuid, owner_pk, is_manual_import, is_first_im
                         last_checkin = datetime.now()
                     )
 
-    if new_package:
-        do_stuff_when_packages_change.delay(app_pk)
+    with tracing.span('packages_changed'):
+        if new_package:
+            # NB: no delay, the package list is already in memory
+            installed = set()
+            for n_v_r in data['installed']:
+                installed.add('%s-%s' % (n_v_r['n'], n_v_r['v']))
+            do_stuff_when_packages_change(app_pk, installed)
 
     # schedule action only for approved apps to avoid double scheduling on register+approve
     if search_data:
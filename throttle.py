@@ -0,0 +1,141 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Cache backed rate limiting for Celery tasks.
+
+    Instead of sleeping inside a worker, callers reserve a slot in a
+    bucket and schedule the task with the returned countdown:
+
+        countdown = throttle.reserve('db')
+        if countdown is None:
+            # bucket is full, leave the rest for the next CRON run
+            break
+        my_task.apply_async(args=[...], countdown=countdown)
+
+    Time is divided in windows of @period seconds and every window holds
+    at most @count reservations. Slots are numbered from the epoch and
+    every bucket is a single cache counter holding the next free slot so
+    a reservation is one atomic increment. Buckets are shared between all
+    workers via the cache.
+"""
+
+import time
+from django.core.cache import cache
+
+# bucket name -> (count, period in seconds)
+DEFAULT_RATE_LIMITS = {
+    # importing new packages, see pv_import_same_pkg_type_from_rss()
+    'db' : (5, 10),
+}
+
+# used for buckets not listed above, e.g. registry hosts
+DEFAULT_RATE_LIMIT = (10, 10)
+
+try:
+    from django.conf import settings
+    RATE_LIMITS = settings.DIFIO_RATE_LIMITS
+except:
+    RATE_LIMITS = {}
+
+# don't schedule further ahead than that many seconds. Must be lower than
+# the broker visibility timeout (1 hour by default for Redis and SQS),
+# otherwise the messages are delivered again before they are executed
+try:
+    from django.conf import settings
+    MAX_COUNTDOWN = settings.DIFIO_THROTTLE_MAX_COUNTDOWN
+except:
+    MAX_COUNTDOWN = 3000
+
+# how long to keep the counter of an idle bucket
+COUNTER_TIMEOUT = 86400
+
+# bucket name -> time until which it is known to be full.
+# Saves cache requests while a sweep skips the remaining items
+_full = {}
+
+def get_rate_limit(name):
+    """
+        @name - string - bucket name
+        @return - tuple - (count, period)
+    """
+    if RATE_LIMITS.has_key(name):
+        return RATE_LIMITS[name]
+
+    return DEFAULT_RATE_LIMITS.get(name, DEFAULT_RATE_LIMIT)
+
+def bucket_for_callback(func):
+    """
+        Upstream sources are implemented in separate modules, e.g.
+        pypi.get_latest, metacpan.get_url. Use the module name as
+        the bucket name so every registry is limited on its own.
+
+        @func - callable
+        @return - string - bucket name
+    """
+    return 'registry.%s' % func.__module__.split('.')[-1]
+
+def reserve(name, now=None):
+    """
+        Reserve a slot in bucket @name.
+
+        @name - string - bucket name
+        @now - float - current time, used for testing
+
+        @return - int - seconds to wait before executing, at most
+                  MAX_COUNTDOWN, or None if the bucket is full. Then don't
+                  schedule the task, it will be found again by the next
+                  CRON execution.
+    """
+    (count, period) = get_rate_limit(name)
+
+    if now is None:
+        now = time.time()
+
+    if _full.get(name, 0) > now:
+        return None
+
+    # first slot of the current window
+    first = int(now // period) * count
+
+    key = 'throttle.%s' % name
+    key = key.replace(' ','_') # memcache doesn't like spaces
+
+    cache.add(key, first, COUNTER_TIMEOUT)
+    try:
+        slot = cache.incr(key) - 1
+    except ValueError: # expired in the meantime
+        cache.set(key, first + 1, COUNTER_TIMEOUT)
+        slot = first
+
+    if slot < first:
+        # the bucket was idle, move the counter to the current window.
+        # Only one caller per window does that, the others run right away
+        if not cache.add('%s.%d' % (key, first), 1, period):
+            return 0
+        slot = cache.incr(key, first - slot) - 1
+
+    countdown = max(0, int((slot // count) * period - now))
+
+    if countdown > MAX_COUNTDOWN:
+        # give the slot back, the bucket is full
+        cache.decr(key)
+        _full[name] = now + period
+        return None
+
+    return countdown
@@ -0,0 +1,249 @@
+################################################################################
+#
+#   Copyright (c) 2014, Alexander Todorov <atodorov@nospam.dif.io>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+################################################################################
+
+"""
+    Lightweight tracing for the long running tasks.
+
+        with tracing.span('generate_advisory_files', advisory=id) as trace:
+            with tracing.span('extract'):
+                ...
+            summary = trace.summary()
+
+    Spans opened inside another span on the same thread become its children.
+    Every span records its duration, CPU time and peak RSS of the process
+    and of its reaped children, the number of subprocesses started,
+    the bytes read/written by the process (including reaped children)
+    and the number of HTTP requests per host. When a span ends it is logged
+    as a single key=value line and sent to the metrics sinks.
+"""
+
+import time
+import metrics
+import logging
+import resource
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+def current():
+    """
+        @return - Span - the innermost open span on this thread or None
+    """
+    return getattr(_local, 'span', None)
+
+def _read_io():
+    """
+        @return - tuple - (bytes read, bytes written) by this process so far.
+        Zeros if /proc/self/io is not available.
+    """
+    read = 0
+    written = 0
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f.readlines():
+                (name, value) = line.split(':', 1)
+                if name == 'rchar':
+                    read = int(value)
+                elif name == 'wchar':
+                    written = int(value)
+    except:
+        pass
+
+    return (read, written)
+
+def _read_cpu():
+    """
+        @return - tuple - (user + system CPU seconds of this process,
+        same for its reaped children)
+    """
+    result = []
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        result.append(usage.ru_utime + usage.ru_stime)
+
+    return tuple(result)
+
+def _read_maxrss():
+    """
+        @return - tuple - (peak RSS in KB of this process, of its largest reaped child)
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+class Span(object):
+    """
+        Use span() instead of creating objects directly.
+    """
+    def __init__(self, name, **tags):
+        self.name = name
+        self.parent = None
+        self.tags = tags
+        self.children = []
+        self.duration = 0
+        self.read = 0
+        self.written = 0
+        self.cpu = 0
+        self.cpu_children = 0
+        self.maxrss = 0
+        self.maxrss_children = 0
+        self.subprocesses = 0
+        self.http = {}
+        self.path = name
+
+    def start(self):
+        self.parent = current()
+        if self.parent:
+            self.path = '%s.%s' % (self.parent.path, self.name)
+        _local.span = self
+
+        self._io = _read_io()
+        self._cpu = _read_cpu()
+        self._started = time.time()
+        return self
+
+    def stop(self):
+        self.duration = time.time() - self._started
+        (read, written) = _read_io()
+        self.read = read - self._io[0]
+        self.written = written - self._io[1]
+        (cpu, cpu_children) = _read_cpu()
+        self.cpu = cpu - self._cpu[0]
+        self.cpu_children = cpu_children - self._cpu[1]
+        # high-water marks, not only this span
+        (self.maxrss, self.maxrss_children) = _read_maxrss()
+
+        _local.span = self.parent
+        if self.parent:
+            self.parent.children.append(self)
+
+        self.report()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+        return False
+
+    def count_subprocess(self):
+        node = self
+        while node:
+            node.subprocesses += 1
+            node = node.parent
+
+    def count_http(self, host):
+        node = self
+        while node:
+            node.http[host] = node.http.get(host, 0) + 1
+            node = node.parent
+
+    def all_tags(self):
+        """
+            @return - dict - tags of this span and its parents
+        """
+        tags = {}
+        if self.parent:
+            tags.update(self.parent.all_tags())
+        tags.update(self.tags)
+        return tags
+
+    def report(self):
+        fields = ['span=%s' % self.path]
+        tags = self.all_tags()
+        for k in sorted(tags.keys()):
+            fields.append('%s=%s' % (k, tags[k]))
+
+        fields.append('duration=%.3f' % self.duration)
+        fields.append('cpu=%.3f' % self.cpu)
+        fields.append('cpu_children=%.3f' % self.cpu_children)
+        fields.append('subprocesses=%d' % self.subprocesses)
+        fields.append('read=%d' % self.read)
+        fields.append('written=%d' % self.written)
+        for host in sorted(self.http.keys()):
+            fields.append('http.%s=%d' % (host, self.http[host]))
+
+        logger.info(' '.join(fields))
+
+        metrics.timing('%s.time' % self.path, int(self.duration * 1000))
+        metrics.incr('%s.subprocesses' % self.path, self.subprocesses)
+        metrics.incr('%s.read' % self.path, self.read)
+        metrics.incr('%s.written' % self.path, self.written)
+        for host in self.http.keys():
+            metrics.incr('%s.http.%s' % (self.path, metrics.clean_name(host)), self.http[host])
+
+    def summary(self):
+        """
+            @return - dict - suitable for JSON serialization. Includes
+            the children which have finished so far.
+        """
+        return {
+            'name' : self.name,
+            'tags' : self.tags,
+            'duration' : round(self.duration or (time.time() - self._started), 3),
+            'subprocesses' : self.subprocesses,
+            'read' : self.read,
+            'written' : self.written,
+            'cpu' : round(self.cpu, 3),
+            'cpu_children' : round(self.cpu_children, 3),
+            'maxrss' : self.maxrss,
+            'maxrss_children' : self.maxrss_children,
+            'http' : self.http,
+            'spans' : [s.summary() for s in self.children],
+        }
+
+
+def span(name, **tags):
+    """
+        @name - string - stage name
+        @tags - additional fields for the log line, e.g. advisory=id
+
+        @return - Span - use as a context manager or call start()/stop()
+    """
+    return Span(name, **tags)
+
+def count_http(host):
+    """
+        Record an HTTP request to @host in the current span, if any.
+    """
+    parent = current()
+    if parent:
+        parent.count_http(host)
+
+
+class CountingPopen(subprocess.Popen):
+    """
+        Counts the subprocesses started inside spans.
+    """
+    def __init__(self, *args, **kwargs):
+        parent = current()
+        if parent:
+            parent.count_subprocess()
+        super(CountingPopen, self).__init__(*args, **kwargs)
+
+def install():
+    """
+        Replace subprocess.Popen so that subprocesses are counted.
+        subprocess.call() and friends use Popen and are counted as well.
+        Safe to call more than once.
+    """
+    if not issubclass(subprocess.Popen, CountingPopen):
+        subprocess.Popen = CountingPopen
@@ -23,13 +23,17 @@ import os
 import re
 import tar
 import json
-import shutil
+import time
 import urllib
-import httplib
 import logging
+import httppool
+import metrics
+import tracing
 import tempfile
+import subprocess
+from gitrepo import GitRepo
 from bugs import BUG_TYPE_UNKNOWN
-from xml.dom.minidom import parse
+from xml.dom.minidom import parse, parseString
 from htmlmin.minify import html_minify
 from BeautifulSoup import BeautifulSoup
 from datetime import datetime, timedelta
@@ -93,11 +97,6 @@ def fetch_page(url, decode=True, last_modified=None, extra_headers={}, method='G
     (host_port, path) = host_path.split('/', 1)
     path = '/' + path
 
-    if url.startswith('https'):
-        conn = httplib.HTTPSConnection(host_port)
-    else:
-        conn = httplib.HTTPConnection(host_port)
-
     # some servers, notably logilab.org returns 404 if not a browser
     # GitHub also requires a valid UA string
     headers = {
@@ -120,35 +119,49 @@ def fetch_page(url, decode=True, last_modified=None, extra_headers={}, method='G
 
 #    print "DEBUG fetch_page - before send", method, path, headers
 
-    conn.request(real_method, path, body=body, headers=headers)
-    response = conn.getresponse()
-
-#    print "DEBUG fetch_page - after send", response.getheaders(), response.status
-
-    if (response.status == 404):
-        raise Exception("404 - %s not found" % url)
-
-    if response.status in [301, 302]:
-        location = response.getheader('Location')
-        logger.info("URL Redirect %d from %s to %s" % (response.status, url, location))
+    tracing.count_http(host_port)
+    started = time.time()
+    status = None
+    size = 0
+    location = None
+    content = None
+
+    # connections are reused, see httppool.py
+    with httppool.host_slot(host_port):
+        try:
+            (conn, response) = httppool.request(url.startswith('https'), host_port, real_method, path, body, headers)
+            status = response.status
+
+#            print "DEBUG fetch_page - after send", response.getheaders(), response.status
+
+            # always read the body so the connection can be reused
+            data = response.read()
+            httppool.release(conn, response)
+
+            if (response.status == 404):
+                raise Exception("404 - %s not found" % url)
+
+            if response.status in [301, 302]:
+                location = response.getheader('Location')
+                logger.info("URL Redirect %d from %s to %s" % (response.status, url, location))
+            elif response.status == 304: # not modified
+                print "DEBUG: 304 %s" % url
+            elif (method == "HEAD") and (response.status == 200):
+                content = response.getheader('Content-Length')
+            elif (method == "HEAD") and (response.status == 206): # partial content
+                content = response.getheader('Content-Range').strip().split(' ')[1].split('/')[1]
+            else:
+                content = data
+                size = len(content)
+                if decode:
+                    content = content.decode('UTF-8', 'replace')
+        finally:
+            metrics.http_request(host_port, path, status, time.time() - started, size, last_modified is not None)
+
+    if location:
         return fetch_page(location, decode, last_modified, extra_headers, method)
 
-    # not modified
-    if response.status == 304:
-        print "DEBUG: 304 %s" % url
-        return None
-
-    if (method == "HEAD"):
-        if response.status == 200:
-            return response.getheader('Content-Length')
-        elif response.status == 206: # partial content
-            return response.getheader('Content-Range').strip().split(' ')[1].split('/')[1]
-
-
-    if decode:
-        return response.read().decode('UTF-8', 'replace')
-    else:
-        return response.read()
+    return content
 
 def get_size(url):
     """
@@ -157,6 +170,32 @@ def get_size(url):
     size = fetch_page(url, method="HEAD")
     return int(size)
 
+def get_package_version_size(pv):
+    """
+        Get the size in bytes of the archive for @pv.
+
+        Uses the size published by the registry, see resolve_version,
+        then the download cache. A HEAD request is the last resort.
+    """
+    if pv.size is not None:
+        return pv.size
+
+    # import grabber here, because urlgrabber is not installed on OpenShift
+    try:
+        import grabber
+    except:
+        try:
+            from difio import grabber
+        except:
+            grabber = None
+
+    if grabber:
+        size = grabber.cached_size(pv.download_url, pv.checksum)
+        if size is not None:
+            return size
+
+    return get_size(pv.download_url)
+
 def get_checkout_url(homepage):
     """
         Construct checkout URL if homepage is at some well
@@ -682,6 +721,46 @@ def get_extract_func(url):
 
     return None
 
+def changelog_from_package_xml(dom):
+    """
+        Render the changelog of a PEAR package.
+
+        @dom - parsed package.xml
+        @return - string - UTF8 encoded Changelog text
+    """
+    result = ""
+
+    changelog = dom.getElementsByTagName("changelog")
+    if changelog:
+        changelog = changelog[0]
+    else:
+        return result
+
+    for release in changelog.childNodes:
+        if release.nodeName != u'release':
+            continue
+
+        version = release.getElementsByTagName("version")[0]
+        release_version = version.getElementsByTagName("release")[0].firstChild.wholeText
+        api_version = version.getElementsByTagName("api")[0].firstChild.wholeText
+
+        stability = release.getElementsByTagName("stability")[0]
+        release_stability = stability.getElementsByTagName("release")[0].firstChild.wholeText
+        api_stability = stability.getElementsByTagName("api")[0].firstChild.wholeText
+
+        date = release.getElementsByTagName("date")[0].firstChild.wholeText
+        notes = release.getElementsByTagName("notes")[0].firstChild.wholeText
+
+        text = """
+%s - Release %s (%s) / API %s (%s)
+--------------------------------------------------
+%s
+""" % (date, release_version, release_stability, api_version, api_stability, notes)
+
+        result += text.encode('UTF8', 'replace')
+
+    return result
+
 def compile_changelog(package_xml):
     """
         Parse a package.xml file from a PEAR package
@@ -691,65 +770,61 @@ def compile_changelog(package_xml):
         @package_xml - path to the file.
     """
 
-    try:
-        # NB: The name is Changelog.php which is unlikely to coincide with a Changelog
-        # file distributed in the tarball itself.
-        changelog_name = os.path.join(os.path.dirname(package_xml), 'Changelog.php')
+    # NB: The name is Changelog.php which is unlikely to coincide with a Changelog
+    # file distributed in the tarball itself.
+    changelog_name = os.path.join(os.path.dirname(package_xml), 'Changelog.php')
 
-        # rewrite the file if it already exists
-        changelog_text = open(changelog_name, 'w')
+    # rewrite the file if it already exists
+    changelog_text = open(changelog_name, 'w')
+    try:
+        changelog_text.write(changelog_from_package_xml(parse(package_xml)))
+    finally:
+        changelog_text.close()
 
-        dom = parse(package_xml)
-        changelog = dom.getElementsByTagName("changelog")
-        if changelog:
-            changelog = changelog[0]
-        else:
-            return
+def _fast_import_members(members, generate_changelog):
+    """
+        Filter archive members before importing them into git.
+        Skips .git files and adds Changelog.php for PEAR packages.
 
-        for release in changelog.childNodes:
-            if release.nodeName != u'release':
-                continue
+        @members - iterable - (path, kind, mode, data), see tar.iter_tar()
+        @generate_changelog - bool - if True compile Changelog.php from package.xml
+    """
+    package_xml = None
 
-            version = release.getElementsByTagName("version")[0]
-            release_version = version.getElementsByTagName("release")[0].firstChild.wholeText
-            api_version = version.getElementsByTagName("api")[0].firstChild.wholeText
+    for member in members:
+        path = member[0]
 
-            stability = release.getElementsByTagName("stability")[0]
-            release_stability = stability.getElementsByTagName("release")[0].firstChild.wholeText
-            api_stability = stability.getElementsByTagName("api")[0].firstChild.wholeText
+        # some packages, e.g. django-leaflet-storage
+        # ship with git submodules in the tarball, represented via .git *files*
+        # git doesn't accept .git path components anyway
+        if '.git' in path.split('/'):
+            continue
 
-            date = release.getElementsByTagName("date")[0].firstChild.wholeText
-            notes = release.getElementsByTagName("notes")[0].firstChild.wholeText
+        if path == 'package.xml':
+            package_xml = member[3]
 
-            text = """
-%s - Release %s (%s) / API %s (%s)
---------------------------------------------------
-%s
-""" % (date, release_version, release_stability, api_version, api_stability, notes)
+        yield member
 
-            changelog_text.write(text.encode('UTF8', 'replace'))
-    finally:
-        changelog_text.close()
+    if generate_changelog and package_xml:
+        yield ('Changelog.php', 'file', 0644, changelog_from_package_xml(parseString(package_xml)))
 
-def download_extract_commit(pv, dirname, generate_changelog=False):
+def download_extract_commit(pv, dirname, generate_changelog=False, fast_import=False):
     """
         @pv - PackageVersion object
         @dirname - directory of local git repo
+        @fast_import - bool - if True stream the archive members into
+                       git fast-import without extracting them. The working
+                       tree is not modified, checkout the tag when needed.
 
         Downloads a tarball, extracts to @dirname
         and commits into local git repository.
     """
 
-    os.chdir(dirname)
-
-#    import sys
-#    print os.getcwd()
-#    print sys.path
+    repo = GitRepo(dirname)
 
     #check if the same tag already exists and skip the import
     version = pv.version.replace(" ", "_")
-    version = version.replace(".", "\.")
-    if os.system('git tag | grep "^%s$"' % version) == 0: # tag alredy exists
+    if repo.has_tag(version): # tag alredy exists
         return
 
     extract_func = get_extract_func(pv.download_url)
@@ -757,63 +832,45 @@ def download_extract_commit(pv, dirname, generate_changelog=False):
     if not extract_func:
         raise Exception('No extract_func for %s' % pv.download_url)
 
-    # remove all files from previous tag.
-    # we're doing this because tags are not imported in sequence.
-    for p in os.listdir(dirname):
-        # skip git directory
-        if (p == ".git") and os.path.isdir(p):
-            continue
-
-        if os.path.isfile(p):
-            os.remove(p)
-
-        if os.path.isdir(p):
-            shutil.rmtree(p, True) # ignore errors
-
-    local_fname = None
-
     # import grabber here, because urlgrabber is not installed on OpenShift
-    # and outside try/finally
     try:
         import grabber
     except:
         from difio import grabber
 
-    try:
-        local_fname = grabber.download_file(pv.download_url, dirname)
-        extract_func(local_fname, dirname)
+    # NB: the file is in the shared download cache, don't remove it
+    local_fname = grabber.download_cached(pv.download_url, pv.checksum)
+    if not local_fname:
+        raise Exception("Failed to download %s" % pv.download_url)
 
-        # some packages, e.g. django-leaflet-storage
-        # ship with git submodules in the tarball, represented via .git *files*
-        # this breaks tarball extraction so remove .git *files* if present
-        for (dirpath, dirs, files) in os.walk(dirname):
-            for f in files:
-                if (f == ".git"):
-                    os.remove(os.path.join(dirpath, f))
-
-        if generate_changelog:
-            compile_changelog(os.path.join(dirname, 'package.xml'))
-    finally:
-        if local_fname:
-            grabber.remove_file(local_fname)
-        else:
-            raise Exception("Failed to download %s" % pv.download_url)
+    if fast_import:
+        members = tar.MEMBER_ITERATORS[extract_func](local_fname)
+        members = _fast_import_members(members, generate_changelog)
+        repo.fast_import(members, 'refs/tags/%s' % version, 'Import %s' % pv.__unicode__())
+        return
+
+    # remove all files from previous tag.
+    # we're doing this because tags are not imported in sequence.
+    repo.clean()
+
+    extract_func(local_fname, dirname)
+
+    # some packages, e.g. django-leaflet-storage
+    # ship with git submodules in the tarball, represented via .git *files*
+    # this breaks tarball extraction so remove .git *files* if present
+    for (dirpath, dirs, files) in os.walk(dirname):
+        for f in files:
+            if (f == ".git"):
+                os.remove(os.path.join(dirpath, f))
+
+    if generate_changelog:
+        compile_changelog(os.path.join(dirname, 'package.xml'))
 
     # extraction is done, now commit
     # NB: extract_func() will extract everything into the dirname
     # and remove any parent directories from the archive so that diff works
-    if os.system("git add .") != 0:
-        raise Exception("FAILED: git add %s/%s" % (dirname, pv.__unicode__()))
-
-    # this may fail if nothing has changed
-    # use -a to commit removed files
-    cmdline = "git commit --allow-empty -a -m 'Import %s' --author='Difio <info@nospam.dif.io>'" % pv.__unicode__()
-    ret_code = os.system(cmdline)
-    if ret_code not in [0, 1]:
-        raise Exception("FAILED: git commit %s/%s - return value %d" % (dirname, pv.__unicode__(), ret_code))
-
-    if os.system("git tag '%s'" % pv.version.replace(" ", "_")) != 0:
-        raise Exception("FAILED: git tag %s/%s" % (dirname, pv.__unicode__()))
+    repo.commit('Import %s' % pv.__unicode__(), repo.worktree_files())
+    repo.tag(version)
 
 
 def files_in_dir(dirname):
@@ -871,17 +928,13 @@ def checkout_or_pull(dirname, scmurl, CLONE_CMD, PULL_CMD):
         # empty directory => checkout sources
         if CLONE_CMD:
             cmdline = CLONE_CMD % (scmurl, dirname)
-            if os.system(cmdline) != 0:
+            if subprocess.call(cmdline, shell=True, cwd=os.path.dirname(dirname.rstrip('/'))) != 0:
                 raise Exception("FAILED: %s" % cmdline)
-
-        os.chdir(dirname)
     else:
         # pull the latest updates
-        os.chdir(dirname)
-
         if PULL_CMD:
             cmdline = PULL_CMD
-            if os.system(cmdline) != 0:
+            if subprocess.call(cmdline, shell=True, cwd=dirname) != 0:
                 raise Exception("FAILED: %s in %s" % (cmdline, dirname))
 
 def which_checkout_dir(scm_short_name, pkg_type, pkg_name, adv_id=None):
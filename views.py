@@ -24,12 +24,12 @@ import uuid
 import utils
 import base64
 import hashlib
-import rubygems
 import difio.tasks
 import pkg_parsers
 from forms import *
 from models import *
 from django.conf import settings
+from decorators import query_budget
 from django.core.cache import cache
 from django.core import cache as cache_module
 from django.shortcuts import render
@@ -245,6 +245,7 @@ def ajax_delete_inst_pkg(request):
 # member pages
 
 @login_required
+@query_budget
 def dashboard(request):
     """
         Display applications owned by the current user.
@@ -585,6 +586,7 @@ def _appdetails_get_objects_fast(owner, app_id, show_all, page):   # FALSE NEGAT
 
 
 @login_required
+@query_budget
 def appdetails(request, id):
     """
         Display information about particular application.
@@ -1028,16 +1030,10 @@ def hook_rubygems(request):
     authorization = hashlib.sha256(data['name'] + data['version'] + settings.RUBYGEMS_API_KEY).hexdigest()
     if request.META['HTTP_AUTHORIZATION'] != authorization:
         return HttpResponse("Unauthorized", mimetype='text/plain', status=401)
-    else:
-        try:
-# see https://github.com/rubygems/rubygems.org/issues/536
-            # todo: don't add prerelease software
-            (latest_ver, released_on) = rubygems.get_latest(data['name']) # this can raise 404 sometimes
 
-            if latest_ver == data['version']:
-                difio.tasks.pv_import_new_from_rss.delay(RUBYGEM_RUBY_PKG, data['name'], data['version'], released_on)
-        except:
-            pass
+    # NB: don't query RubyGems.org here. Events are imported in batches
+    # by tasks.cron_process_webhook_events
+    WebHookEvent.objects.create(pkg_type=RUBYGEM_RUBY_PKG, payload=json.dumps(data))
 
     return HttpResponse("Success", mimetype='text/plain', status=200)
 